@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import logging.handlers
+import os
+import signal
+import ssl
+import sys
+import threading
+import time
+
+import obd
+from obd import OBDStatus
+import paho.mqtt.client as mqtt
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../obdii')
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../common')
+import obdii_data  # noqa: E402
+from obdii_data import OBDIIConnectionError, vehicle_connect, probe_vehicle, discover_capabilities, query_data, state_message, open_analytics  # noqa: E402
+from scheduler import PollingScheduler  # noqa: E402
+from trips import TripDetector  # noqa: E402
+from charging import ChargeEstimator  # noqa: E402
+from power import PowerManager  # noqa: E402
+from connection_cache import ConnectionCache  # noqa: E402
+from capabilities import CapabilityMap  # noqa: E402
+from breaker import CircuitBreaker  # noqa: E402
+from raw_frames import RawBatch  # noqa: E402
+from store import open_store, backlog_message  # noqa: E402
+from changes import ChangeFilter  # noqa: E402
+from payloads import PayloadEncoder  # noqa: E402
+from timeseries import open_time_series  # noqa: E402
+from metrics import Metrics  # noqa: E402
+from location import Fix, location_info  # noqa: E402
+from track import AdaptiveTracker  # noqa: E402
+
+# gpsd JSON protocol: stream reports as JSON objects, one per line
+GPSD_WATCH = b'?WATCH={"enable":true,"json":true};\n'
+
+
+class MqttLoop(object):
+    """Drive a paho MQTT client from the asyncio event loop instead of its network thread.
+
+    The client socket is watched with add_reader/add_writer, so publishing only
+    queues the packets and they are written as soon as the socket is writable.
+    Socket callbacks may be called from an executor thread (connecting does a
+    blocking TLS handshake), so the loop is always updated thread-safely.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_reader, sock.fileno(), client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_reader, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock.fileno())
+
+
+class Agent(object):
+    """Collect OBDII and GPS data and publish it to MQTT from a single process.
+
+    Everything runs on one asyncio event loop:
+        - OBDII: python-OBD is blocking, so the polling cycles run in a
+          dedicated thread (the only one using the serial link) and the loop
+          just awaits them. A slow command only delays the OBDII data.
+        - GPS: gpsd JSON reports are read from its socket as they arrive, the
+          latest fix is published every gps sleep seconds.
+        - MQTT: the client is driven by the loop (see MqttLoop), it reconnects
+          in the background with exponential backoff.
+
+    Collected messages go through a bounded outbox queue, so the collectors
+    never wait for the broker: when the outbox is full the oldest message is
+    moved to the store (or dropped) and the MQTT client queue is bounded too,
+    messages not accepted by it are stored to be published later.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.topic_prefix = config['mqtt']['topic_prefix']
+        base_dir = os.path.dirname(os.path.realpath(__file__))
+        self.store = open_store(config.get('store'), base_dir)
+        self.change_filter = ChangeFilter.from_config(config.get('changes'))
+        self.encoder = PayloadEncoder.from_config(config.get('encoding'), self.topic_prefix)
+        self.time_series = open_time_series(config.get('timeseries'), base_dir)
+        self.metrics_config = config.get('metrics')
+        # Only used from the OBDII thread
+        self.metrics = Metrics() if self.metrics_config else None
+        self.trips = TripDetector.from_config(config.get('trips'), base_dir)
+        self.analytics = open_analytics(config.get('analytics'))
+        if self.analytics is not None and self.time_series is not None:
+            self.analytics.seed(self.time_series)
+        # Only used from the OBDII thread (and between cycles)
+        self.power = PowerManager.from_config(config.get('power'), base_dir, self.metrics)
+        self.charge_estimator = ChargeEstimator.from_config(config.get('charging'), config.get('vehicle', {}).get('battery_capacity'), base_dir)
+        self.connection_cache = ConnectionCache.from_config(config.get('connection_cache'), base_dir)
+        self.capabilities = CapabilityMap.from_config(config.get('capabilities'), base_dir)
+        self.breaker = CircuitBreaker.from_config(config.get('breaker'), base_dir, self.metrics)
+        self.raw = RawBatch.from_config(config.get('raw'))
+        # Discover the vehicle again once (--discover)
+        self.discover = config.get('discover', False)
+        self.outbox = None
+        self.mqtt_client = None
+        self.connection = None
+        self.obd_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.stop = threading.Event()
+        self.stored_published = None
+        self.published = 0
+        self.dropped = 0
+
+    def enqueue(self, msgs):
+        """Add messages to the outbox without waiting, moving the oldest ones out when it's full."""
+        for msg in msgs:
+            if self.outbox.full():
+                oldest = self.outbox.get_nowait()
+                self.dropped += 1
+                if self.store is not None:
+                    self.store.put([oldest])
+                logger.warning("Outbox full, {} message not published live".format(oldest['topic']))
+            self.outbox.put_nowait(msg)
+
+    async def run_mqtt(self):
+        """Keep the MQTT client connected and process its keepalives and retries."""
+        mqtt_config = self.config['mqtt']
+        loop = asyncio.get_event_loop()
+        client = mqtt.Client(client_id="pioniq-agent", protocol=mqtt.MQTTv311, transport="tcp")
+        client.tls_set(tls_version=ssl.PROTOCOL_TLS)
+        client.username_pw_set(mqtt_config['user'], mqtt_config['password'])
+        client.enable_logger(logger)
+        client.max_queued_messages_set(int(self.config.get('service', {}).get('max_queued_messages', 100)))
+        client.on_connect = lambda client, userdata, flags, rc: self.on_connect(rc)
+        MqttLoop(loop, client)
+        client.connect_async(mqtt_config['broker'], int(mqtt_config['port']), int(mqtt_config.get('keepalive', 60)))
+        self.mqtt_client = client
+
+        backoff = 1
+        while True:
+            if client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                try:
+                    logger.debug("Connecting to MQTT...")
+                    # Name resolution, TCP connection and TLS handshake are blocking
+                    await loop.run_in_executor(None, client.reconnect)
+                    backoff = 1
+                except (OSError, ssl.SSLError, ValueError) as err:
+                    logger.error("MQTT connection could not be established: {}, retrying in {} second(s)...".format(err, backoff))
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 60)
+                    continue
+            await asyncio.sleep(1)
+
+    def on_connect(self, rc):
+        if rc == mqtt.CONNACK_ACCEPTED:
+            logger.info("Connected to MQTT")
+            if self.store is not None and len(self.store) > 0:
+                self.stored_published.set()
+        else:
+            logger.error("Not connected to MQTT: {}".format(mqtt.connack_string(rc)))
+
+    async def run_publisher(self):
+        """Publish the outbox messages, storing the ones the MQTT client doesn't accept."""
+        while True:
+            msgs = [await self.outbox.get()]
+            while not self.outbox.empty():
+                msgs.append(self.outbox.get_nowait())
+            if self.change_filter is not None:
+                msgs = self.change_filter.filter(msgs)
+            if self.encoder is not None:
+                msgs = self.encoder.encode(msgs)
+            failed = []
+            for msg in msgs:
+                result = self.mqtt_client.publish(topic=msg['topic'],
+                                                  payload=msg['payload'],
+                                                  qos=msg['qos'],
+                                                  retain=msg['retain'])
+                if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.published += 1
+                    logger.debug("Message published to {}".format(msg['topic']))
+                else:
+                    logger.error("Error publishing to MQTT: {}".format(mqtt.error_string(result.rc)))
+                    failed.append(msg)
+            if failed:
+                if self.store is not None:
+                    self.store.put(failed)
+            elif self.store is not None and len(self.store) > 0:
+                self.stored_published.set()
+
+    async def run_store(self, batch_size=100, timeout=30):
+        """Publish the stored messages (see drain_store) whenever the broker is reachable again.
+
+        It runs apart from the live messages, so waiting for the stored
+        messages acknowledgement never delays them.
+        """
+        while True:
+            await self.stored_published.wait()
+            self.stored_published.clear()
+            published = 0
+            while self.mqtt_client.is_connected():
+                rows = self.store.peek(batch_size)
+                if not rows:
+                    break
+                results = []
+                for row_id, msg in rows:
+                    msg = backlog_message(msg)
+                    results.append((row_id, self.mqtt_client.publish(topic=msg['topic'], payload=msg['payload'], qos=1, retain=False)))
+                deadline = time.monotonic() + timeout
+                pending = [result for _, result in results if result.rc == mqtt.MQTT_ERR_SUCCESS]
+                while any(not result.is_published() for result in pending) and time.monotonic() < deadline:
+                    await asyncio.sleep(0.05)
+                acknowledged = []
+                for row_id, result in results:
+                    if result.rc != mqtt.MQTT_ERR_SUCCESS or not result.is_published():
+                        break
+                    acknowledged.append(row_id)
+                self.store.delete(acknowledged)
+                published += len(acknowledged)
+                if len(acknowledged) < len(rows):
+                    logger.warning("Broker didn't acknowledge all stored messages, will retry later")
+                    break
+            if published > 0:
+                logger.info("{} stored message(s) published, {} left".format(published, len(self.store)))
+
+    def obd_cycle(self, cycle_start, interval, reverse):
+        """Query the vehicle once (OBDII thread), reconnecting when needed. Returns the messages."""
+        msgs = []
+        try:
+            if self.connection is None or self.connection.status() != OBDStatus.CAR_CONNECTED:
+                if self.connection is not None:
+                    logger.warning("OBDII connection lost ({}). Reconnecting...".format(self.connection.status()))
+                    self.connection.close()
+                    self.connection = None
+                self.connection = vehicle_connect(self.config, self.metrics, self.power, self.connection_cache)
+                self.connection.scheduler = PollingScheduler(self.config.get('schedule'))
+                # ECUs not answering are kept across connections
+                self.connection.breaker = self.breaker
+                self.connection.raw = self.raw
+            if self.power is None or not self.power.sleeping or probe_vehicle(self.connection, self.power):
+                if self.capabilities is not None and (self.discover or self.capabilities.needs_discovery()):
+                    if discover_capabilities(self.connection, self.capabilities):
+                        self.discover = False
+                self.connection.scheduler.start_cycle(cycle_start)
+                msgs = query_data(self.connection, self.config, self.topic_prefix, reverse,
+                                  deadline=cycle_start + interval, stop=self.stop, trips=self.trips,
+                                  analytics=self.analytics, charge_estimator=self.charge_estimator,
+                                  power=self.power, capabilities=self.capabilities)
+        except OBDIIConnectionError as err:
+            logger.error("OBDII connection error: {0}".format(err), exc_info=False)
+            if self.power is not None:
+                self.power.unanswered()
+        except Exception as ex:
+            logger.error("Unexpected error: {}".format(ex), exc_info=True)
+        if self.breaker is not None:
+            self.breaker.save()
+        if self.trips is not None:
+            trip_msg = self.trips.end_message(self.topic_prefix + "trip")
+            if trip_msg is not None:
+                msgs.append(trip_msg)
+        if self.metrics is not None:
+            self.metrics.observe('obdii_cycle_duration_seconds', time.monotonic() - cycle_start)
+            if time.monotonic() >= self.next_metrics:
+                msgs.append(self.metrics.message(self.topic_prefix + "metrics"))
+                if self.metrics_config.get('textfile'):
+                    self.metrics.write_textfile(self.metrics_config['textfile'])
+                self.next_metrics += float(self.metrics_config.get('interval', 60))
+        return msgs
+
+    def obd_close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    async def run_obd(self):
+        """Poll the vehicle every service interval (or the interval of the power state when configured)."""
+        loop = asyncio.get_event_loop()
+        interval = float(self.config.get('service', {}).get('interval', 10))
+        next_cycle = time.monotonic()
+        self.next_metrics = next_cycle
+        reverse = False
+        while True:
+            if self.power is not None:
+                interval = self.power.interval()
+            msgs = [state_message(self.topic_prefix)]
+            msgs.extend(await loop.run_in_executor(self.obd_executor, self.obd_cycle, next_cycle, interval, reverse))
+            reverse = not reverse
+            if self.time_series is not None:
+                for msg in msgs[1:]:
+                    topic = msg['topic'][len(self.topic_prefix):]
+                    # Metrics and raw batches are not vehicle values
+                    if topic not in ("metrics", "raw"):
+                        self.time_series.append_values(topic, json.loads(msg['payload']))
+            self.enqueue(msgs)
+            logger.info("OBDII cycle finished in {:.3f} second(s)".format(time.monotonic() - next_cycle))
+
+            if self.power is not None:
+                # The state may have changed during the cycle (i.e. the car woke up)
+                interval = self.power.interval()
+            next_cycle += interval
+            delay = next_cycle - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                logger.warning("OBDII cycle took {:.1f} second(s) longer than the configured interval".format(-delay))
+                next_cycle = time.monotonic()
+
+    async def run_gps(self):
+        """Read the gpsd reports as they arrive and publish the latest fix every gps sleep seconds.
+
+        When tracking is configured, the tracker decides when the location is
+        published and the simplified track is published to the track topic.
+        """
+        gps_config = self.config['gps']
+        sleep_time = float(gps_config.get('sleep', 15))
+        max_accuracy = float(gps_config.get('min_accuracy', 30))
+        tracker = AdaptiveTracker.from_config(self.config.get('tracking'))
+        if tracker is not None:
+            sleep_time = 1
+        state = {'fix': None}
+
+        async def read_reports():
+            backoff = 1
+            while True:
+                writer = None
+                try:
+                    reader, writer = await asyncio.open_connection(gps_config.get('host', '127.0.0.1'),
+                                                                   int(gps_config.get('port', 2947)))
+                    writer.write(GPSD_WATCH)
+                    logger.info("Connected to gpsd")
+                    backoff = 1
+                    while True:
+                        line = await reader.readline()
+                        if not line:
+                            raise ConnectionError("connection closed by gpsd")
+                        try:
+                            report = json.loads(line)
+                        except ValueError:
+                            logger.warning("Invalid gpsd report: {}".format(line))
+                            continue
+                        if report.get('class') == 'TPV':
+                            state['fix'] = Fix.from_report(report)
+                except OSError as err:
+                    logger.error("gpsd error: {}, reconnecting in {} second(s)...".format(err, backoff))
+                    state['fix'] = None
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 60)
+                finally:
+                    if writer is not None:
+                        writer.close()
+
+        reader_task = asyncio.ensure_future(read_reports())
+        previous = None
+        last_fix = None
+        try:
+            while True:
+                await asyncio.sleep(sleep_time)
+                fix = state['fix']
+                if tracker is not None and tracker.track_due():
+                    self.enqueue([tracker.track_message(self.topic_prefix + "track")])
+                if fix is None or fix is last_fix:
+                    if tracker is None:
+                        logger.warning("No new GPS fix since last update")
+                    continue
+                last_fix = fix
+                if tracker is not None:
+                    if fix.mode >= 2 and fix.accuracy < max_accuracy:
+                        tracker.add(fix)
+                    if not tracker.location_due(fix):
+                        continue
+                location = location_info(fix, max_accuracy, previous)
+                if location is None:
+                    continue
+                if tracker is not None:
+                    tracker.published(fix)
+                previous = (location['latitude'], location['longitude'])
+                if self.time_series is not None:
+                    self.time_series.append_values("location", location)
+                self.enqueue([{'topic': self.topic_prefix + "location", 'payload': json.dumps(location), 'qos': 0, 'retain': True}])
+        finally:
+            reader_task.cancel()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        stopping = asyncio.Event()
+        # systemd stops the service with SIGTERM, exit cleanly closing connections
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stopping.set)
+        self.outbox = asyncio.Queue(maxsize=int(self.config.get('service', {}).get('queue_size', 100)))
+        self.stored_published = asyncio.Event()
+        tasks = [asyncio.ensure_future(self.run_mqtt())]
+        # Let run_mqtt create the client before publishing
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(self.run_publisher()))
+        if self.store is not None:
+            tasks.append(asyncio.ensure_future(self.run_store()))
+        if self.config.get('serial') or self.config.get('replay'):
+            tasks.append(asyncio.ensure_future(self.run_obd()))
+        if self.config.get('gps'):
+            tasks.append(asyncio.ensure_future(self.run_gps()))
+        tasks.append(asyncio.ensure_future(stopping.wait()))
+        try:
+            logger.info("=== Agent start ===")
+            # Besides the stopping event, any task ending means it failed
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            # Stop the OBDII cycle after the module being queried
+            self.stop.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await loop.run_in_executor(self.obd_executor, self.obd_close)
+            self.obd_executor.shutdown()
+            if self.store is not None:
+                unpublished = []
+                while not self.outbox.empty():
+                    unpublished.append(self.outbox.get_nowait())
+                if unpublished:
+                    self.store.put(unpublished)
+                self.store.close()
+            if self.mqtt_client is not None:
+                self.mqtt_client.disconnect()
+            if self.time_series is not None:
+                self.time_series.close()
+            logger.info("{} message(s) published, {} moved out of the outbox".format(self.published, self.dropped))
+            logger.info("===  Agent end  ===")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read the OBDII data and the GPS location and publish them to MQTT.")
+    parser.add_argument('--discover',
+                        action='store_true',
+                        help="probe the commands supported by the vehicle again (needs the capabilities section)")
+    args = parser.parse_args()
+
+    console_handler = logging.StreamHandler()  # sends output to stderr
+    console_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-10s %(levelname)-8s %(message)s"))
+    console_handler.setLevel(logging.DEBUG)
+
+    file_handler = logging.handlers.TimedRotatingFileHandler(os.path.dirname(os.path.realpath(__file__)) + '/../agent.log',
+                                                             when='midnight',
+                                                             backupCount=15
+                                                             )  # sends output to agent.log file rotating it at midnight and storing latest 15 days
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-10s %(levelname)-8s %(message)s"))
+    file_handler.setLevel(logging.INFO)
+
+    # Same handlers for the agent, the OBDII functions, python-OBD and the shared modules loggers
+    obd.logger.setLevel(obd.logging.DEBUG)
+    for handler in obd.logger.handlers[:]:
+        obd.logger.removeHandler(handler)
+    for module_logger in (logger, obdii_data.logger, obd.logger, logging.getLogger('pioniq')):
+        module_logger.setLevel(logging.DEBUG)
+        module_logger.addHandler(console_handler)
+        module_logger.addHandler(file_handler)
+
+    with open(os.path.dirname(os.path.realpath(__file__)) + '/agent.config.json') as config_file:
+        config = json.loads(config_file.read())
+
+    if args.discover:
+        if not config.get('capabilities'):
+            parser.error("--discover needs the capabilities section in agent.config.json")
+        config['discover'] = True
+
+    asyncio.run(Agent(config).run())
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger('agent')
+    # obdii_data functions log to the logger created when it runs as a script
+    obdii_data.logger = logging.getLogger('obdii')
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import argparse
+import atexit
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../obdii')
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../common')
+import decoders  # noqa: E402
+import obdii_data  # noqa: E402
+from commands import ext_commands  # noqa: E402
+from recorder import ReplayConnection  # noqa: E402
+from transport import FrameParser  # noqa: E402
+import raw_frames  # noqa: E402
+try:
+    # NumPy is optional, only needed by the analytics
+    from battery import PackAnalytics
+except ImportError:
+    PackAnalytics = None
+
+# Recorded responses of every command in commands.py (obdii_data.py --record against the emulator)
+FRAMES = os.path.dirname(os.path.realpath(__file__)) + '/frames.jsonl'
+BASELINE = os.path.dirname(os.path.realpath(__file__)) + '/baseline.json'
+
+logger = logging.getLogger('benchmark')
+
+
+class CachedConnection(object):
+    """Connection answering every query with an already decoded response, to measure what happens after decoding."""
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def query(self, command, force=False):
+        return self.responses[command.name]
+
+
+def decoded_responses():
+    """Decode every recorded response once: {command name: OBDResponse}."""
+    connection = ReplayConnection(FRAMES, realtime=False)
+    return {name: connection.query(ext_commands[name]) for name in connection.records}
+
+
+def benchmarks():
+    """Return {benchmark name: function to measure}."""
+    replay = ReplayConnection(FRAMES, realtime=False)
+    messages = {name: replay.protocol(replay.records[name][0]['lines']) for name in replay.records}
+    responses = decoded_responses()
+    config = {'vehicle': {'battery_capacity': 28}}
+    cases = {}
+
+    # Decoders, called as python-OBD does (with the parsed messages)
+    for name, command in sorted(ext_commands.items()):
+        decoder = getattr(decoders, command.decode.__name__, None)
+        if decoder is not None and decoder is command.decode:
+            cases['decode.' + name] = (lambda decoder=decoder, command_messages=messages[name]: decoder(command_messages))
+
+    # Response parsing and decoding from the raw adapter lines: python-OBD messages and lean transport
+    parser = FrameParser()
+    for name, command in sorted(ext_commands.items()):
+        layout = decoders.LAYOUTS.get(command.decode.__name__)
+        if layout is None or name not in replay.records:
+            continue
+        lines = replay.records[name][0]['lines']
+        # The lean transport sets the adapter without spaces
+        raw = "\r".join(line.replace(" ", "") for line in lines).encode()
+        cases['parse.obd.' + name] = (lambda command=command, lines=lines: command(replay.protocol(lines)).value)
+        cases['parse.lean.' + name] = (lambda layout=layout, raw=raw: layout.decode_data(parser.parse(raw)[0]))
+
+    # Battery information assembly (cell voltages merge, module temperatures average, ...) without decoding
+    cached_connection = CachedConnection(responses)
+    cases['assembly.battery'] = lambda: obdii_data.query_battery_info(cached_connection, 28)
+
+    # JSON serialization of the battery information
+    battery_info = obdii_data.query_battery_info(cached_connection, 28)
+    cases['json.battery'] = lambda: json.dumps(battery_info)
+
+    # Battery pack analytics (cell voltage and module temperature statistics, drift) of a sample
+    if PackAnalytics is not None:
+        analytics = PackAnalytics()
+        cases['analytics.battery'] = lambda: analytics.analyze(battery_info)
+
+    # Raw batch of a cycle (a response of every command) and batch decoding of 1000 cycles
+    frames = [(0, raw_frames.COMMAND_IDS[name], obdii_data.response_data(response))
+              for name, response in sorted(responses.items()) if name in raw_frames.COMMAND_IDS]
+    cases['raw.encode'] = lambda: raw_frames.encode(frames)
+    cases['raw.encode_zlib'] = lambda: raw_frames.encode(frames, compress=True)
+    batch = raw_frames.encode(frames)
+    cases['raw.decode'] = lambda: raw_frames.decode_batch(batch)
+    stored = raw_frames.encode(frames * 1000, compress=True)
+    decoder = raw_frames.BatchDecoder()
+    cases['raw.decode_x1000'] = lambda: sum(1 for frame in decoder.decode(stored))
+
+    # Full collection cycle (queries, decoding, assembly and messages) against the recorded session
+    def cycle():
+        connection = ReplayConnection(FRAMES, realtime=False)
+        msgs = [obdii_data.state_message("car/")]
+        msgs.extend(obdii_data.query_data(connection, config, "car/"))
+        return msgs
+    cases['cycle.query_data'] = cycle
+
+    # Whole cron run (run_once) replaying the session: connection, queries, trips, time series, binary
+    # encoding and metrics, with the MQTT publishing replaced by collecting the messages
+    cases['cycle.run_once'] = run_once_cycle()
+    return cases
+
+
+def run_once_cycle():
+    """Function running obdii_data.run_once against the recorded session, its state files in a temporary folder."""
+    folder = tempfile.mkdtemp(prefix='pioniq-benchmark-')
+    atexit.register(shutil.rmtree, folder, True)
+    config = {
+        'mqtt': {'broker': 'localhost', 'port': 8883, 'user': 'user', 'password': 'password', 'topic_prefix': 'car/'},
+        'replay': {'path': FRAMES, 'realtime': False},
+        'vehicle': {'battery_capacity': 28},
+        'store': {'path': os.path.join(folder, 'obdii_data.db')},
+        'trips': {'path': os.path.join(folder, 'trips.json')},
+        'timeseries': {'path': os.path.join(folder, 'obdii_data.ring'), 'capacity': 10000},
+        'encoding': {'battery': 'binary-zlib', 'vmcu': 'binary', 'tpms': 'binary'},
+        'metrics': {'interval': 60},
+    }
+    published = []
+
+    def publish_data_mqtt(msgs, store=None, **kwargs):
+        published.extend(msgs)
+
+    obdii_data.publish_data_mqtt = publish_data_mqtt
+
+    def cycle():
+        del published[:]
+        obdii_data.run_once(config)
+        return published
+    return cycle
+
+
+def measure(function, repeat=7, min_time=0.2):
+    """Best time per call in microseconds (the minimum is the least noisy estimate)."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decoders, battery information assembly, JSON serialization and full cycles.")
+    parser.add_argument('--baseline', default=BASELINE, help="baseline file to compare with (default: %(default)s)")
+    parser.add_argument('--save', action='store_true', help="save the results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help="max slowdown ratio against the baseline before failing (default: %(default)s)")
+    parser.add_argument('--filter', default='', help="only run the benchmarks whose name contains this text")
+    args = parser.parse_args()
+
+    # Keep the benchmarked code quiet
+    obdii_data.logger = logging.getLogger('obdii')
+    logging.getLogger('obdii').setLevel(logging.ERROR)
+    logging.getLogger('obd').setLevel(logging.ERROR)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    slower = []
+    print("{:<28} {:>14} {:>14} {:>8}".format("benchmark", "baseline (us)", "current (us)", "ratio"))
+    for name, function in sorted(benchmarks().items()):
+        if args.filter not in name:
+            continue
+        results[name] = round(measure(function), 3)
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            status = "SLOWER" if ratio > args.threshold else ""
+            if status:
+                slower.append(name)
+            print("{:<28} {:>14.2f} {:>14.2f} {:>8.2f} {}".format(name, baseline[name], results[name], ratio, status))
+        else:
+            print("{:<28} {:>14} {:>14.2f} {:>8}".format(name, "-", results[name], "-"))
+
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4, sort_keys=True)
+        print("Baseline saved to {}".format(args.baseline))
+    if slower:
+        print("{} benchmark(s) slower than {}x the baseline: {}".format(len(slower), args.threshold, ", ".join(slower)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
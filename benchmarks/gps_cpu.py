@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+import gps
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../gps')
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../common')
+import gps_data  # noqa: E402
+
+# gpsd reports of a GlobalSat BU-353-S4 (TPV and SKY every second): parked, driving and stopping
+STREAM = os.path.dirname(os.path.realpath(__file__)) + '/gpsd.jsonl'
+
+
+def record(host, port, path, seconds):
+    """Record the gpsd JSON reports with their time offset (one JSON object per line)."""
+    client = socket.create_connection((host, port))
+    client.sendall(b'?WATCH={"enable":true,"json":true};\n')
+    start = time.monotonic()
+    with client.makefile('rb') as reports, open(path, 'w') as stream_file:
+        for line in reports:
+            stream_file.write(json.dumps({'t': round(time.monotonic() - start, 3), 'line': line.decode().rstrip()}) + "\n")
+            if time.monotonic() - start > seconds:
+                break
+    client.close()
+
+
+def serve(path, port, speed, ready):
+    """Fake gpsd replaying a recorded stream to the first client, speed times faster."""
+    with open(path) as stream_file:
+        records = [json.loads(line) for line in stream_file]
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(1)
+    ready.set()
+    client, _ = server.accept()
+    # Wait for the WATCH command
+    client.recv(1024)
+    start = time.monotonic()
+    for record in records:
+        delay = start + record['t'] / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        client.sendall(record['line'].encode() + b'\r\n')
+    client.close()
+    server.close()
+
+
+def run_poller(port, duration, sleep_time):
+    """Previous gps_data.py: a thread calling next() on the gps session and sampling gpsd.fix."""
+    gpsd = gps.gps(port=port, mode=gps.WATCH_ENABLE)
+    running = [True]
+    reports = [0]
+
+    def poll():
+        try:
+            while running[0]:
+                next(gpsd)
+                reports[0] += 1
+        except StopIteration:
+            # End of the stream
+            pass
+
+    poller = threading.Thread(target=poll, daemon=True)
+    poller.start()
+    fixes = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        time.sleep(sleep_time)
+        if max(gpsd.fix.epy, gpsd.fix.epx) < 30:
+            fixes += 1
+    running[0] = False
+    return reports[0], fixes
+
+
+def run_reader(port, duration, sleep_time):
+    """Current gps_data.py: GpsReader waiting for reports and snapshots of the latest fix."""
+    reader = gps_data.GpsReader(port=port)
+    reader.start()
+    fixes = 0
+    last_fix = None
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        time.sleep(sleep_time)
+        fix = reader.latest()
+        if fix is not None and fix is not last_fix and fix.accuracy < 30:
+            fixes += 1
+        last_fix = fix
+    reader.stop()
+    reader.join()
+    return reader.reports, fixes
+
+
+def measure(consumer, path, port, speed, sleep_time):
+    with open(path) as stream_file:
+        duration = (json.loads(stream_file.readlines()[-1])['t'] + 1) / speed
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(path, port, speed, ready))
+    server.start()
+    ready.wait()
+    start_cpu = time.process_time()
+    start = time.monotonic()
+    reports, fixes = consumer(port, duration, sleep_time / speed)
+    cpu = time.process_time() - start_cpu
+    wall = time.monotonic() - start
+    server.join()
+    return reports, fixes, cpu, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the CPU used to read a recorded gpsd stream by the previous GPS poller and the current GPS reader.")
+    parser.add_argument('--stream', default=STREAM, help="recorded gpsd stream (default: %(default)s)")
+    parser.add_argument('--record', type=float, metavar='SECONDS', help="record SECONDS of the local gpsd to --stream instead")
+    parser.add_argument('--port', type=int, default=12947, help="port of the fake gpsd")
+    parser.add_argument('--speed', type=float, default=1, help="replay the stream SPEED times faster")
+    parser.add_argument('--sleep', type=float, default=15, help="seconds between location samples, as service.sleep")
+    args = parser.parse_args()
+
+    if args.record:
+        record('127.0.0.1', gps.GPSD_PORT, args.stream, args.record)
+        return
+
+    # Reconnection errors at the end of the stream are expected
+    gps_data.logger = logging.getLogger('gps')
+    gps_data.logger.addHandler(logging.NullHandler())
+    gps_data.logger.propagate = False
+    print("{:<8} {:>8} {:>6} {:>10} {:>8} {:>8}".format("reader", "reports", "fixes", "cpu (ms)", "wall (s)", "cpu %"))
+    for name, consumer in (("poller", run_poller), ("reader", run_reader)):
+        reports, fixes, cpu, wall = measure(consumer, args.stream, args.port, args.speed, args.sleep)
+        print("{:<8} {:>8} {:>6} {:>10.1f} {:>8.1f} {:>8.2f}".format(name, reports, fixes, cpu * 1000, wall, cpu / wall * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""Check the lean transport parsing (FrameParser and decoders.LAYOUTS) against python-OBD.
+
+Every recorded response of the benchmarks/frames*.jsonl sessions (see
+--record, drop a session recorded in the car there to check it too) is
+parsed and decoded by both, as well as the same responses with every data
+byte set to edge values (i.e. 0x80 and 0xFF, signed and unsigned limits) and
+to random values, framed again as the adapter sends them.
+
+Run with: python3 -m unittest discover benchmarks
+"""
+
+import glob
+import os
+import random
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../obdii')
+import decoders  # noqa: E402
+from commands import ext_commands  # noqa: E402
+from recorder import ReplayConnection  # noqa: E402
+from transport import FrameParser, HEADER_LENGTHS  # noqa: E402
+
+SESSIONS = sorted(glob.glob(os.path.dirname(os.path.realpath(__file__)) + '/frames*.jsonl'))
+EDGE_VALUES = (0x00, 0x01, 0x7F, 0x80, 0xFE, 0xFF)
+
+
+def iso_tp_lines(can_id, data):
+    """Frame the message data as the adapter lines of an ISO-TP response (headers on, no spaces)."""
+    if len(data) <= 7:
+        frames = [bytes([len(data)]) + data]
+    else:
+        frames = [bytes([0x10 | len(data) >> 8, len(data) & 0xFF]) + data[:6]]
+        for sequence, start in enumerate(range(6, len(data), 7), 1):
+            frames.append(bytes([0x20 | sequence & 0x0F]) + data[start:start + 7])
+    return [can_id + frame.ljust(8, b'\xAA').hex().upper() for frame in frames]
+
+
+class FrameParsingTest(unittest.TestCase):
+
+    def assert_same(self, replay, name, lines):
+        """Parse and decode the response lines with python-OBD and with the lean transport, expecting the same."""
+        command = ext_commands[name]
+        layout = decoders.LAYOUTS[command.decode.__name__]
+        messages = replay.protocol(lines)
+        parser = FrameParser(HEADER_LENGTHS[replay.protocol_id()])
+        data, text = parser.parse("\r".join(lines).encode())
+        self.assertIsNotNone(data, "{} not reassembled: {}".format(name, lines))
+        self.assertEqual(bytes(data), bytes(messages[0].data), name)
+        self.assertEqual(layout.decode_data(data), command(messages).value, name)
+
+    def test_sessions(self):
+        self.assertTrue(SESSIONS)
+        rng = random.Random(0)
+        for path in SESSIONS:
+            replay = ReplayConnection(path, realtime=False)
+            header_length = HEADER_LENGTHS[replay.protocol_id()]
+            for name, records in sorted(replay.records.items()):
+                command = ext_commands.get(name)
+                if command is None or command.decode.__name__ not in decoders.LAYOUTS:
+                    continue
+                for record in records:
+                    lines = record.get('lines')
+                    messages = replay.protocol(lines) if lines else None
+                    if not messages:
+                        # Errors and responses without data (i.e. NO DATA) aren't decoded
+                        continue
+                    with self.subTest(session=os.path.basename(path), command=name, t=record['t']):
+                        self.assert_same(replay, name, lines)
+                        # Same response with other values, keeping the service and PID bytes
+                        can_id = lines[0][:header_length]
+                        data = bytes(messages[0].data)
+                        payloads = [bytes([value]) * (len(data) - 2) for value in EDGE_VALUES]
+                        payloads += [bytes(rng.randrange(256) for _ in range(len(data) - 2)) for _ in range(10)]
+                        for payload in payloads:
+                            if command.decode.__name__ == 'vin' and any(byte > 0x7F for byte in payload):
+                                # The VIN is ASCII text
+                                continue
+                            self.assert_same(replay, name, iso_tp_lines(can_id, data[:2] + payload))
+
+
+if __name__ == '__main__':
+    unittest.main()
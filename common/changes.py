@@ -0,0 +1,93 @@
+import fnmatch
+import json
+import logging
+import time
+
+logger = logging.getLogger('pioniq')
+
+
+class ChangeFilter(object):
+    """Reduce MQTT traffic publishing the messages only when their values changed since they were last published.
+
+    Messages with a JSON object payload are compared, per topic, field by field
+    against the last published values. A numeric field changed when it moved
+    beyond its deadband, a dict per field name (fnmatch patterns allowed, i.e.
+    dcBatteryCellVoltage*) with:
+        absolute: max absolute difference ignored.
+        percent:  max difference ignored, as percent of the last published value.
+    Fields without deadband and non numeric fields change on any difference.
+
+    Messages with any changed field are published as built (full and
+    retained), so subscribers always get every field. The always fields (i.e.
+    timestamp) never trigger a publication by themselves and messages without
+    changes are dropped. Every keyframe_interval seconds the message is
+    published anyway, so consumers know the values are still current. Other
+    payloads and not retained messages (events, i.e. the GPS track) are always
+    published.
+    """
+
+    def __init__(self, deadbands=None, keyframe_interval=300, always=('timestamp', 'last_update')):
+        self.deadbands = deadbands or {}
+        self.keyframe_interval = keyframe_interval
+        self.always = set(always)
+        self.published = {}  # last published values per topic
+        self.keyframes = {}  # time of the last keyframe per topic
+        self.bytes_saved = 0
+        self._field_deadbands = {}
+
+    @classmethod
+    def from_config(cls, changes_config):
+        """Create the filter from the 'changes' config section (None when not configured)."""
+        if not changes_config:
+            return None
+        return cls(deadbands=changes_config.get('deadbands'),
+                   keyframe_interval=float(changes_config.get('keyframe_interval', 300)),
+                   always=changes_config.get('always', ('timestamp', 'last_update')))
+
+    def deadband(self, field):
+        if field not in self._field_deadbands:
+            deadband = self.deadbands.get(field)
+            if deadband is None:
+                deadband = next((value for pattern, value in self.deadbands.items()
+                                 if fnmatch.fnmatchcase(field, pattern)), {})
+            self._field_deadbands[field] = deadband
+        return self._field_deadbands[field]
+
+    def changed(self, field, previous, value):
+        numeric = (int, float)
+        if isinstance(value, bool) or not isinstance(value, numeric) or \
+                isinstance(previous, bool) or not isinstance(previous, numeric):
+            return value != previous
+        deadband = self.deadband(field)
+        difference = abs(value - previous)
+        if 'absolute' in deadband and difference <= deadband['absolute']:
+            return False
+        if 'percent' in deadband and difference <= abs(previous) * deadband['percent'] / 100.0:
+            return False
+        return difference > 0
+
+    def filter(self, msgs, now=None):
+        """Return the messages to publish instead of msgs, updating the bytes saved counter."""
+        now = time.monotonic() if now is None else now
+        filtered = []
+        for msg in msgs:
+            try:
+                values = json.loads(msg['payload'])
+            except (TypeError, ValueError):
+                values = None
+            if not isinstance(values, dict) or not msg.get('retain', False):
+                filtered.append(msg)
+                continue
+
+            topic = msg['topic']
+            published = self.published.get(topic)
+            if published is not None and now - self.keyframes[topic] < self.keyframe_interval and \
+                    not any(field not in self.always and (field not in published or self.changed(field, published[field], value))
+                            for field, value in values.items()):
+                self.bytes_saved += len(msg['payload'])
+                continue
+            # Compared against the values published, so slow drifts still add up beyond the deadband
+            self.published[topic] = values
+            self.keyframes[topic] = now
+            filtered.append(msg)
+        return filtered
@@ -0,0 +1,84 @@
+import logging
+import socket
+import struct
+
+from store import backlog_message
+
+logger = logging.getLogger('pioniq')
+
+# Messages are sent as datagrams: qos, retain and topic length followed by the topic and the payload
+_HEADER = struct.Struct('<BBH')
+# Max datagram size (header included) the publisher service receives
+MAX_MESSAGE_SIZE = 65536
+
+
+def pack_message(msg):
+    topic = msg['topic'].encode()
+    payload = msg['payload']
+    if isinstance(payload, str):
+        payload = payload.encode()
+    elif payload is None:
+        payload = b''
+    return _HEADER.pack(msg.get('qos', 0), int(msg.get('retain', False)), len(topic)) + topic + payload
+
+
+def unpack_message(data):
+    qos, retain, topic_length = _HEADER.unpack_from(data)
+    topic_end = _HEADER.size + topic_length
+    return {'topic': data[_HEADER.size:topic_end].decode(),
+            'payload': data[topic_end:],
+            'qos': qos,
+            'retain': bool(retain)}
+
+
+class LocalPublisher(object):
+    """Hand MQTT messages to the local publisher service (publisher/publisher.py) through its Unix socket.
+
+    Sending a datagram doesn't wait for the broker, the publisher service owns
+    the only MQTT connection and publishes the messages as soon as possible.
+    """
+
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.settimeout(timeout)
+
+    def publish(self, msgs):
+        """Send the messages to the publisher service and return the ones that couldn't be sent.
+
+        Messages larger than MAX_MESSAGE_SIZE can never be received whole, so
+        they are dropped (and logged) instead of returned.
+        """
+        for i, msg in enumerate(msgs):
+            data = pack_message(msg)
+            if len(data) > MAX_MESSAGE_SIZE:
+                logger.error("{} message too large for the local publisher ({} bytes, max {}), dropped"
+                             .format(msg['topic'], len(data), MAX_MESSAGE_SIZE))
+                continue
+            try:
+                self.socket.sendto(data, self.path)
+            except (OSError, socket.timeout) as err:
+                logger.error("Local publisher not available at {}: {}".format(self.path, err))
+                return msgs[i:]
+        return []
+
+    def forward_store(self, store, batch_size=100, max_batches=None):
+        """Send up to max_batches batches of stored messages (see backlog_message) removing them once sent. Returns the number sent."""
+        sent = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            batches += 1
+            rows = store.peek(batch_size)
+            if not rows:
+                break
+            failed = self.publish([backlog_message(msg) for _, msg in rows])
+            store.delete([row_id for row_id, _ in rows[:len(rows) - len(failed)]])
+            sent += len(rows) - len(failed)
+            if failed:
+                break
+        if sent > 0:
+            logger.info("{} stored message(s) sent to the local publisher, {} left".format(sent, len(store)))
+        return sent
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,76 @@
+import collections
+import logging
+import math
+import time
+
+logger = logging.getLogger('pioniq')
+
+_FIX_FIELDS = ('time', 'latitude', 'longitude', 'epx', 'epy', 'epv', 'ept', 'eps', 'speed', 'climb', 'track', 'mode', 'received')
+# gpsd TPV report key of each fix field
+_TPV_KEYS = {'time': 'time', 'latitude': 'lat', 'longitude': 'lon', 'epx': 'epx', 'epy': 'epy', 'epv': 'epv',
+             'ept': 'ept', 'eps': 'eps', 'speed': 'speed', 'climb': 'climb', 'track': 'track', 'mode': 'mode'}
+
+
+class Fix(collections.namedtuple('Fix', _FIX_FIELDS)):
+    """Immutable snapshot of a gpsd TPV report, received is the local time it was read.
+
+    Readers always get a whole fix: a new report creates a new Fix instead of
+    updating the fields of the current one. Missing values are NaN (mode 0),
+    as in the gps module.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_report(cls, report, received=None):
+        values = {field: report.get(key, math.nan) for field, key in _TPV_KEYS.items()}
+        values['time'] = report.get('time')
+        values['mode'] = report.get('mode', 0)
+        values['received'] = time.time() if received is None else received
+        return cls(**values)
+
+    @property
+    def accuracy(self):
+        """Horizontal error (meters), NaN when unknown."""
+        if math.isnan(self.epx) or math.isnan(self.epy):
+            return math.nan
+        return max(self.epx, self.epy)
+
+
+def location_info(fix, max_accuracy, previous=None):
+    """Build the location information published to the location topic from a fix.
+
+    previous is the (latitude, longitude) of the previous published location.
+    Returns None when the fix is not accurate enough.
+    """
+    logger.debug("Latitude error (EPY): +/- {} m".format(fix.epy))
+    logger.debug("Longitude error (EPX): +/- {} m".format(fix.epx))
+    fix_accuracy = fix.accuracy
+    logger.info("Location accuracy: +/- {} m".format(fix_accuracy))
+    if fix.mode < 2 or not fix_accuracy < max_accuracy:
+        logger.warning("Location not accurate enought: it's +/- {} m but +/- {} m required".format(fix_accuracy, max_accuracy))
+        return None
+    logger.debug("GPS position fixed with +/- {} m".format(fix_accuracy))
+    location = {
+        'last_update': int(round(time.time())),
+        'state': 'running',
+        'latitude': fix.latitude,
+        'longitude': fix.longitude,
+        'gps_accuracy': fix_accuracy,
+        'eps': fix.eps,  # Estimated Speed error
+        'epx': fix.epx,  # Estimated longitude error
+        'epy': fix.epy,  # Estimated latitude error
+        'epv': fix.epv,  # Estimated altitude error
+        'ept': fix.ept,  # Estimated time error
+        'speed': fix.speed,  # m/s
+        'climb': fix.climb,
+        'track': fix.track,
+        'mode': fix.mode
+    }
+    if previous is not None:
+        # Previous latitude and longitude data is useful to measure distance travelled between updates.
+        location.update({
+            'platitude': previous[0],  # Latitude got from previous read
+            'plongitude': previous[1]  # Longitude got from previous read
+        })
+    return location
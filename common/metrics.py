@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import time
+
+from state import load_state, save_state
+
+logger = logging.getLogger('pioniq')
+
+# Upper bounds (seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics(object):
+    """In-memory counters and histograms, labelled as in Prometheus (i.e. command="BMS_2101").
+
+    Metrics can be exported as a JSON friendly dict (labels values joined with
+    '/' as keys) and in the Prometheus text exposition format, to be written to
+    the node exporter textfile collector folder.
+
+    They can be saved to a file and loaded back, so they keep adding up
+    between runs (i.e. cron) as Prometheus counters must.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}  # name: {labels: value}
+        self.histograms = {}  # name: {labels: [bucket counts..., count, sum, max]}
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = [0] * len(self.buckets) + [0, 0.0, 0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[index] += 1
+        size = len(self.buckets)
+        histogram[size] += 1
+        histogram[size + 1] += value
+        histogram[size + 2] = max(histogram[size + 2], value)
+
+    def load(self, path):
+        """Load the metrics saved to path (nothing when there's no path or file), before adding any."""
+        saved = load_state(path, "metrics", ('since', 'buckets', 'counters', 'histograms'))
+        if saved is None:
+            return
+        self.started = saved['since']
+        for name, series in saved['counters'].items():
+            self.counters[name] = {tuple(tuple(label) for label in labels): value for labels, value in series}
+        # Histograms with other buckets can't be added up, they start again
+        if tuple(saved['buckets']) == self.buckets:
+            for name, series in saved['histograms'].items():
+                self.histograms[name] = {tuple(tuple(label) for label in labels): histogram for labels, histogram in series}
+
+    def save(self, path):
+        try:
+            save_state(path, {'since': self.started,
+                              'buckets': self.buckets,
+                              'counters': {name: list(series.items()) for name, series in self.counters.items()},
+                              'histograms': {name: list(series.items()) for name, series in self.histograms.items()}})
+        except OSError as err:
+            logger.error("Cannot save metrics to {}: {}".format(path, err))
+
+    def as_dict(self):
+        size = len(self.buckets)
+        metrics = {'since': int(self.started)}
+        for name, series in self.counters.items():
+            metrics[name] = {_json_key(key): value for key, value in series.items()}
+        for name, series in self.histograms.items():
+            metrics[name] = {_json_key(key): {'count': histogram[size],
+                                              'sum': round(histogram[size + 1], 4),
+                                              'avg': round(histogram[size + 1] / histogram[size], 4),
+                                              'max': round(histogram[size + 2], 4),
+                                              'buckets': dict(zip([str(bound) for bound in self.buckets], histogram[:size]))}
+                             for key, histogram in series.items()}
+        return metrics
+
+    def prometheus(self, prefix='pioniq_'):
+        size = len(self.buckets)
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            lines.append("# TYPE {}{} counter".format(prefix, name))
+            for key, value in sorted(series.items()):
+                lines.append("{}{}{} {}".format(prefix, name, _labels(key), value))
+        for name, series in sorted(self.histograms.items()):
+            lines.append("# TYPE {}{} histogram".format(prefix, name))
+            for key, histogram in sorted(series.items()):
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append("{}{}_bucket{} {}".format(prefix, name, _labels(key + (('le', str(bound)),)), count))
+                lines.append("{}{}_bucket{} {}".format(prefix, name, _labels(key + (('le', '+Inf'),)), histogram[size]))
+                lines.append("{}{}_sum{} {}".format(prefix, name, _labels(key), histogram[size + 1]))
+                lines.append("{}{}_count{} {}".format(prefix, name, _labels(key), histogram[size]))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write the Prometheus metrics atomically, so the collector never reads a partial file."""
+        temporary_path = path + '.tmp'
+        try:
+            with open(temporary_path, 'w') as textfile:
+                textfile.write(self.prometheus())
+            os.replace(temporary_path, path)
+        except OSError as err:
+            logger.error("Cannot write metrics to {}: {}".format(path, err))
+
+    def message(self, topic):
+        """Build the MQTT message with the metrics."""
+        return {'topic': topic,
+                'payload': json.dumps(self.as_dict()),
+                'qos': 0,
+                'retain': True}
+
+
+def _json_key(labels):
+    return "/".join(str(value) for _, value in labels) or "total"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + "}"
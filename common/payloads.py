@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+
+"""Compact binary MQTT payloads.
+
+Consumers only need this file (standard library only) to read the payloads:
+
+    from payloads import decode
+    values = decode(msg.payload)  # JSON payloads are decoded too
+
+A binary payload is a header followed by one or more records (a batch):
+    magic (1 byte, 'P'), schema id (1 byte), schema version (1 byte),
+    flags (1 byte, bit 0: body compressed with zlib), number of records (2 bytes)
+All values are little-endian. Each record starts with a bitmap telling which
+fields of the schema are present (so partial messages can be encoded) followed
+by the present fields packed in schema order. Numeric fields with scale are
+sent as round(value * scale). Strings are padded with NUL bytes.
+
+Schemas are never changed once published: adding or changing fields means
+adding a new version with the same id, so old payloads can still be decoded.
+"""
+
+import argparse
+import json
+import logging
+import random
+import struct
+import time
+import zlib
+
+logger = logging.getLogger('pioniq')
+
+MAGIC = 0x50  # 'P', JSON payloads start with '{'
+FLAG_ZLIB = 0x01
+_HEADER = struct.Struct('<BBBBH')
+
+ENCODINGS = ('json', 'binary', 'binary-zlib')
+
+
+def _limits(fmt):
+    """Range of the integer struct formats (None for the rest)."""
+    if fmt not in ('b', 'B', 'h', 'H', 'i', 'I', 'q', 'Q'):
+        return None
+    bits = struct.calcsize(fmt) * 8
+    if fmt.islower():
+        return -2 ** (bits - 1), 2 ** (bits - 1) - 1
+    return 0, 2 ** bits - 1
+
+
+class Schema(object):
+    """Fixed field order of a topic: fields are (name, struct format, scale) tuples.
+
+    Values are decoded as raw / scale when scale is set, otherwise as the raw
+    value (int for integer formats, str for strings).
+    """
+
+    def __init__(self, name, schema_id, version, fields):
+        self.name = name
+        self.id = schema_id
+        self.version = version
+        self.fields = tuple(fields)
+        self.index = {field[0]: i for i, field in enumerate(self.fields)}
+        self.bitmap_size = (len(self.fields) + 7) // 8
+        self.limits = tuple(_limits(field[1]) for field in self.fields)
+        self._structs = {}  # struct per bitmap of present fields
+
+    def _struct(self, bitmap):
+        record_struct = self._structs.get(bitmap)
+        if record_struct is None:
+            fmt = '<' + ''.join(self.fields[i][1] for i in range(len(self.fields)) if bitmap >> i & 1)
+            record_struct = self._structs[bitmap] = struct.Struct(fmt)
+        return record_struct
+
+    def fit(self, values):
+        """Return the values that can be encoded and the names of the ones left out.
+
+        Fields not in the schema, values of the wrong type and numbers out of
+        the range of their format once scaled (i.e. a speed decoded from a
+        corrupted frame) are left out.
+        """
+        fitted = {}
+        left_out = []
+        for name, value in values.items():
+            i = self.index.get(name)
+            if i is None:
+                left_out.append(name)
+                continue
+            if value is not None:
+                _, fmt, scale = self.fields[i]
+                limits = self.limits[i]
+                if fmt[-1] == 's':
+                    valid = isinstance(value, str) and all(ord(char) < 256 for char in value)
+                elif not isinstance(value, (int, float)):
+                    valid = False
+                elif limits is None:
+                    valid = abs(value) <= 3.4e38  # float range
+                else:
+                    try:
+                        raw = int(round(value * scale)) if scale is not None else value
+                    except (ValueError, OverflowError):
+                        raw = None  # NaN or infinite
+                    valid = isinstance(raw, int) and limits[0] <= raw <= limits[1]
+                if not valid:
+                    left_out.append(name)
+                    continue
+            fitted[name] = value
+        return fitted, left_out
+
+    def encode_record(self, values):
+        bitmap = 0
+        found = 0
+        packed = []
+        for i, (name, fmt, scale) in enumerate(self.fields):
+            if name not in values:
+                continue
+            found += 1
+            value = values[name]
+            if value is None:
+                continue
+            bitmap |= 1 << i
+            if scale is not None:
+                value = int(round(value * scale))
+            elif fmt[-1] == 's':
+                value = value.encode('latin-1')
+            packed.append(value)
+        if found != len(values):
+            unknown = [name for name in values if name not in self.index]
+            raise ValueError("Field(s) {} not in {} schema version {}".format(", ".join(unknown), self.name, self.version))
+        return bitmap.to_bytes(self.bitmap_size, 'little') + self._struct(bitmap).pack(*packed)
+
+    def decode_record(self, data, offset):
+        """Return the record starting at offset and the offset of the next one."""
+        bitmap = int.from_bytes(data[offset:offset + self.bitmap_size], 'little')
+        offset += self.bitmap_size
+        record_struct = self._struct(bitmap)
+        raw_values = iter(record_struct.unpack_from(data, offset))
+        values = {}
+        for i, (name, fmt, scale) in enumerate(self.fields):
+            if bitmap >> i & 1:
+                value = next(raw_values)
+                if scale is not None:
+                    value = value / scale
+                elif fmt[-1] == 's':
+                    value = value.rstrip(b'\0').decode('latin-1')
+                values[name] = value
+        return values, offset + record_struct.size
+
+
+_MODULE_TEMPS = [('dcBatteryModuleTemp{:02d}'.format(i), 'b', None) for i in range(1, 13)]
+_CELL_VOLTAGES = [('dcBatteryCellVoltage{:02d}'.format(i), 'B', 50) for i in range(1, 97)]  # Packed byte array
+_TIRES = [('tire_{}_{}'.format(tire, value), fmt, scale)
+          for tire in ('fl', 'fr', 'bl', 'br')
+          for value, fmt, scale in (('pressure', 'B', 10), ('temperature', 'b', None))]
+
+SCHEMAS = [
+    Schema('battery', 1, 1, [
+        ('timestamp', 'I', None),
+        ('minsToCompleteCharge', 'H', None),
+        ('socBms', 'B', 2),
+        ('bmsIgnition', 'B', None),
+        ('bmsMainRelay', 'B', None),
+        ('auxBatteryVoltage', 'B', 10),
+        ('charging', 'B', None),
+        ('normalChargePort', 'B', None),
+        ('rapidChargePort', 'B', None),
+        ('fanStatus', 'B', None),
+        ('fanFeedback', 'B', None),
+        ('cumulativeEnergyCharged', 'I', 10),
+        ('cumulativeEnergyDischarged', 'I', 10),
+        ('cumulativeChargeCurrent', 'I', 10),
+        ('cumulativeDischargeCurrent', 'I', 10),
+        ('cumulativeOperatingTime', 'I', None),
+        ('availableChargePower', 'H', 100),
+        ('availableDischargePower', 'H', 100),
+        ('dcBatteryInletTemperature', 'b', None),
+        ('dcBatteryMaxTemperature', 'b', None),
+        ('dcBatteryMinTemperature', 'b', None),
+        ('dcBatteryCellMaxVoltage', 'B', 50),
+        ('dcBatteryCellNoMaxVoltage', 'B', None),
+        ('dcBatteryCellMinVoltage', 'B', 50),
+        ('dcBatteryCellNoMinVoltage', 'B', None),
+        ('dcBatteryCurrent', 'h', 10),
+        ('dcBatteryPower', 'i', 1000),
+        ('dcBatteryVoltage', 'H', 10),
+        ('driveMotorSpeed', 'h', None),
+        ('soh', 'H', 10),
+        ('dcBatteryCellMaxDeterioration', 'H', 10),
+        ('dcBatteryCellMinDeterioration', 'H', 10),
+        ('socDisplay', 'B', None),
+        ('dcBatteryCellVoltageDeviation', 'B', 50),
+        ('dcBatteryHeater1Temperature', 'B', 1.0),
+        ('dcBatteryHeater2Temperature', 'B', 1.0),
+        ('dcBatteryCellNoMaxDeterioration', 'B', None),
+        ('dcBatteryCellNoMinDeterioration', 'B', None),
+        ('dcBatteryAvgTemperature', 'h', 10),
+    ] + _MODULE_TEMPS + _CELL_VOLTAGES),
+    Schema('vmcu', 2, 1, [
+        ('timestamp', 'I', None),
+        ('vin', '17s', None),
+        ('gear', '4s', None),
+        ('speed', 'H', 100),
+        ('accel_pedal_depth', 'B', 2),
+        ('brake_lamp', 'B', None),
+        ('brakes_on', 'B', None),
+    ]),
+    Schema('tpms', 3, 1, [('timestamp', 'I', None)] + _TIRES),
+    Schema('location', 4, 1, [
+        ('last_update', 'I', None),
+        ('state', '8s', None),
+        ('latitude', 'd', None),
+        ('longitude', 'd', None),
+        ('gps_accuracy', 'f', None),
+        ('eps', 'f', None),
+        ('epx', 'f', None),
+        ('epy', 'f', None),
+        ('epv', 'f', None),
+        ('ept', 'f', None),
+        ('speed', 'f', None),
+        ('climb', 'f', None),
+        ('track', 'f', None),
+        ('mode', 'B', None),
+        ('platitude', 'd', None),
+        ('plongitude', 'd', None),
+    ]),
+]
+
+# Latest version per topic name, used to encode
+SCHEMAS_BY_NAME = {}
+# Every version, used to decode
+SCHEMAS_BY_ID = {}
+for _schema in SCHEMAS:
+    if _schema.name not in SCHEMAS_BY_NAME or _schema.version > SCHEMAS_BY_NAME[_schema.name].version:
+        SCHEMAS_BY_NAME[_schema.name] = _schema
+    SCHEMAS_BY_ID[(_schema.id, _schema.version)] = _schema
+
+
+def encode(name, records, compress=False):
+    """Encode a record (dict) or a batch of records (list of dicts) of the named schema."""
+    schema = SCHEMAS_BY_NAME[name]
+    if isinstance(records, dict):
+        records = [records]
+    body = b''.join(schema.encode_record(record) for record in records)
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 9)
+        flags |= FLAG_ZLIB
+    return _HEADER.pack(MAGIC, schema.id, schema.version, flags, len(records)) + body
+
+
+def decode_batch(payload):
+    """Decode a binary or JSON payload into a list of records."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if not payload or payload[0] != MAGIC:
+        values = json.loads(payload.decode())
+        return values if isinstance(values, list) else [values]
+    magic, schema_id, version, flags, count = _HEADER.unpack_from(payload)
+    schema = SCHEMAS_BY_ID.get((schema_id, version))
+    if schema is None:
+        raise ValueError("Unknown payload schema {} version {}".format(schema_id, version))
+    body = payload[_HEADER.size:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    records = []
+    offset = 0
+    for _ in range(count):
+        record, offset = schema.decode_record(body, offset)
+        records.append(record)
+    return records
+
+
+def decode(payload):
+    """Decode a binary or JSON payload holding a single record."""
+    records = decode_batch(payload)
+    if len(records) != 1:
+        raise ValueError("Payload holds {} records, use decode_batch".format(len(records)))
+    return records[0]
+
+
+class PayloadEncoder(object):
+    """Encode the MQTT messages of each topic as configured.
+
+    encodings maps topic names (without prefix) to 'json' (default), 'binary'
+    or 'binary-zlib'. A topic never mixes formats: values that can't be
+    encoded (see Schema.fit) are left out of the binary record (consumers get
+    them as missing) and a message that can't be encoded at all is dropped.
+    """
+
+    def __init__(self, encodings, topic_prefix):
+        for name, encoding in encodings.items():
+            if encoding not in ENCODINGS:
+                raise ValueError("Unknown encoding {} for {}, use one of: {}".format(encoding, name, ", ".join(ENCODINGS)))
+            if encoding != 'json' and name not in SCHEMAS_BY_NAME:
+                raise ValueError("No binary schema for {}".format(name))
+        self.encodings = encodings
+        self.topic_prefix = topic_prefix
+
+    @classmethod
+    def from_config(cls, encoding_config, topic_prefix):
+        """Create the encoder from the 'encoding' config section (None when not configured)."""
+        if not encoding_config:
+            return None
+        return cls(encoding_config, topic_prefix)
+
+    def encode(self, msgs):
+        encoded = []
+        for msg in msgs:
+            name = msg['topic'][len(self.topic_prefix):]
+            encoding = self.encodings.get(name, 'json')
+            if encoding != 'json':
+                schema = SCHEMAS_BY_NAME[name]
+                try:
+                    values = json.loads(msg['payload'])
+                    records = []
+                    for record in (values if isinstance(values, list) else [values]):
+                        record, left_out = schema.fit(record)
+                        if left_out:
+                            logger.warning("{} field(s) left out of the {} message (not in the schema or out of range): {}"
+                                           .format(len(left_out), name, ", ".join(sorted(left_out))))
+                        records.append(record)
+                    msg = dict(msg, payload=encode(name, records, encoding == 'binary-zlib'))
+                except (ValueError, TypeError, AttributeError, struct.error) as err:
+                    logger.error("Cannot encode {} message as {}, dropped: {}".format(name, encoding, err))
+                    continue
+            encoded.append(msg)
+        return encoded
+
+
+def sample_record(schema, seed=0):
+    """Record with valid random values for every field of the schema."""
+    rng = random.Random(seed)
+    record = {}
+    for name, fmt, scale in schema.fields:
+        if fmt.endswith('s'):
+            record[name] = ''.join(rng.choice('ABCDEFGHJKLMNPRSTUVWXYZ0123456789') for _ in range(int(fmt[:-1])))
+        elif fmt in 'fd':
+            value = rng.uniform(-180, 180)
+            record[name] = struct.unpack('<f', struct.pack('<f', value))[0] if fmt == 'f' else value
+        else:
+            bits = struct.calcsize(fmt) * 8 - (1 if fmt.islower() else 0)
+            raw = rng.randrange(0, min(2 ** bits, 100000))
+            record[name] = raw / scale if scale is not None else raw
+    return record
+
+
+def measure(repeat=1000, batch_size=10):
+    """Payload size (bytes) and encode time (microseconds) per schema and format."""
+    results = []
+    for schema in SCHEMAS_BY_NAME.values():
+        records = [sample_record(schema, seed) for seed in range(batch_size)]
+        formats = [
+            ('json', lambda: json.dumps(records[0])),
+            ('binary', lambda: encode(schema.name, records[0])),
+            ('binary-zlib', lambda: encode(schema.name, records[0], compress=True)),
+            ('json batch x{}'.format(batch_size), lambda: json.dumps(records)),
+            ('binary-zlib batch x{}'.format(batch_size), lambda: encode(schema.name, records, compress=True)),
+        ]
+        for name, encoder in formats:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                payload = encoder()
+            elapsed = (time.perf_counter() - start) / repeat * 1e6
+            assert decode_batch(payload) is not None
+            results.append((schema.name, name, len(payload), elapsed))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the size and encode time of the MQTT payload formats.")
+    parser.add_argument('--repeat', type=int, default=1000, help="encodings per measure")
+    parser.add_argument('--batch', type=int, default=10, help="records per batch")
+    args = parser.parse_args()
+    print("{:<10} {:<24} {:>8} {:>12}".format("topic", "format", "bytes", "encode (us)"))
+    for topic, fmt, size, elapsed in measure(args.repeat, args.batch):
+        print("{:<10} {:<24} {:>8} {:>12.1f}".format(topic, fmt, size, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger('pioniq')
+
+
+def state_path(path, base_dir):
+    """Path of a state file set in a config section (None when not set), relative paths are relative to base_dir."""
+    return os.path.join(base_dir, path) if path else None
+
+
+def load_state(path, description, keys=()):
+    """Load a JSON state file, None when there isn't one or it can't be read (i.e. missing any of keys)."""
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as state_file:
+            state = json.load(state_file)
+        missing = [key for key in keys if key not in state]
+        if missing:
+            raise KeyError(", ".join(missing))
+        return state
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        logger.warning("Could not load {} from {}: {}".format(description, path, err))
+        return None
+
+
+def save_state(path, state, **dump_options):
+    """Save a JSON state file (json.dump options, i.e. indent, can be given)."""
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w') as state_file:
+        json.dump(state, state_file, **dump_options)
+    # Replace the file at once, so it's never read half written
+    os.replace(temp_path, path)
@@ -0,0 +1,141 @@
+import logging
+import os
+import sqlite3
+import time
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger('pioniq')
+
+# Backlog published per polling cycle (batches and seconds to wait for their acknowledgement), so it never stalls the polling
+STORE_CYCLE_BATCHES = 1
+STORE_CYCLE_TIMEOUT = 5
+
+# Stored messages are republished to the backlog topic of their topic (i.e. car/battery/backlog)
+BACKLOG_SUFFIX = "/backlog"
+
+
+def backlog_message(msg):
+    """Stored message as it's republished: on its backlog topic, QoS 1 and not retained.
+
+    Subscribers of the live topics don't get the stored readings as if they
+    were the current state, the ones keeping the history subscribe to the
+    backlog topics too.
+    """
+    topic = msg['topic']
+    if not topic.endswith(BACKLOG_SUFFIX):
+        topic += BACKLOG_SUFFIX
+    return dict(msg, topic=topic, qos=1, retain=False)
+
+
+class MessageStore(object):
+    """Durable and bounded queue (SQLite) of the MQTT messages that couldn't be published.
+
+    Messages are kept as they were built, so their payloads keep the original
+    timestamps. When the queue is full the oldest messages are evicted first.
+
+    The number of stored messages is counted once when opening and then kept
+    up to date by put and delete, so len() (checked after every message by the
+    publishing loops) doesn't query the database. Each store file must only
+    be used by one process.
+    """
+
+    def __init__(self, path, max_messages=100000):
+        self.path = path
+        self.max_messages = max_messages
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "queued REAL NOT NULL, "
+                        "topic TEXT NOT NULL, "
+                        "payload BLOB, "
+                        "qos INTEGER NOT NULL, "
+                        "retain INTEGER NOT NULL)")
+        self.count = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def put(self, msgs):
+        """Append messages (dicts with topic, payload, qos and retain) to the queue."""
+        queued = time.time()
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT INTO messages (queued, topic, payload, qos, retain) VALUES (?, ?, ?, ?, ?)",
+                                [(queued, msg['topic'], msg['payload'], msg.get('qos', 0), int(msg.get('retain', False)))
+                                 for msg in msgs])
+            evicted = self.db.execute("DELETE FROM messages WHERE id <= (SELECT MAX(id) FROM messages) - ?",
+                                      (self.max_messages,)).rowcount
+        self.count += len(msgs) - evicted
+        if evicted > 0:
+            logger.warning("Message store full, {} oldest message(s) evicted".format(evicted))
+        logger.info("{} message(s) stored to be published later".format(len(msgs)))
+
+    def peek(self, limit):
+        """Return up to limit (id, message) pairs, oldest first, without removing them."""
+        rows = self.db.execute("SELECT id, topic, payload, qos, retain FROM messages ORDER BY id LIMIT ?", (limit,))
+        return [(row_id, {'topic': topic, 'payload': payload, 'qos': qos, 'retain': bool(retain)})
+                for row_id, topic, payload, qos, retain in rows]
+
+    def delete(self, ids):
+        with self.db:
+            self.db.execute("BEGIN")
+            deleted = self.db.executemany("DELETE FROM messages WHERE id = ?", [(row_id,) for row_id in ids]).rowcount
+        self.count -= max(deleted, 0)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.db.close()
+
+
+def drain_store(mqtt_client, store, batch_size=100, timeout=30, max_batches=None, deadline=None):
+    """Publish the stored messages oldest first (see backlog_message), removing them once acknowledged by the broker.
+
+    Messages are sent in batches of pipelined QoS 1 publishes (up to batch_size
+    in flight) instead of waiting for each acknowledgement. Up to max_batches
+    batches are published (all of them when None), so polling loops only
+    spend a bounded time on the backlog per cycle. When a deadline (monotonic
+    time) is given, no batch is started nor waited for past it, so a run
+    that's killed at a fixed time (i.e. cron) is done before.
+    Returns the number of messages published.
+    """
+    mqtt_client.max_inflight_messages_set(batch_size)
+    published = 0
+    batches = 0
+    while mqtt_client.is_connected() and (max_batches is None or batches < max_batches):
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        batches += 1
+        rows = store.peek(batch_size)
+        if not rows:
+            break
+        results = []
+        for row_id, msg in rows:
+            msg = backlog_message(msg)
+            results.append((row_id, mqtt_client.publish(topic=msg['topic'], payload=msg['payload'], qos=1, retain=False)))
+        batch_deadline = time.monotonic() + timeout if deadline is None else min(time.monotonic() + timeout, deadline)
+        acknowledged = []
+        for row_id, result in results:
+            while result.rc == mqtt.MQTT_ERR_SUCCESS and not result.is_published() and time.monotonic() < batch_deadline:
+                time.sleep(0.01)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS or not result.is_published():
+                break
+            acknowledged.append(row_id)
+        store.delete(acknowledged)
+        published += len(acknowledged)
+        if len(acknowledged) < len(rows):
+            logger.warning("Broker didn't acknowledge all stored messages, will retry later")
+            break
+    if published > 0:
+        logger.info("{} stored message(s) published, {} left".format(published, len(store)))
+    return published
+
+
+def open_store(store_config, base_dir):
+    """Open the message store configured in the 'store' config section (None when not configured).
+
+    Relative paths are relative to base_dir.
+    """
+    if not store_config:
+        return None
+    return MessageStore(os.path.join(base_dir, store_config['path']),
+                        int(store_config.get('max_messages', 100000)))
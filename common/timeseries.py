@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import mmap
+import os
+import struct
+import time
+
+logger = logging.getLogger('pioniq')
+
+MAGIC = b'PIONIQTS'
+VERSION = 1
+# magic, version, capacity (records), head (records ever appended)
+_HEADER = struct.Struct('<8sIIQ')
+_HEAD_OFFSET = 16
+_HEAD = struct.Struct('<Q')
+# time (epoch seconds), series id, value
+_RECORD = struct.Struct('<dHd')
+NAME_SIZE = 64
+MAX_SERIES = 1024
+_NAMES_OFFSET = 64
+_RECORDS_OFFSET = _NAMES_OFFSET + NAME_SIZE * MAX_SERIES
+
+AGGREGATES = {
+    'mean': lambda values: sum(values) / len(values),
+    'min': min,
+    'max': max,
+    'last': lambda values: values[-1],
+}
+
+
+class TimeSeries(object):
+    """Fixed-size ring buffer of timestamped samples in a memory-mapped file.
+
+    Each sample is a (time, series, value) record. Series are named (i.e.
+    battery.socBms) and up to MAX_SERIES names are stored in the file, so other
+    processes can query it (open with readonly=True). Appending is O(1) and
+    overwrites the oldest sample once capacity samples are stored. Samples must
+    be appended in time order, queries use it to find the window start by
+    binary search.
+
+    The file size is fixed (capacity * 18 bytes plus 64 KB), so is the memory
+    used. Place it in a tmpfs (i.e. /dev/shm) to avoid any SD card write, or in
+    the SD card to keep the history between reboots: the kernel writes the
+    dirty pages back periodically, so each page is written once per writeback
+    period instead of once per sample.
+    """
+
+    def __init__(self, path, capacity=20000, readonly=False, heartbeat=60):
+        self.path = path
+        self.readonly = readonly
+        self.heartbeat = heartbeat
+        self.last = {}  # (time, value) last appended per series id
+        if readonly:
+            self.file = open(path, 'rb')
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.file = self._open(path, capacity)
+            self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, version, self.capacity, self.head = _HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a time series file (version {})".format(path, VERSION))
+        self.ids = {}
+        self.names = []
+        self._load_names()
+        if not readonly:
+            self._load_last()
+
+    @staticmethod
+    def _open(path, capacity):
+        size = _RECORDS_OFFSET + capacity * _RECORD.size
+        if os.path.exists(path):
+            time_series_file = open(path, 'r+b')
+            header = time_series_file.read(_HEADER.size)
+            if len(header) == _HEADER.size:
+                magic, version, file_capacity, _ = _HEADER.unpack(header)
+                if magic == MAGIC and version == VERSION and file_capacity == capacity:
+                    return time_series_file
+            logger.warning("Time series file {} has a different format or capacity, creating it again".format(path))
+            time_series_file.close()
+        time_series_file = open(path, 'w+b')
+        time_series_file.truncate(size)
+        time_series_file.write(_HEADER.pack(MAGIC, VERSION, capacity, 0))
+        time_series_file.flush()
+        return time_series_file
+
+    def _load_names(self):
+        for series_id in range(len(self.names), MAX_SERIES):
+            offset = _NAMES_OFFSET + series_id * NAME_SIZE
+            name = self.mm[offset:offset + NAME_SIZE].rstrip(b'\0')
+            if not name:
+                break
+            self.names.append(name.decode())
+            self.ids[self.names[-1]] = series_id
+
+    def _load_last(self):
+        """Rebuild the last samples from the tail of the buffer, so unchanged values are skipped across runs (i.e. cron).
+
+        Only the samples of the last heartbeat seconds matter, older ones are
+        appended again anyway.
+        """
+        for timestamp, series_id, value in self._records(time.time() - self.heartbeat):
+            self.last[series_id] = (timestamp, value)
+
+    def series_id(self, name):
+        """Id of the series name, registering it when it's new (None when the name table is full)."""
+        series_id = self.ids.get(name)
+        if series_id is None and not self.readonly:
+            if len(self.names) == MAX_SERIES:
+                return None
+            series_id = len(self.names)
+            offset = _NAMES_OFFSET + series_id * NAME_SIZE
+            self.mm[offset:offset + NAME_SIZE] = name.encode()[:NAME_SIZE].ljust(NAME_SIZE, b'\0')
+            self.names.append(name)
+            self.ids[name] = series_id
+        return series_id
+
+    def append(self, name, value, timestamp=None):
+        series_id = self.series_id(name)
+        if series_id is None:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        _RECORD.pack_into(self.mm, _RECORDS_OFFSET + (self.head % self.capacity) * _RECORD.size,
+                          timestamp, series_id, value)
+        self.head += 1
+        _HEAD.pack_into(self.mm, _HEAD_OFFSET, self.head)
+        self.last[series_id] = (timestamp, value)
+
+    def append_values(self, prefix, values, timestamp=None, exclude=('timestamp', 'last_update')):
+        """Append the numeric values of a dict (but the exclude keys) as prefix.key series.
+
+        A value equal to the last one appended to its series is skipped unless
+        heartbeat seconds have passed, so unchanged (i.e. cached) values don't
+        fill the buffer.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        for key, value in values.items():
+            if key in exclude:
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            elif not isinstance(value, (int, float)):
+                continue
+            name = prefix + '.' + key
+            last = self.last.get(self.ids.get(name))
+            if last is not None and last[1] == value and timestamp - last[0] < self.heartbeat:
+                continue
+            self.append(name, value, timestamp)
+
+    def __len__(self):
+        return min(self.head, self.capacity)
+
+    def _time_at(self, first, index):
+        offset = _RECORDS_OFFSET + ((first + index) % self.capacity) * _RECORD.size
+        return _RECORD.unpack_from(self.mm, offset)[0]
+
+    def _records(self, start=None):
+        """Iterate over the (time, series id, value) records from the first one at or after start.
+
+        The first record is found by binary search, which assumes records are in
+        time order (as appended). After the clock stepped backwards (i.e. set by
+        NTP) the order is broken and the window start may be wrong, skipping or
+        including samples, until the records before the step are overwritten.
+        """
+        self.head = _HEAD.unpack_from(self.mm, _HEAD_OFFSET)[0]
+        count = len(self)
+        first = self.head - count
+        low = 0
+        if start is not None:
+            high = count
+            while low < high:
+                middle = (low + high) // 2
+                if self._time_at(first, middle) < start:
+                    low = middle + 1
+                else:
+                    high = middle
+        begin = (first + low) % self.capacity
+        end = begin + count - low
+        # At most two contiguous chunks when the buffer wraps around
+        chunks = [(begin, min(end, self.capacity)), (0, max(0, end - self.capacity))]
+        for chunk_start, chunk_end in chunks:
+            if chunk_end > chunk_start:
+                view = memoryview(self.mm)[_RECORDS_OFFSET + chunk_start * _RECORD.size:
+                                           _RECORDS_OFFSET + chunk_end * _RECORD.size]
+                try:
+                    for record in _RECORD.iter_unpack(view):
+                        yield record
+                finally:
+                    view.release()
+
+    def series(self):
+        self._load_names()
+        return list(self.names)
+
+    def query(self, name, start=None, end=None):
+        """Return the (time, value) samples of the series in the time window."""
+        self._load_names()
+        series_id = self.ids.get(name)
+        if series_id is None:
+            return []
+        samples = []
+        for timestamp, record_id, value in self._records(start):
+            if end is not None and timestamp > end:
+                break
+            if record_id == series_id:
+                samples.append((timestamp, value))
+        return samples
+
+    def query_many(self, names, start=None, end=None):
+        """Return the (time, index in names, value) samples of several series in the time window, in one pass."""
+        self._load_names()
+        indexes = {self.ids[name]: index for index, name in enumerate(names) if name in self.ids}
+        samples = []
+        if not indexes:
+            return samples
+        for timestamp, record_id, value in self._records(start):
+            if end is not None and timestamp > end:
+                break
+            index = indexes.get(record_id)
+            if index is not None:
+                samples.append((timestamp, index, value))
+        return samples
+
+    def downsample(self, name, start, end, step, aggregate='mean'):
+        """Return (bucket start, aggregated value) for each step seconds bucket with samples."""
+        function = AGGREGATES[aggregate]
+        buckets = []
+        bucket = None
+        values = []
+        for timestamp, value in self.query(name, start, end):
+            sample_bucket = start + (timestamp - start) // step * step
+            if sample_bucket != bucket:
+                if values:
+                    buckets.append((bucket, function(values)))
+                bucket = sample_bucket
+                values = []
+            values.append(value)
+        if values:
+            buckets.append((bucket, function(values)))
+        return buckets
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+def open_time_series(time_series_config, base_dir):
+    """Open the time series configured in the 'timeseries' config section (None when not configured).
+
+    Relative paths are relative to base_dir.
+    """
+    if not time_series_config:
+        return None
+    return TimeSeries(os.path.join(base_dir, time_series_config['path']),
+                      capacity=int(time_series_config.get('capacity', 20000)),
+                      heartbeat=float(time_series_config.get('heartbeat', 60)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query a time series file written by the data scripts.")
+    parser.add_argument('path', help="time series file")
+    parser.add_argument('series', nargs='?', help="series name (i.e. battery.socBms), list the series if not set")
+    parser.add_argument('--last', type=float, default=3600, help="seconds of history to show")
+    parser.add_argument('--step', type=float, help="downsample to one value every STEP seconds")
+    parser.add_argument('--aggregate', choices=sorted(AGGREGATES), default='mean', help="downsampling function")
+    args = parser.parse_args()
+
+    time_series = TimeSeries(args.path, readonly=True)
+    try:
+        if not args.series:
+            for name in time_series.series():
+                print(name)
+            return
+        end = time.time()
+        start = end - args.last
+        if args.step:
+            samples = time_series.downsample(args.series, start, end, args.step, args.aggregate)
+        else:
+            samples = time_series.query(args.series, start, end)
+        for timestamp, value in samples:
+            print("{} {}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)), value))
+    finally:
+        time_series.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import json
+import logging
+import math
+import time
+
+logger = logging.getLogger('pioniq')
+
+EARTH_RADIUS = 6371008.8  # meters
+
+
+def distance(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance in meters (haversine)."""
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def heading_change(track1, track2):
+    """Absolute difference between two headings in degrees (0 - 180)."""
+    return abs((track2 - track1 + 180) % 360 - 180)
+
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of (time, latitude, longitude) points.
+
+    Returns the points to keep (first and last included): every dropped point
+    is less than tolerance meters away from the simplified track. Distances
+    are measured in a local equirectangular projection, accurate enough for
+    the few kilometers of a track.
+    """
+    if len(points) < 3:
+        return list(points)
+    scale_x = math.radians(1) * EARTH_RADIUS * math.cos(math.radians(points[0][1]))
+    scale_y = math.radians(1) * EARTH_RADIUS
+    xy = [(point[2] * scale_x, point[1] * scale_y) for point in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    # Iterative, so long tracks don't hit the recursion limit
+    segments = [(0, len(points) - 1)]
+    while segments:
+        first, last = segments.pop()
+        ax, ay = xy[first]
+        dx = xy[last][0] - ax
+        dy = xy[last][1] - ay
+        length = dx * dx + dy * dy
+        farthest = None
+        max_distance = tolerance
+        for index in range(first + 1, last):
+            px = xy[index][0] - ax
+            py = xy[index][1] - ay
+            # Distance to the segment (not the line), so going back and forth isn't dropped
+            t = 0 if length == 0 else min(1, max(0, (px * dx + py * dy) / length))
+            point_distance = math.hypot(px - t * dx, py - t * dy)
+            if point_distance > max_distance:
+                farthest = index
+                max_distance = point_distance
+        if farthest is not None:
+            keep[farthest] = True
+            segments.append((first, farthest))
+            segments.append((farthest, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+class AdaptiveTracker(object):
+    """Decide when to publish the location depending on the movement and batch the track.
+
+    Location is published:
+        - every max_interval seconds when stationary (speed below stationary_speed)
+        - when moving, every distance meters travelled (at the current speed),
+          but not more often than min_interval seconds nor less than max_interval
+        - as soon as the heading changes more than heading_change degrees
+
+    Accurate fixes are buffered (when more than tolerance meters away from the
+    previous one) and, every track_interval seconds or max_points points, the
+    buffer is simplified with Douglas-Peucker (tolerance meters) and published
+    as a batch to the track topic.
+    """
+
+    def __init__(self, min_interval=5, max_interval=300, distance=250, heading_change=30, stationary_speed=1.0,
+                 tolerance=10, track_interval=60, max_points=500):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.distance = distance
+        self.heading_change = heading_change
+        self.stationary_speed = stationary_speed
+        self.tolerance = tolerance
+        self.track_interval = track_interval
+        self.max_points = max_points
+        self.points = []  # (time, latitude, longitude)
+        self.last_published = None  # (time, fix)
+
+    @classmethod
+    def from_config(cls, tracking_config):
+        """Create the tracker from the 'tracking' config section (None when not configured)."""
+        if not tracking_config:
+            return None
+        return cls(min_interval=float(tracking_config.get('min_interval', 5)),
+                   max_interval=float(tracking_config.get('max_interval', 300)),
+                   distance=float(tracking_config.get('distance', 250)),
+                   heading_change=float(tracking_config.get('heading_change', 30)),
+                   stationary_speed=float(tracking_config.get('stationary_speed', 1.0)),
+                   tolerance=float(tracking_config.get('tolerance', 10)),
+                   track_interval=float(tracking_config.get('track_interval', 60)),
+                   max_points=int(tracking_config.get('max_points', 500)))
+
+    def moving(self, fix):
+        return not math.isnan(fix.speed) and fix.speed >= self.stationary_speed
+
+    def add(self, fix):
+        """Buffer the position of an accurate fix for the next track."""
+        if self.points:
+            _, latitude, longitude = self.points[-1]
+            if distance(latitude, longitude, fix.latitude, fix.longitude) <= self.tolerance:
+                return
+        self.points.append((fix.received, fix.latitude, fix.longitude))
+
+    def location_due(self, fix, now=None):
+        """Whether the location must be published for this fix."""
+        if self.last_published is None:
+            return True
+        now = time.time() if now is None else now
+        published_time, published_fix = self.last_published
+        elapsed = now - published_time
+        if elapsed < self.min_interval:
+            return False
+        if not self.moving(fix):
+            return elapsed >= self.max_interval
+        if not math.isnan(fix.track) and not math.isnan(published_fix.track) \
+                and heading_change(published_fix.track, fix.track) >= self.heading_change:
+            return True
+        return elapsed >= min(self.max_interval, max(self.min_interval, self.distance / fix.speed))
+
+    def published(self, fix, now=None):
+        """Record that the location of the fix has been published."""
+        self.last_published = (time.time() if now is None else now, fix)
+
+    def track_due(self, now=None):
+        now = time.time() if now is None else now
+        return len(self.points) > 1 and (len(self.points) >= self.max_points or now - self.points[0][0] >= self.track_interval)
+
+    def track_message(self, topic, now=None):
+        """Build the track MQTT message with the simplified buffered points and empty the buffer.
+
+        The last point is kept as the first one of the next track, so tracks are continuous.
+        """
+        points = simplify(self.points, self.tolerance)
+        logger.info("Track simplified from {} to {} point(s)".format(len(self.points), len(points)))
+        track = {
+            'timestamp': int(round(time.time() if now is None else now)),
+            'tolerance': self.tolerance,
+            'original_points': len(self.points),
+            'points': [[round(point_time, 1), latitude, longitude] for point_time, latitude, longitude in points]
+        }
+        self.points = self.points[-1:]
+        return {'topic': topic,
+                'payload': json.dumps(track),
+                'qos': 1,
+                'retain': False}
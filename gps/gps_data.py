@@ -9,12 +9,25 @@ import json
 import logging
 import logging.handlers
 import os
+import sys
 
 import gps
 import threading
 import time
 
-gpsd = None  # setting the global variable
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../common')
+from store import open_store, drain_store, STORE_CYCLE_BATCHES, STORE_CYCLE_TIMEOUT  # noqa: E402
+from changes import ChangeFilter  # noqa: E402
+from payloads import PayloadEncoder  # noqa: E402
+from local_publisher import LocalPublisher  # noqa: E402
+from timeseries import open_time_series  # noqa: E402
+from location import Fix, location_info  # noqa: E402
+from track import AdaptiveTracker  # noqa: E402
+
+# Stream the reports as JSON objects, one per line
+GPSD_WATCH = '?WATCH={"enable":true,"json":true};'
+# class is the first member of every report
+TPV_CLASS = '"TPV"'
 
 
 def on_publish(client, userdata, mid):
@@ -31,20 +44,68 @@ def on_connect(client, userdata, flags, rc):
         logger.error("Not connected to MQTT. Bad connection Returned code=", rc)
 
 
-class GpsPoller(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        global gpsd  # bring it in scope
-        gpsd = gps.gps(mode=gps.WATCH_ENABLE)  # starting the stream of info
-        self.current_value = None
-        self.running = True
+class GpsReader(threading.Thread):
+    """Read the gpsd reports as they arrive, keeping a snapshot of the latest fix.
+
+    The thread sleeps until gpsd sends data (select on the gpsd socket) and
+    only TPV reports are decoded (not the satellites in SKY reports). Each one
+    replaces the latest fix with a new immutable Fix, so the fix is never read
+    half updated and the publishing rate doesn't depend on the reading rate.
+    It reconnects when gpsd closes the connection.
+    """
+
+    def __init__(self, host="127.0.0.1", port=gps.GPSD_PORT):
+        threading.Thread.__init__(self, daemon=True)
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.fix = None
+        self.reports = 0
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+
+    def latest(self):
+        """Return the latest fix (None until the first TPV report is read)."""
+        with self.lock:
+            return self.fix
 
     def run(self):
-        global gpsd
-        while gpsp.running:
-            # this will continue to loop and grab EACH set of
-            # gpsd info to clear the buffer
-            next(gpsd)
+        backoff = 1
+        while not self.stopping.is_set():
+            session = None
+            try:
+                # Line reader of the gps module, without its reports interpretation
+                session = gps.client.gpscommon(host=self.host, port=self.port)
+                session.send(GPSD_WATCH)
+                backoff = 1
+                while not self.stopping.is_set():
+                    # Wake up every second to check if the thread must stop
+                    if not session.waiting(timeout=1.0):
+                        continue
+                    buffered = len(session.linebuffer)
+                    status = session.read()
+                    if status < 0 or (status == 0 and len(session.linebuffer) == buffered):
+                        # Nothing read although the socket was ready
+                        raise ConnectionError("connection closed by gpsd")
+                    if status == 0:
+                        # Only part of a report has been received
+                        continue
+                    self.reports += 1
+                    if TPV_CLASS in session.response[:20]:
+                        fix = Fix.from_report(json.loads(session.response))
+                        with self.lock:
+                            self.fix = fix
+            except (OSError, ValueError) as err:
+                logger.error("gpsd error: {}, reconnecting in {} second(s)...".format(err, backoff))
+                with self.lock:
+                    self.fix = None
+                self.stopping.wait(backoff)
+                backoff = min(backoff * 2, 60)
+            finally:
+                if session is not None:
+                    session.close()
 
 
 if __name__ == '__main__':
@@ -65,6 +126,12 @@ if __name__ == '__main__':
 
     logger.setLevel(logging.DEBUG)
 
+    # Add handlers to the logger of the modules shared with other scripts
+    common_logger = logging.getLogger('pioniq')
+    common_logger.setLevel(logging.DEBUG)
+    common_logger.addHandler(console_handler)
+    common_logger.addHandler(file_handler)
+
     with open(os.path.dirname(os.path.realpath(__file__)) + '/gps_data.config.json') as config_file:
         config = json.loads(config_file.read())
 
@@ -74,101 +141,125 @@ if __name__ == '__main__':
     password = config['mqtt']['password']
     topic_prefix = config['mqtt']['topic_prefix']
 
-    gpsp = GpsPoller()  # create the GPS thread
+    store = open_store(config.get('store'), os.path.dirname(os.path.realpath(__file__)))
+    change_filter = ChangeFilter.from_config(config.get('changes'))
+    encoder = PayloadEncoder.from_config(config.get('encoding'), topic_prefix)
+    time_series = open_time_series(config.get('timeseries'), os.path.dirname(os.path.realpath(__file__)))
+    tracker = AdaptiveTracker.from_config(config.get('tracking'))
+
+    gpsp = GpsReader()  # create the GPS thread
+    mqtt_client = None
+    local_publisher = None
 
     try:
         logger.info("=== Script start ===")
 
-        # Start GPS Poller thread
+        # Start GPS reader thread
         gpsp.start()
 
-        mqtt.Client.connected_flag = False
-        # Create MQTT client
-        mqtt_client = mqtt.Client(client_id="gps-data-script", protocol=mqtt.MQTTv311, transport="tcp")
-        # Assign callback functions
-        mqtt_client.on_publish = on_publish
-        mqtt_client.on_connect = on_connect
-        # Set tls
-        mqtt_client.tls_set()
-        # Set user and password
-        mqtt_client.username_pw_set(user, password)
-        # Enable MQTT logger
-        mqtt_client.enable_logger(logger)
-        # Start loop to process callbacks
-        mqtt_client.loop_start()
-        # Conect to MQTT server
-        while not mqtt_client.connected_flag:
-            try:
-                logger.debug("Trying to connect to MQTT server")
-                mqtt_client.connect(broker_address, port)
-            except Exception as err:
-                logger.error("MQTT connection could not be established: {}, retrying... ".format(err), exc_info=False)
-            time.sleep(5)
-
-        previous_latitude = 0
-        previous_logitude = 0
+        if config.get('publisher'):
+            # The publisher service owns the MQTT connection
+            local_publisher = LocalPublisher(config['publisher']['socket'])
+        else:
+            mqtt.Client.connected_flag = False
+            # Create MQTT client
+            mqtt_client = mqtt.Client(client_id="gps-data-script", protocol=mqtt.MQTTv311, transport="tcp")
+            # Assign callback functions
+            mqtt_client.on_publish = on_publish
+            mqtt_client.on_connect = on_connect
+            # Set tls
+            mqtt_client.tls_set()
+            # Set user and password
+            mqtt_client.username_pw_set(user, password)
+            # Enable MQTT logger
+            mqtt_client.enable_logger(logger)
+            # Start loop to process callbacks
+            mqtt_client.loop_start()
+            # Conect to MQTT server
+            while not mqtt_client.connected_flag:
+                try:
+                    logger.debug("Trying to connect to MQTT server")
+                    mqtt_client.connect(broker_address, port)
+                except Exception as err:
+                    logger.error("MQTT connection could not be established: {}, retrying... ".format(err), exc_info=False)
+                time.sleep(5)
+
+        previous = None
+        last_fix = None
         max_accuracy = int(config['service']['min_accuracy'])
 
         sleep_time = int(config['service']['sleep'])
+        if tracker is not None:
+            # The tracker decides when the location is published, check every new fix
+            sleep_time = 1
 
         published_messages = 0
         while True:
             try:
-                location = {
-                    'last_update': int(round(time.time())),
-                    'state': 'running'
-                }
                 location_fixed = False
-                # It may take some seconds to get good data
-                logger.debug("Latitude error (EPY): +/- {} m".format(gpsd.fix.epy))
-                logger.debug("Longitude error (EPX): +/- {} m".format(gpsd.fix.epx))
-                fix_accuracy = max(gpsd.fix.epy, gpsd.fix.epx)
-                logger.info("Location accuracy: +/- {} m".format(fix_accuracy))
-                if fix_accuracy < max_accuracy:
-                    logger.debug("GPS position fixed with +/- {} m".format(fix_accuracy))
-                    location_fixed = True
-                    location.update({'latitude': gpsd.fix.latitude,
-                                     'longitude': gpsd.fix.longitude,
-                                     'gps_accuracy': fix_accuracy,
-                                     'eps': gpsd.fix.eps,  # Estimated Speed error
-                                     'epx': gpsd.fix.epx,  # Estimated longitude error
-                                     'epy': gpsd.fix.epy,  # Estimated latitude error
-                                     'epv': gpsd.fix.epv,  # Estimated altitude error
-                                     'ept': gpsd.fix.ept,  # Estimated time error
-                                     'speed': gpsd.fix.speed,  # m/s
-                                     'climb': gpsd.fix.climb,
-                                     'track': gpsd.fix.track,
-                                     'mode': gpsd.fix.mode
-                                     })
-                    if previous_latitude != 0 and previous_logitude != 0:
-                        # Previous latitude and longitude data is useful to measure distance travelled between updates.
-                        location.update({
-                            'platitude': previous_latitude,  # Latitude got from previous read
-                            'plongitude': previous_logitude  # Longitude got from previous read
-                        })
-                    previous_latitude = gpsd.fix.latitude
-                    previous_logitude = gpsd.fix.longitude
-
-                    # Publish to MQTT
-                    logger.debug("Publishing positon to MQTT...")
-                    logger.debug("{}".format(json.dumps(location)))
-
-    #                logger.debug("%s satellites in view" % len(gpsd.satellites))
-    #                for sat in gpsd.satellites:
-    #                    logger.debug("    %r" % sat)
+                track_msgs = []
+                # Snapshot of the latest fix, it may take some seconds to get good data
+                fix = gpsp.latest()
+                if fix is None or fix is last_fix:
+                    if tracker is None:
+                        logger.warning("No new GPS fix since last update")
                 else:
-                    logger.warning("Location not accurate enought: it's +/- {} m but +/- {} m required".format(fix_accuracy, max_accuracy))
+                    last_fix = fix
+                    if tracker is not None and fix.mode >= 2 and fix.accuracy < max_accuracy:
+                        tracker.add(fix)
+                    location = None
+                    if tracker is None or tracker.location_due(fix):
+                        location = location_info(fix, max_accuracy, previous)
+                    if location is not None:
+                        location_fixed = True
+                        if tracker is not None:
+                            tracker.published(fix)
+                        if time_series is not None:
+                            time_series.append_values("location", location)
+                        previous = (fix.latitude, fix.longitude)
+
+                        # Publish to MQTT
+                        logger.debug("Publishing positon to MQTT...")
+                        logger.debug("{}".format(json.dumps(location)))
+                if tracker is not None and tracker.track_due():
+                    track_msgs = [tracker.track_message(topic_prefix + "track")]
             except Exception as ex:
                 logger.exception("Unexpected error: {}".format(ex))
             finally:
+                msgs = []
                 if location_fixed:
-                    result = mqtt_client.publish(topic=topic_prefix + "location", payload=json.dumps(location), qos=0, retain=True)
-                    result.wait_for_publish()
+                    msgs = [{'topic': topic_prefix + "location", 'payload': json.dumps(location), 'qos': 0, 'retain': True}]
+                    if change_filter is not None:
+                        msgs = change_filter.filter(msgs)
+                        logger.debug("{} byte(s) saved by change-based publishing".format(change_filter.bytes_saved))
+                        if not msgs:
+                            logger.info("Location didn't change, not published")
+                # The track is a batch of new points, there is nothing to compare with
+                msgs += track_msgs
+                if encoder is not None and msgs:
+                    msgs = encoder.encode(msgs)
+                if local_publisher is not None and msgs:
+                    failed = local_publisher.publish(msgs)
+                    if failed and store is not None:
+                        store.put(failed)
+                    elif not failed:
+                        published_messages += 1
+                        if store is not None and len(store) > 0:
+                            local_publisher.forward_store(store, max_batches=STORE_CYCLE_BATCHES)
+                    msgs = []
+                for msg in msgs:
+                    result = mqtt_client.publish(**msg)
                     if (result.rc == 0):
+                        # Only wait when the message was sent, otherwise it would wait forever
+                        result.wait_for_publish()
                         logger.info("Message successfully published: " + str(result))
                         published_messages += 1
+                        if store is not None and len(store) > 0:
+                            drain_store(mqtt_client, store, timeout=STORE_CYCLE_TIMEOUT, max_batches=STORE_CYCLE_BATCHES)
                     else:
                         logger.error("Error publishing message: " + str(result))
+                        if store is not None:
+                            store.put([msg])
 
                 logger.debug("Waiting {} seconds...".format(sleep_time))
                 time.sleep(sleep_time)
@@ -179,9 +270,16 @@ if __name__ == '__main__':
         logger.exception("Unexpected error: {}".format(ex))
     finally:
         logger.info("Killing threads...")
-        mqtt_client.loop_stop()
-        mqtt_client.disconnect()
-        gpsp.running = False
-        gpsp.join()  # wait for the thread to finish what it's doing
+        if mqtt_client is not None:
+            mqtt_client.loop_stop()
+            mqtt_client.disconnect()
+        if local_publisher is not None:
+            local_publisher.close()
+        gpsp.stop()
+        gpsp.join(timeout=5)  # wait for the thread to finish what it's doing
+        if store is not None:
+            store.close()
+        if time_series is not None:
+            time_series.close()
         logger.info("{} location points published".format(published_messages))
         logger.info("=== Script end ===")
@@ -0,0 +1,47 @@
+class AdapterState(object):
+    """Keep track of the CAN settings currently applied to the ELM327 adapter.
+
+    Every AT command is a full serial round trip, so only the settings that
+    differ from the ones already applied need to be sent to the adapter.
+    A value of None means the setting is unknown and must always be sent.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget all settings (i.e. after the adapter has been reset)."""
+        self.header = None
+        self.receive_address = None
+        self.can_filter = None
+
+    def pending_commands(self, header, receive_address=None, can_filter=None):
+        """Return the ext_commands names needed to reach the requested state, in sending order."""
+        pending = []
+        if header is not None and header != self.header:
+            pending.append("CAN_HEADER_" + header)
+        if receive_address is not None and receive_address != self.receive_address:
+            pending.append("CAN_RECEIVE_ADDRESS_" + receive_address)
+        if can_filter is not None and can_filter != self.can_filter:
+            pending.append("CAN_FILTER_" + can_filter)
+        return pending
+
+    def invalidate(self, command_name):
+        """Mark the setting changed by the command as unknown (i.e. before sending it)."""
+        if command_name.startswith("CAN_HEADER_"):
+            self.header = None
+        else:
+            # Receive address and filter are both applied by the ELM327 to the
+            # same CAN ID filter, so changing one of them overrides the other
+            self.receive_address = None
+            self.can_filter = None
+
+    def applied(self, command_name):
+        """Update the state once the adapter accepted the command."""
+        value = command_name.rsplit("_", 1)[1]
+        if command_name.startswith("CAN_HEADER_"):
+            self.header = value
+        elif command_name.startswith("CAN_RECEIVE_ADDRESS_"):
+            self.receive_address = value
+        elif command_name.startswith("CAN_FILTER_"):
+            self.can_filter = value
@@ -0,0 +1,162 @@
+import json
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger('obdii')
+
+CELL_COUNT = 96
+MODULE_COUNT = 12
+CELL_KEYS = ["dcBatteryCellVoltage{:02d}".format(i + 1) for i in range(CELL_COUNT)]
+MODULE_TEMP_KEYS = ["dcBatteryModuleTemp{:02d}".format(i + 1) for i in range(MODULE_COUNT)]
+# Scale of the median absolute deviation to estimate the standard deviation of normal values
+MAD_SCALE = 1.4826
+
+
+def stats(values):
+    """Min, max, mean, standard deviation and imbalance (max - min) of an array."""
+    low = values.min()
+    high = values.max()
+    return {'min': float(low), 'max': float(high), 'mean': float(values.mean()),
+            'std': float(values.std()), 'imbalance': float(high - low)}
+
+
+class PackAnalytics(object):
+    """Cell voltage and module temperature analytics of the battery pack.
+
+    Every battery sample is analysed as arrays (vectorized with NumPy): min,
+    max, mean, standard deviation and imbalance of cell voltages and module
+    temperatures, and the outlier cells, the ones further from the median than
+    outlier_voltage and outlier_sigma robust standard deviations (MAD).
+
+    The deviation of each cell from the pack mean is also followed across
+    samples with exponentially weighted rolling mean and standard deviation
+    (window samples): the drift of a cell is its rolling mean deviation, a
+    cell always below the others is likely weaker. The rolling statistics are
+    seeded from the battery values of the time series history, so they
+    survive restarts (i.e. cron runs).
+    """
+
+    def __init__(self, outlier_voltage=0.02, outlier_sigma=3.0, window=100, detail_interval=600, history=3600):
+        self.outlier_voltage = outlier_voltage
+        self.outlier_sigma = outlier_sigma
+        self.alpha = 2.0 / (window + 1)
+        self.detail_interval = detail_interval
+        self.history = history
+        self.deviation_mean = np.zeros(CELL_COUNT)
+        self.deviation_var = np.zeros(CELL_COUNT)
+        self.samples = 0
+        self.last_sample = None  # time of the latest sample (seeded from the time series)
+
+    @classmethod
+    def from_config(cls, analytics_config):
+        """Create the analytics from the 'analytics' config section (None when not configured)."""
+        if not analytics_config:
+            return None
+        return cls(outlier_voltage=float(analytics_config.get('outlier_voltage', 0.02)),
+                   outlier_sigma=float(analytics_config.get('outlier_sigma', 3.0)),
+                   window=int(analytics_config.get('window', 100)),
+                   detail_interval=float(analytics_config.get('detail_interval', 600)),
+                   history=float(analytics_config.get('history', 3600)))
+
+    def seed(self, time_series):
+        """Replay the cell voltages of the last history seconds of the time series into the rolling statistics.
+
+        Unchanged values are not appended to the time series, so each cell
+        keeps its previous value until it has a new sample.
+        """
+        start = time.time() - self.history
+        samples = time_series.query_many(["battery." + key for key in CELL_KEYS], start)
+        voltages = np.full(CELL_COUNT, np.nan)
+        last_time = None
+        for timestamp, index, value in samples:
+            # All the values of a battery sample are appended with the same time
+            if timestamp != last_time and last_time is not None and not np.isnan(voltages).any():
+                self.update_drift(voltages)
+            voltages[index] = value
+            last_time = timestamp
+        if last_time is not None and not np.isnan(voltages).any():
+            self.update_drift(voltages)
+        self.last_sample = last_time
+        logger.info("Cell drift seeded with {} sample(s) of the time series".format(self.samples))
+
+    def update_drift(self, voltages):
+        deviation = voltages - voltages.mean()
+        if self.samples == 0:
+            self.deviation_mean = deviation
+        else:
+            # Incremental exponentially weighted mean and variance
+            difference = deviation - self.deviation_mean
+            increment = self.alpha * difference
+            self.deviation_mean = self.deviation_mean + increment
+            self.deviation_var = (1 - self.alpha) * (self.deviation_var + difference * increment)
+        self.samples += 1
+
+    def analyze(self, battery_info):
+        """Return the summary of a battery sample, updating the rolling statistics."""
+        voltages = np.array([battery_info[key] for key in CELL_KEYS])
+        temps = np.array([battery_info[key] for key in MODULE_TEMP_KEYS], dtype=float)
+        self.update_drift(voltages)
+
+        median = np.median(voltages)
+        absolute_deviation = np.abs(voltages - median)
+        limit = max(self.outlier_voltage, self.outlier_sigma * MAD_SCALE * np.median(absolute_deviation))
+        outliers = np.flatnonzero(absolute_deviation > limit) + 1
+        drift_cell = int(np.argmax(np.abs(self.deviation_mean)))
+
+        voltage_stats = stats(voltages)
+        temp_stats = stats(temps)
+        return {
+            'timestamp': battery_info['timestamp'],
+            'cellVoltageMin': round(voltage_stats['min'], 3),
+            'cellVoltageMax': round(voltage_stats['max'], 3),
+            'cellVoltageMean': round(voltage_stats['mean'], 3),
+            'cellVoltageStd': round(voltage_stats['std'], 4),
+            'cellVoltageImbalance': round(voltage_stats['imbalance'], 3),
+            'cellNoMinVoltage': int(np.argmin(voltages)) + 1,
+            'cellNoMaxVoltage': int(np.argmax(voltages)) + 1,
+            'outlierCells': outliers.tolist(),
+            'cellNoMaxDrift': drift_cell + 1,
+            'cellMaxDrift': round(float(self.deviation_mean[drift_cell]), 4),
+            'moduleTempMin': temp_stats['min'],
+            'moduleTempMax': temp_stats['max'],
+            'moduleTempMean': round(temp_stats['mean'], 1),
+            'moduleTempStd': round(temp_stats['std'], 2),
+            'moduleTempImbalance': temp_stats['imbalance']
+        }
+
+    def detail(self, battery_info):
+        """Per cell and per module values and rolling statistics."""
+        return {
+            'timestamp': battery_info['timestamp'],
+            'cellVoltages': [battery_info[key] for key in CELL_KEYS],
+            'cellDrift': np.round(self.deviation_mean, 4).tolist(),
+            'cellDriftStd': np.round(np.sqrt(self.deviation_var), 4).tolist(),
+            'driftSamples': self.samples,
+            'moduleTemps': [battery_info[key] for key in MODULE_TEMP_KEYS]
+        }
+
+    def messages(self, battery_info, topic_prefix):
+        """Return the MQTT messages of a battery sample: the summary and, every detail_interval seconds, the detail.
+
+        The detail is due when the sample is in a later detail_interval period
+        than the previous one, so the rate is the same when the script runs once
+        per cron execution (with a time series).
+        """
+        timestamp = battery_info['timestamp']
+        if timestamp == self.last_sample:
+            # Same response (not due in the polling schedule), already analysed
+            return []
+        due = self.last_sample is None or timestamp // self.detail_interval != self.last_sample // self.detail_interval
+        self.last_sample = timestamp
+        msgs = [{'topic': topic_prefix + "cells",
+                 'payload': json.dumps(self.analyze(battery_info)),
+                 'qos': 0,
+                 'retain': True}]
+        if due:
+            msgs.append({'topic': topic_prefix + "cells_detail",
+                         'payload': json.dumps(self.detail(battery_info)),
+                         'qos': 0,
+                         'retain': True})
+        return msgs
@@ -0,0 +1,118 @@
+import logging
+import time
+
+from state import state_path, load_state, save_state
+
+logger = logging.getLogger('obdii')
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+    """Per ECU (request header) circuit breaker and negative cache of the failed commands.
+
+    States of each ECU:
+        closed:    commands are queried as usual (with retries).
+        open:      after failures consecutive failed commands (all their
+                   attempts) the ECU is considered asleep or dead and its
+                   commands fail at once, without using the bus, for ttl
+                   seconds (doubled every time the ECU is still not answering,
+                   up to max_ttl).
+        half-open: once the ttl expires, the next command is a probe queried
+                   only once (no retries): the breaker closes when it answers
+                   and opens again when it doesn't.
+
+    Every failed command is also cached for ttl seconds, so a command an
+    awake ECU doesn't answer isn't retried on every cycle either.
+
+    When path is set, the state is saved there, so it's kept between script
+    runs (i.e. cron).
+    """
+
+    def __init__(self, failures=2, ttl=30, max_ttl=300, path=None, metrics=None):
+        self.failures = failures
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.path = path
+        self.metrics = metrics
+        self.ecus = {}  # header: {'state', 'failures', 'ttl', 'until'}
+        self.failed = {}  # command name: time until the failure is cached
+        self.changed = False
+        saved = load_state(path, "circuit breaker state", ('ecus', 'failed'))
+        if saved is not None:
+            self.ecus = saved['ecus']
+            self.failed = saved['failed']
+
+    @classmethod
+    def from_config(cls, breaker_config, base_dir, metrics=None):
+        """Create the breaker from the 'breaker' config section (None when not configured)."""
+        if not breaker_config:
+            return None
+        return cls(failures=int(breaker_config.get('failures', 2)),
+                   ttl=float(breaker_config.get('ttl', 30)),
+                   max_ttl=float(breaker_config.get('max_ttl', 300)),
+                   path=state_path(breaker_config.get('path'), base_dir),
+                   metrics=metrics)
+
+    def ecu(self, header):
+        return self.ecus.setdefault(header, {'state': CLOSED, 'failures': 0, 'ttl': self.ttl, 'until': 0})
+
+    def transition(self, header, state):
+        ecu = self.ecu(header)
+        if state != ecu['state']:
+            logger.info("ECU {} circuit breaker: {} -> {}".format(header, ecu['state'], state))
+            if self.metrics is not None:
+                self.metrics.inc('obdii_breaker_transitions_total', ecu=header, state=state)
+            ecu['state'] = state
+            self.changed = True
+
+    def rejected(self, header, command_name, now=None):
+        """Why the command must fail without querying it ("open" or "cached"), None when it can be queried."""
+        now = time.time() if now is None else now
+        ecu = self.ecu(header)
+        if ecu['state'] == OPEN:
+            if now < ecu['until']:
+                return "open"
+            self.transition(header, HALF_OPEN)
+        elif ecu['state'] == CLOSED and now < self.failed.get(command_name, 0):
+            return "cached"
+        return None
+
+    def probing(self, header):
+        """Whether the next command of the ECU is the half-open probe (one attempt)."""
+        return self.ecu(header)['state'] == HALF_OPEN
+
+    def success(self, header, command_name):
+        ecu = self.ecu(header)
+        if ecu['failures'] or ecu['state'] != CLOSED:
+            ecu['failures'] = 0
+            ecu['ttl'] = self.ttl
+            self.transition(header, CLOSED)
+            self.changed = True
+        if self.failed.pop(command_name, None) is not None:
+            self.changed = True
+
+    def failure(self, header, command_name, now=None):
+        now = time.time() if now is None else now
+        ecu = self.ecu(header)
+        if ecu['state'] == HALF_OPEN:
+            # Still not answering, wait longer before the next probe
+            ecu['ttl'] = min(self.max_ttl, ecu['ttl'] * 2)
+            ecu['until'] = now + ecu['ttl']
+            self.transition(header, OPEN)
+        else:
+            ecu['failures'] += 1
+            if ecu['failures'] >= self.failures:
+                ecu['until'] = now + ecu['ttl']
+                self.transition(header, OPEN)
+        self.failed[command_name] = now + self.ttl
+        self.changed = True
+
+    def save(self):
+        """Save the state when it changed."""
+        if self.path is None or not self.changed:
+            return
+        save_state(self.path, {'ecus': self.ecus, 'failed': self.failed})
+        self.changed = False
@@ -0,0 +1,89 @@
+import logging
+
+from state import state_path, load_state, save_state
+
+logger = logging.getLogger('obdii')
+
+# CAN settings (header, receive address, ID filter) of each known ECU and the extended commands it answers
+ECUS = (
+    ("7E4", "7EC", None, ["BMS_2101", "BMS_2102", "BMS_2103", "BMS_2104", "BMS_2105"]),  # BMS
+    ("7E2", "7EA", None, ["VIN_1A80", "VMCU_2101"]),  # VMCU
+    ("7C6", "7EC", "7CE", ["ODOMETER_22B002"]),  # Cluster
+    ("7A0", "7A8", None, ["TPMS_22C00B"]),  # TPMS
+    ("7E6", "7EE", None, ["EXT_TEMP_2180"])  # External temperature
+)
+
+
+class CapabilityMap(object):
+    """Extended commands supported by each vehicle (by VIN), found by probing its ECUs.
+
+    ext_commands are the ones of the 28 kWh Ioniq, other variants may not
+    answer some of them. Discovery queries every command of ECUS and stores
+    which ones answered, so the vehicle is never queried again for the
+    unsupported ones (retries included). A command is only unsupported once
+    it failed failures discoveries in a row (a module may miss a single
+    one), until then it's still queried and the vehicle is discovered again.
+    Commands of vehicles not discovered yet are all queried.
+
+    The VIN of the vehicle being queried is kept (and saved to path with the
+    map), so it's known before querying the VMCU on the next runs.
+    """
+
+    def __init__(self, path, failures=3):
+        self.path = path
+        self.failures = failures
+        self.vehicles = {}  # VIN: {command name: supported}
+        self.failed = {}  # VIN: {command name: discoveries failed in a row}
+        self.vin = None
+        saved = load_state(path, "capability map", ('vehicles', 'vin'))
+        if saved is not None:
+            self.vehicles = saved['vehicles']
+            self.failed = saved.get('failed', {})
+            self.vin = saved['vin']
+
+    @classmethod
+    def from_config(cls, capabilities_config, base_dir):
+        """Create the map from the 'capabilities' config section (None when not configured)."""
+        if not capabilities_config:
+            return None
+        return cls(state_path(capabilities_config['path'], base_dir),
+                   failures=int(capabilities_config.get('failures', 3)))
+
+    def needs_discovery(self):
+        """Whether the vehicle being queried hasn't been discovered yet (or has commands failed too few times)."""
+        if self.vin not in self.vehicles:
+            return True
+        commands = self.vehicles[self.vin]
+        return any(commands.get(name, True) for name in self.failed.get(self.vin, {}))
+
+    def identify(self, vin):
+        """Set the VIN of the vehicle being queried (i.e. the adapter was moved to another car)."""
+        if vin != self.vin:
+            logger.info("Vehicle {} {}".format(vin, "without discovered commands" if vin not in self.vehicles else "identified"))
+            self.vin = vin
+            self.save()
+
+    def supported(self, command_names):
+        """Whether all the commands are supported by the vehicle being queried (or it isn't discovered)."""
+        commands = self.vehicles.get(self.vin, {})
+        return all(commands.get(name, True) for name in command_names)
+
+    def discovered(self, vin, commands):
+        """Store the discovery results of a vehicle: {command name: answered}."""
+        failed = self.failed.setdefault(vin, {})
+        for name, answered in commands.items():
+            if answered:
+                failed.pop(name, None)
+            else:
+                failed[name] = failed.get(name, 0) + 1
+        self.vehicles[vin] = {name: failed.get(name, 0) < self.failures for name in commands}
+        self.vin = vin
+        self.save()
+        unsupported = sorted(name for name, supported in self.vehicles[vin].items() if not supported)
+        pending = sorted(name for name, supported in self.vehicles[vin].items() if supported and name in failed)
+        logger.info("Vehicle {} discovered, unsupported commands: {}".format(vin, ", ".join(unsupported) or "none"))
+        if pending:
+            logger.info("Commands {} failed, they will be probed again".format(", ".join(pending)))
+
+    def save(self):
+        save_state(self.path, {'vehicles': self.vehicles, 'failed': self.failed, 'vin': self.vin}, indent=4, sort_keys=True)
@@ -0,0 +1,177 @@
+import collections
+import logging
+
+from state import state_path, load_state, save_state
+
+logger = logging.getLogger('obdii')
+
+# Battery temperature bands (C) with their own charge curve: cold below 10, mild below 25, warm
+TEMPERATURE_BANDS = ((10, "cold"), (25, "mild"), (None, "warm"))
+
+
+def temperature_band(temperature):
+    for limit, band in TEMPERATURE_BANDS:
+        if limit is None or temperature < limit:
+            return band
+
+
+class ChargeEstimator(object):
+    """Estimate the time to complete a charge from a rolling window and a learned charge curve.
+
+    During a charging session the latest window (SOC, power, temperature)
+    samples are kept with running sums, so the charging power is the window
+    average instead of a single noisy sample. The average power of each SOC
+    percent is learned across sessions (exponentially weighted, alpha) per
+    charge port (normal or rapid) and battery temperature band: it follows the
+    taper near high SOC. The time to complete adds, for every SOC percent left,
+    its energy divided by the learned power at that SOC, limited by the current
+    power (the charger may be slower than the car).
+
+    When path is set, the curves and the session in progress are saved there,
+    so they are kept between sessions and script runs (i.e. cron).
+    """
+
+    def __init__(self, battery_capacity, window=10, alpha=0.2, path=None):
+        self.battery_capacity = battery_capacity
+        self.alpha = alpha
+        self.path = path
+        self.window = collections.deque(maxlen=window)
+        self.power_sum = 0.0
+        self.temperature_sum = 0.0
+        self.curves = {}  # "port/band": [power (kW) per SOC percent, None when not learned]
+        self.session = None
+        self.last_info = None
+        state = load_state(path, "charging state", ('curves', 'session', 'window'))
+        if state is not None:
+            self.curves = state['curves']
+            self.session = state['session']
+            for sample in state['window']:
+                self.add_sample(*sample)
+
+    @classmethod
+    def from_config(cls, charging_config, battery_capacity, base_dir):
+        """Create the estimator from the 'charging' config section (None when not configured)."""
+        if not charging_config:
+            return None
+        return cls(battery_capacity,
+                   window=int(charging_config.get('window', 10)),
+                   alpha=float(charging_config.get('alpha', 0.2)),
+                   path=state_path(charging_config.get('path'), base_dir))
+
+    def add_sample(self, soc, power, temperature):
+        if len(self.window) == self.window.maxlen:
+            _, old_power, old_temperature = self.window[0]
+            self.power_sum -= old_power
+            self.temperature_sum -= old_temperature
+        self.window.append((soc, power, temperature))
+        self.power_sum += power
+        self.temperature_sum += temperature
+
+    def clear_window(self):
+        self.window.clear()
+        self.power_sum = 0.0
+        self.temperature_sum = 0.0
+
+    def curve(self, port, temperature):
+        """Learned curve of the port at the temperature, or of any other band of the port."""
+        curve = self.curves.get("{}/{}".format(port, temperature_band(temperature)))
+        if curve is None:
+            curve = next((curve for key, curve in sorted(self.curves.items()) if key.startswith(port + "/")), None)
+        return curve
+
+    def learn_percent(self):
+        """Learn the average power of the SOC percent the session is leaving."""
+        session = self.session
+        if session['percentSamples'] and session['percentPower'] > 0 and self.window:
+            self.learn(session['port'], session['percent'], session['percentPower'] / session['percentSamples'],
+                       self.temperature_sum / len(self.window))
+        session['percentPower'] = 0.0
+        session['percentSamples'] = 0
+
+    def learn(self, port, soc, power, temperature):
+        key = "{}/{}".format(port, temperature_band(temperature))
+        curve = self.curves.setdefault(key, [None] * 101)
+        learned = curve[soc]
+        curve[soc] = round(power if learned is None else learned + self.alpha * (power - learned), 3)
+
+    def minutes_to_complete(self, soc, usable_capacity, port, temperature):
+        """Minutes to charge from soc to 100 % at the window power, following the learned curve."""
+        power = self.power_sum / len(self.window)
+        if power <= 0:
+            return None
+        curve = self.curve(port, temperature) or []
+        energy_per_percent = usable_capacity / 100.0  # kWh
+        hours = 0.0
+        for percent in range(soc, 100):
+            learned = curve[percent] if percent < len(curve) else None
+            hours += energy_per_percent / min(power, learned) if learned else energy_per_percent / power
+        return int(round(hours * 60))
+
+    def update(self, battery_info):
+        """Update the session with a battery sample, return the charging info (None when not charging nor ended)."""
+        timestamp = battery_info['timestamp']
+        if self.last_info is not None and timestamp == self.last_info['timestamp']:
+            # Same response (not due in the polling schedule), already counted
+            return self.last_info
+        soc = battery_info['socDisplay']
+        energy_charged = battery_info['cumulativeEnergyCharged']
+        if not battery_info['charging']:
+            if self.session is None:
+                self.last_info = None
+                return None
+            # Session ended, publish its totals
+            self.learn_percent()
+            info = self.charging_info(timestamp, soc, energy_charged, charging=0)
+            info['minsToCompleteCharge'] = 0
+            logger.info("Charging session ended: {} kWh in {} minute(s)".format(info['sessionEnergy'], info['sessionDuration'] // 60))
+            self.session = None
+            self.clear_window()
+            self.save()
+            self.last_info = info
+            return info
+
+        port = "rapid" if battery_info['rapidChargePort'] else "normal"
+        power = abs(battery_info['dcBatteryPower'])
+        temperature = battery_info['dcBatteryAvgTemperature']
+        if self.session is None:
+            logger.info("Charging session started ({} charge port)".format(port))
+            self.session = {'start': timestamp, 'startSoc': soc, 'startEnergy': energy_charged, 'port': port,
+                            'percent': soc, 'percentPower': 0.0, 'percentSamples': 0}
+            self.clear_window()
+        elif soc != self.session['percent']:
+            self.learn_percent()
+            self.session['percent'] = soc
+        self.add_sample(soc, power, temperature)
+        self.session['percentPower'] += power
+        self.session['percentSamples'] += 1
+
+        average_deterioration = (battery_info['dcBatteryCellMaxDeterioration'] + battery_info['dcBatteryCellMinDeterioration']) / 2.0
+        usable_capacity = self.battery_capacity * average_deterioration / 100.0
+        info = self.charging_info(timestamp, soc, energy_charged, charging=1)
+        info['minsToCompleteCharge'] = self.minutes_to_complete(soc, usable_capacity, port, info['temperature'])
+        if info['minsToCompleteCharge'] is not None:
+            info['estimatedCompletion'] = timestamp + info['minsToCompleteCharge'] * 60
+        self.save()
+        self.last_info = info
+        return info
+
+    def charging_info(self, timestamp, soc, energy_charged, charging):
+        session = self.session
+        samples = len(self.window)
+        return {
+            'timestamp': timestamp,
+            'charging': charging,
+            'chargePort': session['port'],
+            'soc': soc,
+            'power': round(self.power_sum / samples, 2) if samples else 0,  # kW, window average
+            'temperature': round(self.temperature_sum / samples, 1) if samples else None,
+            'sessionStart': session['start'],
+            'sessionDuration': timestamp - session['start'],
+            'sessionStartSoc': session['startSoc'],
+            'sessionEnergy': round(energy_charged - session['startEnergy'], 1)  # kWh
+        }
+
+    def save(self):
+        if self.path is None:
+            return
+        save_state(self.path, {'curves': self.curves, 'session': self.session, 'window': list(self.window)})
@@ -0,0 +1,90 @@
+import logging
+
+import obd
+
+from state import state_path, load_state, save_state
+
+logger = logging.getLogger('obdii')
+
+
+class CachedOBD(obd.OBD):
+    """python-obd connection that doesn't query the supported PIDs when they are already known.
+
+    Only forced extended commands are queried, so the supported commands are
+    just informative (print_commands): the ones cached from the first
+    connection are restored instead of querying every PID listing command.
+    """
+
+    def __init__(self, supported_commands, **kwargs):
+        self.cached_commands = supported_commands
+        super(CachedOBD, self).__init__(**kwargs)
+
+    def _OBD__load_commands(self):
+        # Replaces the private OBD.__load_commands called at the end of the connection
+        for name in self.cached_commands:
+            if obd.commands.has_name(name):
+                self.supported_commands.add(obd.commands[name])
+        logger.info("Restored {} cached supported command(s)".format(len(self.supported_commands)))
+
+
+class ConnectionCache(object):
+    """Settings negotiated with the ELM327 adapter and the car on the first successful connection.
+
+    python-obd resets the adapter and detects the baud rate (when not
+    configured) and the OBD protocol (searching them with ATSP0) on every
+    connection, and then queries the supported PIDs. Once connected, the port,
+    baud rate, protocol and supported commands are saved to path, so the next
+    connections (fast path) set them directly: no baud rate nor protocol
+    search and no PID listing queries. When the fast path fails (i.e. another
+    adapter or car) the full detection is done again and its result replaces
+    the cached one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.settings = load_state(path, "connection cache")
+
+    @classmethod
+    def from_config(cls, cache_config, base_dir):
+        """Create the cache from the 'connection_cache' config section (None when not configured)."""
+        if not cache_config:
+            return None
+        return cls(state_path(cache_config['path'], base_dir))
+
+    def fast_settings(self, port):
+        """Cached settings of the port (None when there aren't)."""
+        if self.settings is None or self.settings.get('port') != port:
+            return None
+        return self.settings
+
+    def connect(self, port, timeout):
+        """Connect with the cached settings of the port (one attempt), None when not cached."""
+        settings = self.fast_settings(port)
+        if settings is None:
+            return None
+        logger.info("Connecting with cached settings: BAUD={} PROTOCOL={} ({})"
+                    .format(settings['baudrate'], settings['protocol'], settings['protocolName']))
+        return CachedOBD(settings['supportedCommands'],
+                         portstr=port,
+                         baudrate=settings['baudrate'],
+                         protocol=settings['protocol'],
+                         fast=False,
+                         timeout=timeout)
+
+    def save(self, connection, port, baudrate):
+        """Save the settings of a connection to the car (baudrate None when it was detected)."""
+        if baudrate is None:
+            # python-obd doesn't expose the detected baud rate, it's the one of its serial port
+            baudrate = connection.interface._ELM327__port.baudrate
+        settings = {
+            'port': port,
+            'baudrate': baudrate,
+            'protocol': connection.protocol_id(),
+            'protocolName': connection.protocol_name(),
+            'supportedCommands': sorted(command.name for command in connection.supported_commands)
+        }
+        if settings == self.settings:
+            return
+        save_state(self.path, settings)
+        self.settings = settings
+        logger.info("Connection settings cached: BAUD={} PROTOCOL={}".format(baudrate, settings['protocol']))
@@ -1,174 +1,116 @@
-from obd.utils import bytes_to_int
-from utils import bytes_to_int_signed
-
-
-def external_temperature(messages):
-    """External temperature decoder."""
-    d = messages[0].data
-    if len(d) == 0:
-        return None
-    else:
-        return dict(external_temperature=(d[14] - 80) / 2.0)  # C
-
-
-def vin(messages):
-    """VIN decoder."""
-    d = messages[0].data
-    if len(d) == 0:
-        return None
-    else:
-        vin_str = ""
-        for v in range(16, 33):
-            vin_str = vin_str + chr(bytes_to_int(d[v:v + 1]))
-        return dict(vin=vin_str)
-
-
-def odometer(messages):
-    """Odometer decoder."""
-    d = messages[0].data
-    if len(d) == 0:
-        return None
-    else:
-        v = bytes_to_int(d[9:12])
-        if v == 0:
-            return None
-        else:
-            return dict(odometer=v)  # Km
-
-
-def tpms(messages):
-    """TPMS decoder."""
-    d = messages[0].data
-    if len(d) == 0:
-        return None
-    else:
-        return dict(tire_fl_pressure=round((d[7] * 0.2) / 14.504, 1),  # bar - Front Left
-                    tire_fl_temperature=d[8] - 55,  # C   - Front Left
-
-                    tire_fr_pressure=round((d[11] * 0.2) / 14.504, 1),  # bar - Front Right
-                    tire_fr_temperature=d[12] - 55,  # C   - Front Right
-
-                    tire_bl_pressure=round((d[19] * 0.2) / 14.504, 1),  # bar - Back Left
-                    tire_bl_temperature=d[20] - 55,  # C   - Back Left
-
-                    tire_br_pressure=round((d[15] * 0.2) / 14.504, 1),  # bar - Back Right
-                    tire_br_temperature=d[16] - 55  # C   - Back Right
-                    )
-
-
-def vmcu(messages):
-    """VMCU decoder."""
-    d = messages[0].data
-    if len(d) == 0:
-        return None
-    else:
-        gear_str = ""
-        gear_bits = d[7]
-        if gear_bits & 0x1:  # 1st bit is 1
-            gear_str = gear_str + "P"
-        if gear_bits & 0x2:  # 2nd bit is 1
-            gear_str = gear_str + "R"
-        if gear_bits & 0x4:  # 3rd bit is 1
-            gear_str = gear_str + "N"
-        if gear_bits & 0x8:  # 4th bit is 1
-            gear_str = gear_str + "D"
-
-        brakes_bits = d[8]
-
-        return dict(gear=gear_str,
-                    speed=(((d[16] * 256) + d[15]) / 100.0) * 1.60934,  # kmh. Multiplied by 1.60934 to convert mph to kmh
-                    accel_pedal_depth=d[16] / 2,  # %
-                    brake_lamp=1 if brakes_bits & 0x1 else 0,  # 1st bit is 1
-                    brakes_on=0 if brakes_bits & 0x2 else 1  # 2nd bit is 0
-                    )
-
-
-def bms_2101(messages):
-    """BMS 2101 decoder."""
-    d = messages[0].data
-    if len(d) == 0:
-        return None
-    else:
-        charging_bits = d[11]
-        charging = 1 if charging_bits & 0x80 else 0  # 8th bit is 1
-
-        battery_current = bytes_to_int_signed(d[12:14]) / 10.0
-        battery_voltage = bytes_to_int(d[14:16]) / 10.0
-
-        return dict(socBms=d[6] / 2.0,  # %
-                    bmsIgnition=1 if d[52] & 0x4 else 0,  # 3rd bit is 1
-                    bmsMainRelay=1 if charging_bits & 0x1 else 0,  # 1st bit is 1
-                    auxBatteryVoltage=d[31] / 10.0,  # V
-
-                    charging=charging,
-                    normalChargePort=1 if charging_bits & 0x20 else 0,  # 6th bit is 1
-                    rapidChargePort=1 if charging_bits & 0x40 else 0,  # 7th bit is 1
-                    fanStatus=d[29],  # Hz
-                    fanFeedback=d[30],
-                    cumulativeEnergyCharged=bytes_to_int(d[40:44]) / 10.0,  # kWh
-                    cumulativeEnergyDischarged=bytes_to_int(d[44:48]) / 10.0,  # kWh
-
-                    cumulativeChargeCurrent=bytes_to_int(d[32:36]) / 10.0,  # A
-                    cumulativeDischargeCurrent=bytes_to_int(d[36:40]) / 10.0,  # A
-
-                    cumulativeOperatingTime=bytes_to_int(d[48:52]),  # seconds
-
-                    availableChargePower=bytes_to_int(d[7:9]) / 100.0,  # kW
-                    availableDischargePower=bytes_to_int(d[9:11]) / 100.0,  # kW
-
-                    dcBatteryInletTemperature=bytes_to_int_signed(d[22:23]),  # C
-                    dcBatteryMaxTemperature=bytes_to_int_signed(d[16:17]),  # C
-                    dcBatteryMinTemperature=bytes_to_int_signed(d[17:18]),  # C
-                    dcBatteryCellMaxVoltage=d[25] / 50,  # V
-                    dcBatteryCellNoMaxVoltage=d[26],
-                    dcBatteryCellMinVoltage=d[27] / 50,  # V
-                    dcBatteryCellNoMinVoltage=d[28],
-                    dcBatteryCurrent=battery_current,  # A
-                    dcBatteryPower=round(battery_current * battery_voltage / 1000.0, 3),  # kW
-                    dcBatteryVoltage=battery_voltage,  # V
-
-                    driveMotorSpeed=bytes_to_int_signed(d[55:57]),  # RPM
-
-                    dcBatteryModuleTemp01=bytes_to_int_signed(d[18:19]),  # C
-                    dcBatteryModuleTemp02=bytes_to_int_signed(d[19:20]),  # C
-                    dcBatteryModuleTemp03=bytes_to_int_signed(d[20:21]),  # C
-                    dcBatteryModuleTemp04=bytes_to_int_signed(d[21:22]),  # C
-                    dcBatteryModuleTemp05=bytes_to_int_signed(d[22:23]),  # C
-                    )
-
-
-def bms_2105(messages):
-    """BMS 2105 decoder."""
-    d = messages[0].data
-    if len(d) == 0:
-        return None
-    else:
-        return dict(soh=bytes_to_int(d[27:29]) / 10.0,  # %
-                    dcBatteryCellMaxDeterioration=bytes_to_int(d[27:29]) / 10.0,  # %
-                    dcBatteryCellMinDeterioration=bytes_to_int(d[30:32]) / 10.0,  # %
-                    socDisplay=int(d[33] / 2.0),  # %
-                    dcBatteryModuleTemp06=bytes_to_int_signed(d[11:12]),  # C
-                    dcBatteryModuleTemp07=bytes_to_int_signed(d[12:13]),  # C
-                    dcBatteryModuleTemp08=bytes_to_int_signed(d[13:14]),  # C
-                    dcBatteryModuleTemp09=bytes_to_int_signed(d[14:15]),  # C
-                    dcBatteryModuleTemp10=bytes_to_int_signed(d[15:16]),  # C
-                    dcBatteryModuleTemp11=bytes_to_int_signed(d[16:17]),  # C
-                    dcBatteryModuleTemp12=bytes_to_int_signed(d[17:18]),  # C
-                    dcBatteryCellVoltageDeviation=d[22] / 50,  # V
-                    dcBatteryHeater1Temperature=float(d[25]),  # C
-                    dcBatteryHeater2Temperature=float(d[26]),  # C
-                    dcBatteryCellNoMaxDeterioration=int(d[29]),
-                    dcBatteryCellNoMinDeterioration=int(d[32]),
-                    )
-
-
-def cell_voltages(messages):
-    """Cell voltages decoder."""
-    d = messages[0].data
-    if len(d) == 0:
-        return None
-    else:
-        cell_voltages = []
-        for byte in range(6, 38):
-            cell_voltages.append(d[byte] / 50.0)
-        return cell_voltages
+from signals import Signal, Derived, SignalLayout
+
+# Signal definitions for each PID response. Offsets are relative to the
+# response data (i.e. for BMS 2101, byte 0 is 0x61 and byte 1 is 0x01).
+
+EXTERNAL_TEMPERATURE = SignalLayout("external_temperature", "External temperature decoder.", [
+    Signal('external_temperature', 14, scale='(x - 80) / 2.0', unit='C'),
+])
+
+VIN = SignalLayout("vin", "VIN decoder.", [
+    Signal('vin', 16, 17, text=True),
+])
+
+ODOMETER = SignalLayout("odometer", "Odometer decoder.", [
+    Signal('odometer', 9, 3, unit='Km', null=0),
+])
+
+TPMS = SignalLayout("tpms", "TPMS decoder.", [
+    Signal('tire_fl_pressure', 7, scale='round(x * 0.2 / 14.504, 1)', unit='bar'),  # Front Left
+    Signal('tire_fl_temperature', 8, scale='x - 55', unit='C'),  # Front Left
+
+    Signal('tire_fr_pressure', 11, scale='round(x * 0.2 / 14.504, 1)', unit='bar'),  # Front Right
+    Signal('tire_fr_temperature', 12, scale='x - 55', unit='C'),  # Front Right
+
+    Signal('tire_bl_pressure', 19, scale='round(x * 0.2 / 14.504, 1)', unit='bar'),  # Back Left
+    Signal('tire_bl_temperature', 20, scale='x - 55', unit='C'),  # Back Left
+
+    Signal('tire_br_pressure', 15, scale='round(x * 0.2 / 14.504, 1)', unit='bar'),  # Back Right
+    Signal('tire_br_temperature', 16, scale='x - 55', unit='C'),  # Back Right
+])
+
+VMCU = SignalLayout("vmcu", "VMCU decoder.", [
+    Signal('gear', 7, flags=(('P', 0x1), ('R', 0x2), ('N', 0x4), ('D', 0x8))),  # 1st to 4th bits
+    Signal('speed', 15, 2, little_endian=True, scale='x / 100.0 * 1.60934', unit='km/h'),  # Multiplied by 1.60934 to convert mph to kmh
+    Signal('accel_pedal_depth', 16, scale='x / 2', unit='%'),
+    Signal('brake_lamp', 8, mask=0x1),  # 1st bit is 1
+    Signal('brakes_on', 8, mask=0x2, invert=True),  # 2nd bit is 0
+])
+
+BMS_2101 = SignalLayout("bms_2101", "BMS 2101 decoder.", [
+    Signal('socBms', 6, scale='x / 2.0', unit='%'),
+    Signal('bmsIgnition', 52, mask=0x4),  # 3rd bit is 1
+    Signal('bmsMainRelay', 11, mask=0x1),  # 1st bit is 1
+    Signal('auxBatteryVoltage', 31, scale='x / 10.0', unit='V'),
+
+    Signal('charging', 11, mask=0x80),  # 8th bit is 1
+    Signal('normalChargePort', 11, mask=0x20),  # 6th bit is 1
+    Signal('rapidChargePort', 11, mask=0x40),  # 7th bit is 1
+    Signal('fanStatus', 29, unit='Hz'),
+    Signal('fanFeedback', 30),
+    Signal('cumulativeEnergyCharged', 40, 4, scale='x / 10.0', unit='kWh'),
+    Signal('cumulativeEnergyDischarged', 44, 4, scale='x / 10.0', unit='kWh'),
+
+    Signal('cumulativeChargeCurrent', 32, 4, scale='x / 10.0', unit='A'),
+    Signal('cumulativeDischargeCurrent', 36, 4, scale='x / 10.0', unit='A'),
+
+    Signal('cumulativeOperatingTime', 48, 4, unit='seconds'),
+
+    Signal('availableChargePower', 7, 2, scale='x / 100.0', unit='kW'),
+    Signal('availableDischargePower', 9, 2, scale='x / 100.0', unit='kW'),
+
+    Signal('dcBatteryInletTemperature', 22, signed=True, unit='C'),
+    Signal('dcBatteryMaxTemperature', 16, signed=True, unit='C'),
+    Signal('dcBatteryMinTemperature', 17, signed=True, unit='C'),
+    Signal('dcBatteryCellMaxVoltage', 25, scale='x / 50', unit='V'),
+    Signal('dcBatteryCellNoMaxVoltage', 26),
+    Signal('dcBatteryCellMinVoltage', 27, scale='x / 50', unit='V'),
+    Signal('dcBatteryCellNoMinVoltage', 28),
+    Signal('dcBatteryCurrent', 12, 2, signed=True, scale='x / 10.0', unit='A'),
+    Derived('dcBatteryPower', 'round(dcBatteryCurrent * dcBatteryVoltage / 1000.0, 3)', unit='kW'),
+    Signal('dcBatteryVoltage', 14, 2, scale='x / 10.0', unit='V'),
+
+    Signal('driveMotorSpeed', 55, 2, signed=True, unit='RPM'),
+
+    Signal('dcBatteryModuleTemp01', 18, signed=True, unit='C'),
+    Signal('dcBatteryModuleTemp02', 19, signed=True, unit='C'),
+    Signal('dcBatteryModuleTemp03', 20, signed=True, unit='C'),
+    Signal('dcBatteryModuleTemp04', 21, signed=True, unit='C'),
+    Signal('dcBatteryModuleTemp05', 22, signed=True, unit='C'),  # Same byte as dcBatteryInletTemperature
+])
+
+BMS_2105 = SignalLayout("bms_2105", "BMS 2105 decoder.", [
+    Signal('soh', 27, 2, scale='x / 10.0', unit='%'),
+    Signal('dcBatteryCellMaxDeterioration', 27, 2, scale='x / 10.0', unit='%'),  # Same bytes as soh
+    Signal('dcBatteryCellMinDeterioration', 30, 2, scale='x / 10.0', unit='%'),
+    Signal('socDisplay', 33, scale='int(x / 2.0)', unit='%'),
+    Signal('dcBatteryModuleTemp06', 11, signed=True, unit='C'),
+    Signal('dcBatteryModuleTemp07', 12, signed=True, unit='C'),
+    Signal('dcBatteryModuleTemp08', 13, signed=True, unit='C'),
+    Signal('dcBatteryModuleTemp09', 14, signed=True, unit='C'),
+    Signal('dcBatteryModuleTemp10', 15, signed=True, unit='C'),
+    Signal('dcBatteryModuleTemp11', 16, signed=True, unit='C'),
+    Signal('dcBatteryModuleTemp12', 17, signed=True, unit='C'),
+    Signal('dcBatteryCellVoltageDeviation', 22, scale='x / 50', unit='V'),
+    Signal('dcBatteryHeater1Temperature', 25, scale='float(x)', unit='C'),
+    Signal('dcBatteryHeater2Temperature', 26, scale='float(x)', unit='C'),
+    Signal('dcBatteryCellNoMaxDeterioration', 29),
+    Signal('dcBatteryCellNoMinDeterioration', 32),
+])
+
+CELL_VOLTAGES = SignalLayout("cell_voltages", "Cell voltages decoder.", [
+    Signal('cell_voltages', 6, count=32, scale='x / 50.0', unit='V'),
+], as_list=True)
+
+# Layouts by decoder name, to decode the response data directly (without python-OBD messages)
+LAYOUTS = {layout.name: layout for layout in (EXTERNAL_TEMPERATURE, VIN, ODOMETER, TPMS, VMCU, BMS_2101, BMS_2105,
+                                              CELL_VOLTAGES)}
+
+external_temperature = EXTERNAL_TEMPERATURE.decode
+vin = VIN.decode
+odometer = ODOMETER.decode
+tpms = TPMS.decode
+vmcu = VMCU.decode
+bms_2101 = BMS_2101.decode
+bms_2105 = BMS_2105.decode
+cell_voltages = CELL_VOLTAGES.decode
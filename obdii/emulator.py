@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+logger = logging.getLogger('emulator')
+
+ELM_VERSION = "ELM327 v1.5"
+ELM_PROMPT = b">"
+
+# ELM327 default CAN timeout (ATST32): 0x32 x 4.096 ms
+DEFAULT_TIMEOUT = 0x32
+
+
+def _payload(size, prefix, values):
+    """Build a response payload setting big-endian values: {offset: (struct format, value)}."""
+    data = bytearray(size)
+    data[:len(prefix)] = prefix
+    for offset, (fmt, value) in values.items():
+        struct.pack_into('>' + fmt, data, offset, value)
+    return bytes(data)
+
+
+def sample_responses(charging=False):
+    """Realistic response payloads of a 28 kWh Ioniq per request header and command.
+
+    Returns {request header: (response CAN ID, {command: payload})}.
+    """
+    current = -150 if charging else 85  # dA, negative when charging
+    bms_2101 = _payload(61, b'\x61\x01', {
+        6: ('B', 161),  # SOC BMS 80.5 %
+        7: ('H', 9800),  # Available charge power 98 kW
+        9: ('H', 9800),  # Available discharge power 98 kW
+        11: ('B', 0xA1 if charging else 0x01),  # Main relay (and charging, normal charge port)
+        12: ('h', current),
+        14: ('H', 3712),  # 371.2 V
+        16: ('b', 23), 17: ('b', 21),  # Max and min temperatures
+        18: ('b', 22), 19: ('b', 22), 20: ('b', 21), 21: ('b', 23), 22: ('b', 22),  # Module temps
+        25: ('B', 194), 26: ('B', 12), 27: ('B', 193), 28: ('B', 57),  # Cell max/min voltage and cell numbers
+        29: ('B', 0), 30: ('B', 0),  # Fan
+        31: ('B', 138),  # Aux battery 13.8 V
+        32: ('I', 520340), 36: ('I', 498760),  # Cumulative charge / discharge current
+        40: ('I', 196350), 44: ('I', 187930),  # Cumulative energy charged / discharged
+        48: ('I', 14383920),  # Cumulative operating time
+        52: ('B', 0x04),  # Ignition
+        55: ('h', 0 if charging else 4200),  # Motor RPM
+    })
+    bms_2105 = _payload(45, b'\x61\x05', {
+        11: ('b', 22), 12: ('b', 22), 13: ('b', 21), 14: ('b', 22), 15: ('b', 23), 16: ('b', 22), 17: ('b', 21),
+        22: ('B', 1),  # Cell voltage deviation
+        25: ('B', 21), 26: ('B', 21),  # Heaters
+        27: ('H', 1000), 29: ('B', 1),  # Max deterioration 100 % (SOH) and cell number
+        30: ('H', 995), 32: ('B', 43),  # Min deterioration and cell number
+        33: ('B', 160),  # SOC display 80 %
+    })
+    cells = [_payload(38, bytes([0x61, pid]), {6 + i: ('B', 193 + (i + pid) % 2) for i in range(32)})
+             for pid in (0x02, 0x03, 0x04)]
+    vin = bytearray(99)
+    vin[:2] = b'\x5a\x80'
+    vin[16:33] = b'KMHC751HFHU000000'
+    vmcu = _payload(22, b'\x61\x01', {
+        7: ('B', 0x01 if charging else 0x08),  # P or D
+        8: ('B', 0x02),  # Brakes off
+        15: ('B', 0x00 if charging else 0x9A), 16: ('B', 0x00 if charging else 0x0F),  # Speed (little-endian)
+    })
+    tpms = _payload(23, b'\x62\xc0\x0b', {
+        7: ('B', 191), 8: ('B', 80), 11: ('B', 191), 12: ('B', 81),
+        15: ('B', 186), 16: ('B', 79), 19: ('B', 186), 20: ('B', 80),
+    })
+    odometer = _payload(15, b'\x62\xb0\x02', {9: ('B', 0), 10: ('H', 23100)})
+    external_temperature = _payload(25, b'\x61\x80', {14: ('B', 139)})  # 29.5 C
+    pids_0100 = bytes([0x41, 0x00, 0xBE, 0x1F, 0xA8, 0x13])
+    return {
+        '7DF': ('7E8', {'0100': pids_0100}),
+        '7E0': ('7E8', {'0100': pids_0100}),
+        '7E4': ('7EC', {'2101': bms_2101, '2102': cells[0], '2103': cells[1], '2104': cells[2], '2105': bms_2105}),
+        '7E2': ('7EA', {'1A80': bytes(vin), '2101': vmcu}),
+        '7C6': ('7CE', {'22B002': odometer}),
+        '7A0': ('7A8', {'22C00B': tpms}),
+        '7E6': ('7EE', {'2180': external_temperature}),
+    }
+
+
+def can_frames(can_id, payload, padding=0xAA):
+    """Split a payload in ISO-TP (ISO 15765-2) frames, as single frame or first + consecutive frames."""
+    if len(payload) <= 7:
+        data = bytes([len(payload)]) + payload
+        return [(can_id, data + bytes([padding]) * (8 - len(data)))]
+    frames = [(can_id, bytes([0x10 | (len(payload) >> 8), len(payload) & 0xFF]) + payload[:6])]
+    sequence = 1
+    for start in range(6, len(payload), 7):
+        data = bytes([0x20 | (sequence & 0x0F)]) + payload[start:start + 7]
+        frames.append((can_id, data + bytes([padding]) * (8 - len(data))))
+        sequence += 1
+    return frames
+
+
+class ELM327Emulator(object):
+    """ELM327 adapter emulator answering on a pseudo-terminal.
+
+    Python-OBD connects to port_name exactly as it does to a real dongle. The
+    emulated vehicle answers the responses (see sample_responses) of the module
+    selected with ATSH, filtered by ATCRA/ATCF. Faults can be injected for any
+    command (or '*' for all of them) with a dict of probabilities (0 to 1):
+        {'2101': {'no_data': 0.1, 'can_error': 0.05, 'garbage': 0.01, 'delay': 0.5}}
+    where delay is extra seconds before answering. The serial line speed is
+    emulated when baudrate is given (10 bits per byte) and latency is the time
+    the vehicle takes to answer each request.
+    """
+
+    def __init__(self, responses=None, faults=None, baudrate=None, latency=0.0, seed=None):
+        self.responses = sample_responses() if responses is None else responses
+        self.faults = faults or {}
+        self.baudrate = baudrate
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.master = None
+        self.slave = None
+        self.port_name = None
+        self.thread = None
+        self.running = False
+        self.commands = 0
+        self.reset()
+
+    def reset(self):
+        self.echo = True
+        self.headers = False
+        self.spaces = True
+        self.linefeeds = False
+        self.header = '7DF'
+        self.receive_filter = None
+        self.timeout = DEFAULT_TIMEOUT
+        self.last_command = b""
+
+    def start(self):
+        """Create the pseudo-terminal and start answering in a background thread."""
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, name="elm327-emulator")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("ELM327 emulator listening on {}".format(self.port_name))
+        return self.port_name
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _serve(self):
+        buffer = b""
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            buffer += os.read(self.master, 1024)
+            while b"\r" in buffer:
+                line, buffer = buffer.split(b"\r", 1)
+                self._write(self._answer(line))
+
+    def _write(self, data):
+        if self.baudrate:
+            time.sleep(len(data) * 10.0 / self.baudrate)
+        os.write(self.master, data)
+
+    def _answer(self, line):
+        """Full adapter output (echo, response lines and prompt) for a command line."""
+        command = line.replace(b" ", b"").upper()
+        # Ignore non printable characters (i.e. the ones used by python-OBD to find the baud rate)
+        command = bytes(c for c in command if 32 < c < 127)
+        if not command:
+            command = self.last_command
+        else:
+            self.last_command = command
+        self.commands += 1
+        echo = line + b"\r" if self.echo else b""
+        if command.startswith(b"AT"):
+            lines = self._at_command(command[2:].decode())
+        else:
+            lines = self._obd_command(command.decode())
+        eol = b"\r\n" if self.linefeeds else b"\r"
+        return echo + b"".join(line.encode() + eol for line in lines) + eol + ELM_PROMPT
+
+    def _at_command(self, at):
+        if at in ("Z", "WS"):
+            self.reset()
+            return ["", ELM_VERSION]
+        if at == "D":
+            self.reset()
+        elif at == "I":
+            return [ELM_VERSION]
+        elif at == "RV":
+            return ["12.6V"]
+        elif at == "DPN":
+            return ["A6"]
+        elif at == "DP":
+            return ["AUTO, ISO 15765-4 (CAN 11/500)"]
+        elif at in ("E0", "E1"):
+            self.echo = at == "E1"
+        elif at in ("H0", "H1"):
+            self.headers = at == "H1"
+        elif at in ("S0", "S1"):
+            self.spaces = at == "S1"
+        elif at in ("L0", "L1"):
+            self.linefeeds = at == "L1"
+        elif at.startswith("SH"):
+            self.header = at[2:][-3:]
+        elif at.startswith("CRA"):
+            self.receive_filter = at[3:] or None
+        elif at.startswith("CF"):
+            self.receive_filter = at[2:]
+        elif at.startswith("ST"):
+            self.timeout = int(at[2:], 16)
+        elif not (at[:2] in ("SP", "TP", "AT", "CM") or at in ("LP", "PC", "M0", "M1", "CAF0", "CAF1")):
+            return ["?"]
+        return ["OK"]
+
+    def _obd_command(self, command):
+        can_id, pids = self.responses.get(self.header, (None, {}))
+        faults = dict(self.faults.get('*', {}))
+        faults.update(self.faults.get(command, {}))
+
+        time.sleep(self.latency + faults.get('delay', 0))
+        if self.random.random() < faults.get('can_error', 0):
+            return ["CAN ERROR"]
+        if self.random.random() < faults.get('garbage', 0):
+            return ["".join(self.random.choice("0123456789ABCDEF?<:") for _ in range(self.random.randint(1, 30)))]
+        filtered = self.receive_filter is not None and self.receive_filter != can_id
+        if command not in pids or filtered or self.random.random() < faults.get('no_data', 0):
+            # The adapter waits for the CAN timeout before giving up
+            time.sleep(self.timeout * 4.096 / 1000)
+            return ["NO DATA"]
+
+        lines = []
+        separator = " " if self.spaces else ""
+        for frame_id, data in can_frames(can_id, pids[command]):
+            values = ["{:02X}".format(byte) for byte in data]
+            if self.headers:
+                values.insert(0, frame_id)
+            lines.append(separator.join(values))
+        return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ELM327 emulator serving a pseudo-terminal.")
+    parser.add_argument('--baudrate', type=int, help="emulated serial line speed (unlimited if not set)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the vehicle takes to answer a request")
+    parser.add_argument('--charging', action='store_true', help="emulate a vehicle that is charging")
+    parser.add_argument('--no-data', type=float, default=0.0, help="probability of answering NO DATA")
+    parser.add_argument('--can-error', type=float, default=0.0, help="probability of answering CAN ERROR")
+    parser.add_argument('--garbage', type=float, default=0.0, help="probability of answering garbage")
+    parser.add_argument('--delay', type=float, default=0.0, help="extra seconds before answering")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(name)-10s %(levelname)-8s %(message)s", level=logging.INFO)
+    faults = {'*': {'no_data': args.no_data, 'can_error': args.can_error, 'garbage': args.garbage, 'delay': args.delay}}
+    emulator = ELM327Emulator(responses=sample_responses(args.charging),
+                              faults=faults,
+                              baudrate=args.baudrate,
+                              latency=args.latency)
+    port_name = emulator.start()
+    print("Set the serial port to {} in obdii_data.config.json. Press Ctrl+C to stop.".format(port_name))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+        logger.info("{} commands answered".format(emulator.commands))
+
+
+if __name__ == '__main__':
+    main()
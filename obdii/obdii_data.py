@@ -1,17 +1,44 @@
 #!/usr/bin/env python3
 
+import argparse
+import signal
 import ssl
+import sys
 import time
 import json
 import os
 import logging
 import logging.handlers
-import paho.mqtt.publish as publish
 import paho.mqtt.client as mqtt
 import obd
 from obd import OBDStatus
 
-from commands import ext_commands
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../common')
+from commands import ext_commands  # noqa: E402
+from adapter import AdapterState  # noqa: E402
+from scheduler import PollingScheduler  # noqa: E402
+from recorder import RecordingConnection, ReplayConnection  # noqa: E402
+from trips import TripDetector  # noqa: E402
+from charging import ChargeEstimator  # noqa: E402
+from power import PowerManager  # noqa: E402
+from connection_cache import ConnectionCache  # noqa: E402
+from capabilities import CapabilityMap, ECUS  # noqa: E402
+from transport import ELM327Transport  # noqa: E402
+from breaker import CircuitBreaker  # noqa: E402
+from raw_frames import RawBatch  # noqa: E402
+from store import open_store, drain_store, STORE_CYCLE_BATCHES, STORE_CYCLE_TIMEOUT  # noqa: E402
+from changes import ChangeFilter  # noqa: E402
+from payloads import PayloadEncoder  # noqa: E402
+from local_publisher import LocalPublisher  # noqa: E402
+from timeseries import open_time_series  # noqa: E402
+from metrics import Metrics  # noqa: E402
+from state import state_path  # noqa: E402
+
+
+# The cron job kills the run after 55 seconds, publishing must be done (and the store updated) before
+CRON_RUN_TIME = 50
+# Max seconds publishing the messages and the stored backlog of a run
+PUBLISH_TIMEOUT = 30
 
 
 class OBDIIConnectionError(Exception):
@@ -22,16 +49,22 @@ class CanError(Exception):
     pass
 
 
-def obd_connect(portstr, baudrate, fast=False, timeout=30, max_attempts=3):
+def obd_connect(portstr, baudrate, fast=False, timeout=30, max_attempts=3, lean=False, protocol=None):
     connection_count = 0
     obd_connection = None
     while (obd_connection is None or obd_connection.status() != OBDStatus.CAR_CONNECTED) and connection_count < max_attempts:
         connection_count += 1
         # Establish connection with OBDII dongle
-        obd_connection = obd.OBD(portstr=portstr,
-                                 baudrate=baudrate,
-                                 fast=fast,
-                                 timeout=timeout)
+        if lean:
+            obd_connection = ELM327Transport(portstr=portstr,
+                                             baudrate=baudrate,
+                                             protocol=protocol,
+                                             timeout=timeout)
+        else:
+            obd_connection = obd.OBD(portstr=portstr,
+                                     baudrate=baudrate,
+                                     fast=fast,
+                                     timeout=timeout)
         if (obd_connection is None or obd_connection.status() != OBDStatus.CAR_CONNECTED) and connection_count < max_attempts:
             logger.warning("{}. Retrying in {} second(s)...".format(obd_connection.status(), connection_count))
             time.sleep(connection_count)
@@ -42,37 +75,293 @@ def obd_connect(portstr, baudrate, fast=False, timeout=30, max_attempts=3):
         return obd_connection
 
 
+def vehicle_connect(config, metrics=None, power=None, cache=None):
+    """Connect to the vehicle (or to a recorded session when replaying) recording the session if configured.
+
+    When metrics are given, the connection setup time is measured and the
+    metrics are attached to the connection to instrument its queries.
+
+    When the power manager says the car is asleep, only one short connection
+    attempt is made (probe).
+
+    When a connection cache is given, the cached adapter settings are tried
+    first (fast path) and the full detection is only done when it fails. The
+    time from the start of the connection to the first valid response is
+    reported by query_command.
+
+    With the lean serial transport, the ELM327 is queried directly (see
+    transport.py) with the cached baud rate and protocol when there are.
+
+    When raw batches are configured, the connection keeps the data of the
+    responses for them.
+    """
+    start = time.monotonic()
+    path = "replay"
+    try:
+        replay = config.get('replay')
+        if replay:
+            connection = ReplayConnection(replay['path'], realtime=replay.get('realtime', True))
+        else:
+            probe = power is not None and power.sleeping
+            timeout = power.probe_timeout if probe else 30
+            port = config['serial']['port']
+            baudrate = config['serial'].get('baudrate')
+            baudrate = None if baudrate in (None, "auto") else int(baudrate)
+            lean = config['serial'].get('transport') == "lean"
+            connection = None
+            if lean:
+                path = "lean"
+                settings = cache.fast_settings(port) if cache is not None else None
+                connection = obd_connect(portstr=port,
+                                         baudrate=baudrate or (settings['baudrate'] if settings else None),
+                                         timeout=timeout,
+                                         max_attempts=1 if probe else 3,
+                                         lean=True,
+                                         protocol=settings['protocol'] if settings else None)
+            elif cache is not None:
+                path = "fast"
+                connection = cache.connect(port, timeout)
+                if connection is not None and connection.status() != OBDStatus.CAR_CONNECTED:
+                    status = connection.status()
+                    logger.warning("Fast connection failed ({})".format(status))
+                    connection.close()
+                    connection = None
+                    if probe:
+                        # The car is likely still asleep, no need to detect everything again
+                        raise OBDIIConnectionError(status)
+            if connection is None:
+                path = "full"
+                connection = obd_connect(portstr=port,
+                                         baudrate=baudrate,
+                                         fast=False,
+                                         timeout=timeout,
+                                         max_attempts=1 if probe else 3)
+                if cache is not None:
+                    cache.save(connection, port, baudrate)
+    except OBDIIConnectionError:
+        if metrics is not None:
+            metrics.inc('obdii_connect_failures_total', path=path)
+        raise
+    finally:
+        if metrics is not None:
+            metrics.observe('obdii_connect_duration_seconds', time.monotonic() - start, path=path)
+    logger.info("Connected ({} path) in {:.3f} second(s)".format(path, time.monotonic() - start))
+    if config.get('raw') and hasattr(connection, 'keep_data'):
+        # The lean transport only keeps the response data when asked
+        connection.keep_data = True
+    record = config.get('record')
+    if record:
+        connection = RecordingConnection(connection, record['path'])
+    connection.metrics = metrics
+    connection.connect_start = start
+    connection.connect_path = path
+    return connection
+
+
+def invalid_reason(response):
+    """Why a query response is not valid: null, ? or empty (None when it's valid)."""
+    if response is None or response.is_null() or response.value is None:
+        return "null"
+    if response.value == "?":
+        return "?"
+    if response.value == "":
+        return "empty"
+    return None
+
+
+def response_data(response):
+    """Message data of a valid response (lean transport or python-OBD), as bytes."""
+    data = getattr(response, 'data', None)
+    if data is None:
+        data = bytes(response.messages[0].data)
+    return data
+
+
 def query_command(connection, command, max_attempts=3):
+    metrics = getattr(connection, 'metrics', None)
+    # Answer from the scheduler cache when the command is not due yet
+    scheduler = getattr(connection, 'scheduler', None)
+    if scheduler is not None:
+        cached_response = scheduler.cached(command.name)
+        if cached_response is not None:
+            logger.debug("Using cached response for command: {} ".format(command))
+            if metrics is not None:
+                metrics.inc('obdii_command_cached_total', command=command.name)
+            return cached_response
+
+    # Fail at once when the ECU the adapter points to isn't answering (adapter AT commands always go)
+    breaker = getattr(connection, 'breaker', None)
+    adapter_state = getattr(connection, 'adapter_state', None)
+    header = adapter_state.header if adapter_state is not None and not command.command.startswith(b"AT") else None
+    if breaker is not None and header is not None:
+        rejected = breaker.rejected(header, command.name)
+        if rejected is not None:
+            if metrics is not None:
+                metrics.inc('obdii_command_rejected_total', command=command.name, reason=rejected)
+            raise ValueError("No valid response for {}. ECU {} not answering ({})."
+                             .format(command, header, "circuit open" if rejected == "open" else "recent failure cached"))
+        if breaker.probing(header):
+            max_attempts = 1
+
     command_count = 0
-    cmd_response = None
-    exception = False
     valid_response = False
     while not valid_response and command_count < max_attempts:
         command_count += 1
+        cmd_response = None
+        start = time.monotonic()
         try:
             cmd_response = connection.query(command, force=True)
+            reason = invalid_reason(cmd_response)
         except Exception:
-            exception = True
-        valid_response = not(cmd_response is None or cmd_response.is_null() or cmd_response.value is None or cmd_response.value == "?" or cmd_response.value == "" or exception)
+            reason = "exception"
+        valid_response = reason is None
+        if metrics is not None:
+            metrics.observe('obdii_command_duration_seconds', time.monotonic() - start, command=command.name)
+            if not valid_response:
+                metrics.inc('obdii_command_invalid_total', command=command.name, reason=reason)
         if not valid_response and command_count < max_attempts:
-            logger.warning("No valid response for {}. Retrying in {} second(s)...".format(command, command_count))
+            logger.warning("No valid response for {} ({}). Retrying in {} second(s)...".format(command, reason, command_count))
+            if metrics is not None:
+                metrics.inc('obdii_command_retries_total', command=command.name)
+                metrics.inc('obdii_command_retry_sleep_seconds_total', command_count, command=command.name)
             time.sleep(command_count)
 
     if not valid_response:
+        if metrics is not None:
+            metrics.inc('obdii_command_failures_total', command=command.name)
+        if breaker is not None and header is not None:
+            breaker.failure(header, command.name)
         raise ValueError("No valid response for {}. Max attempts ({}) exceeded."
                          .format(command, max_attempts))
     else:
         logger.info("Got response from command: {} ".format(command))
+        if breaker is not None and header is not None:
+            breaker.success(header, command.name)
+        connect_start = getattr(connection, 'connect_start', None)
+        if connect_start is not None and not command.command.startswith(b"AT"):
+            # First vehicle response since connecting (adapter AT commands don't count)
+            connection.connect_start = None
+            first_response = time.monotonic() - connect_start
+            logger.info("First response {:.3f} second(s) after connecting ({} path)"
+                        .format(first_response, connection.connect_path))
+            if metrics is not None:
+                metrics.observe('obdii_first_response_seconds', first_response, path=connection.connect_path)
+        raw = getattr(connection, 'raw', None)
+        if raw is not None and not command.command.startswith(b"AT"):
+            raw.add(command.name, cmd_response.time, response_data(cmd_response))
+        if scheduler is not None:
+            scheduler.record(command.name, cmd_response)
         return cmd_response
 
 
-def query_battery_info(connection, battery_capacity):
+def probe_vehicle(connection, power):
+    """Query the BMS once, without retries nor cached responses, to update the power state.
+
+    Returns True when the car is awake (ignition on or charging).
+    """
+    logger.info("**** Probing the car ****")
+    try:
+        set_can_module(connection, header="7E4", receive_address="7EC")
+        response = connection.query(ext_commands["BMS_2101"], force=True)
+        reason = invalid_reason(response)
+    except (ValueError, CanError):
+        reason = "exception"
+    if reason is not None:
+        logger.info("Car asleep: no valid response to the probe ({})".format(reason))
+        power.unanswered()
+    else:
+        power.update(response.value)
+    return not power.sleeping
+
+
+def discover_capabilities(connection, capabilities):
+    """Probe every command of the known ECUs and store the supported ones in the capability map by VIN.
+
+    All the ECUs only answer with the ignition on, so the discovery is left
+    for later (returning False) when it's off.
+    """
+    logger.info("**** Discovering supported commands ****")
+    try:
+        set_can_module(connection, header="7E4", receive_address="7EC")
+        if not query_command(connection, ext_commands["BMS_2101"]).value['bmsIgnition']:
+            logger.info("Discovery postponed: the ignition is off")
+            return False
+        set_can_module(connection, header="7E2", receive_address="7EA")
+        vin = query_command(connection, ext_commands["VIN_1A80"]).value['vin']
+    except (ValueError, CanError) as err:
+        logger.warning("Discovery postponed: {}".format(err))
+        return False
+    commands = {}
+    # Every command gets all its attempts, an ECU the circuit breaker considers asleep isn't unsupported
+    breaker = getattr(connection, 'breaker', None)
+    connection.breaker = None
+    try:
+        for header, receive_address, can_filter, command_names in ECUS:
+            set_can_module(connection, header, receive_address, can_filter)
+            for name in command_names:
+                try:
+                    query_command(connection, ext_commands[name])
+                    commands[name] = True
+                except (ValueError, CanError):
+                    commands[name] = False
+    finally:
+        connection.breaker = breaker
+    capabilities.discovered(vin, commands)
+    return True
+
+
+def set_can_module(connection, header, receive_address=None, can_filter=None):
+    """Point the adapter to a CAN module sending only the AT commands that change its state."""
+    adapter_state = getattr(connection, 'adapter_state', None)
+    if adapter_state is None:
+        adapter_state = AdapterState()
+        connection.adapter_state = adapter_state
+    for command_name in adapter_state.pending_commands(header, receive_address, can_filter):
+        adapter_state.invalidate(command_name)
+        query_command(connection, ext_commands[command_name])
+        adapter_state.applied(command_name)
+
+
+def query_raw(connection, command_names):
+    """Query the commands of a module only for the raw batch (query_command adds their responses to it).
+
+    No topic info is built: the values of the responses decoded as dicts are
+    just merged (i.e. bmsIgnition and charging of BMS 2101 for the power
+    manager or the vin for the capability map).
+    """
+    for header, receive_address, can_filter, names in ECUS:
+        if command_names[0] in names:
+            set_can_module(connection, header, receive_address, can_filter)
+    values = {}
+    for name in command_names:
+        value = query_command(connection, ext_commands[name]).value
+        if isinstance(value, dict):
+            values.update(value)
+    return values
+
+
+def open_analytics(analytics_config):
+    """Create the pack analytics from the 'analytics' config section (None when not configured).
+
+    battery.py (and NumPy) is only imported when they are configured, so it's
+    not needed (nor its import time paid on every cron run) otherwise.
+    """
+    if not analytics_config:
+        return None
+    from battery import PackAnalytics
+    return PackAnalytics.from_config(analytics_config)
+
+
+def query_battery_info(connection, battery_capacity, estimate_charge=True):
+    """Query the BMS and build the battery information.
+
+    When estimate_charge is False (a charge estimator provides it), the
+    minutes to complete the charge are not estimated from the sample.
+    """
     logger.info("**** Querying battery information ****")
     battery_info = {}
-    # Set header to 7E4
-    query_command(connection, ext_commands["CAN_HEADER_7E4"])
-    # Set the CAN receive address to 7EC
-    query_command(connection, ext_commands["CAN_RECEIVE_ADDRESS_7EC"])
+    # Set header to 7E4 and the CAN receive address to 7EC
+    set_can_module(connection, header="7E4", receive_address="7EC")
 
     # 2101 - 2105 codes to get battery status information
     bms_2101_resp = query_command(connection, ext_commands["BMS_2101"])
@@ -100,22 +389,25 @@ def query_battery_info(connection, battery_capacity):
 
         # Calculate time to fully charge (only when charging)
         if charging == 1:
-            average_deterioration = (battery_cell_max_deterioration + battery_cell_min_deterioration) / 2.0
-            lost_soh = 100 - average_deterioration
-            lost_wh = ((battery_capacity * 1000) * lost_soh) / 100
-            remaining_pct = 100 - soc_display
-            remaining_wh = (((battery_capacity * 1000) - lost_wh) * remaining_pct) / 100
+            mins_to_complete = None
             charge_power = abs((battery_current * battery_voltage))
-            mins_to_complete = int((remaining_wh / charge_power) * 60)
-
-        battery_info.update({'timestamp': int(round(bms_2105_resp.time))})
+            # No charging power (i.e. the charge is paused), the time can't be estimated
+            if estimate_charge and charge_power > 0:
+                average_deterioration = (battery_cell_max_deterioration + battery_cell_min_deterioration) / 2.0
+                lost_soh = 100 - average_deterioration
+                lost_wh = ((battery_capacity * 1000) * lost_soh) / 100
+                remaining_pct = 100 - soc_display
+                remaining_wh = (((battery_capacity * 1000) - lost_wh) * remaining_pct) / 100
+                mins_to_complete = int((remaining_wh / charge_power) * 60)
+
+        battery_info.update({'timestamp': int(round(bms_2101_resp.time))})
         battery_info.update({'minsToCompleteCharge': mins_to_complete})
         battery_info.update(bms_2101_resp.value)
         battery_info.update(bms_2105_resp.value)
 
         # Battery average temperature
         module_temps = []
-        for i in range(1, 12):
+        for i in range(1, 13):
             module_temps.append(battery_info["dcBatteryModuleTemp{:02d}".format(i)])
         battery_info.update({'dcBatteryAvgTemperature': round(sum(module_temps) / len(module_temps), 1)})
 
@@ -140,12 +432,8 @@ def query_battery_info(connection, battery_capacity):
 def query_odometer_info(connection):
     logger.info("**** Querying odometer ****")
     odometer_info = {}
-    # Set header to 7C6
-    query_command(connection, ext_commands["CAN_HEADER_7C6"])
-    # Set the CAN receive address to 7EC
-    query_command(connection, ext_commands["CAN_RECEIVE_ADDRESS_7EC"])
-    # Sets the ID filter to 7CE
-    query_command(connection, ext_commands["CAN_FILTER_7CE"])
+    # Set header to 7C6, the CAN receive address to 7EC and the ID filter to 7CE
+    set_can_module(connection, header="7C6", receive_address="7EC", can_filter="7CE")
     # Query odometer
     odometer_resp = query_command(connection, ext_commands["ODOMETER_22B002"])
 
@@ -164,10 +452,8 @@ def query_odometer_info(connection):
 def query_vmcu_info(connection):
     logger.info("**** Querying VMCU ****")
     vmcu_info = {}
-    # Set header to 7E2
-    query_command(connection, ext_commands["CAN_HEADER_7E2"])
-    # Set the CAN receive address to 7EA
-    query_command(connection, ext_commands["CAN_RECEIVE_ADDRESS_7EA"])
+    # Set header to 7E2 and the CAN receive address to 7EA
+    set_can_module(connection, header="7E2", receive_address="7EA")
 
     # VIN
     vin_resp = query_command(connection, ext_commands["VIN_1A80"])
@@ -189,10 +475,8 @@ def query_vmcu_info(connection):
 def query_tpms_info(connection):
     logger.info("**** Querying for TPMS information ****")
     tpms_info = {}
-    # Set header to 7A0
-    query_command(connection, ext_commands["CAN_HEADER_7A0"])
-    # Set the CAN receive address to 7A8
-    query_command(connection, ext_commands["CAN_RECEIVE_ADDRESS_7A8"])
+    # Set header to 7A0 and the CAN receive address to 7A8
+    set_can_module(connection, header="7A0", receive_address="7A8")
     # Query TPMS
     tpms_22c00b_resp = query_command(connection, ext_commands["TPMS_22C00B"])
 
@@ -209,10 +493,8 @@ def query_tpms_info(connection):
 def query_external_temperature_info(connection):
     logger.info("**** Querying for external temperature ****")
     external_temperature_info = {}
-    # Set header to 7E6
-    query_command(connection, ext_commands["CAN_HEADER_7E6"])
-    # Set the CAN receive address to 7EC
-    query_command(connection, ext_commands["CAN_RECEIVE_ADDRESS_7EE"])
+    # Set header to 7E6 and the CAN receive address to 7EE
+    set_can_module(connection, header="7E6", receive_address="7EE")
     # Query external temeprature
     ext_temp_resp = query_command(connection, ext_commands["EXT_TEMP_2180"])
 
@@ -234,143 +516,308 @@ def publish_data_mqtt(msgs,
                       user,
                       password,
                       keepalive=60,
-                      will=None):
-    """Publish all messages to MQTT."""
+                      will=None,
+                      store=None,
+                      deadline=None):
+    """Publish all messages to MQTT with a single connection, done by the deadline (monotonic time).
+
+    When a message store is given, messages that can't be published (or
+    aren't acknowledged by the deadline) are stored, and the stored backlog is
+    published with the same connection in the time left. Without deadline,
+    publishing takes up to PUBLISH_TIMEOUT seconds.
+    """
+    deadline = time.monotonic() + PUBLISH_TIMEOUT if deadline is None else deadline
+    logger.info("Publish messages to MQTT")
+    for msg in msgs:
+        logger.info("{}".format(msg))
+    mqtt_client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv311, transport="tcp")
+    mqtt_client.tls_set(tls_version=ssl.PROTOCOL_TLS)
+    mqtt_client.username_pw_set(user, password)
+    mqtt_client.enable_logger(logger)
+    if will is not None:
+        mqtt_client.will_set(**will)
     try:
-        logger.info("Publish messages to MQTT")
-        for msg in msgs:
-            logger.info("{}".format(msg))
-
-        publish.multiple(msgs,
-                         hostname=hostname,
-                         port=port,
-                         client_id=client_id,
-                         keepalive=keepalive,
-                         will=will,
-                         auth={'username': user, 'password': password},
-                         tls={'tls_version': ssl.PROTOCOL_TLS},
-                         protocol=mqtt.MQTTv311,
-                         transport="tcp"
-                         )
-        logger.info("{} message(s) published to MQTT".format(len(msgs)))
+        # The connection (and TLS handshake) timeout is the keepalive, so it never takes longer than the time left
+        mqtt_client.connect(hostname, port, max(1, int(min(keepalive, deadline - time.monotonic()))))
     except Exception as err:
         logger.error("Error publishing to MQTT: {}".format(err), exc_info=False)
+        if store is not None:
+            store.put(msgs)
+        return
+    mqtt_client.loop_start()
+    try:
+        while not mqtt_client.is_connected() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        results = [mqtt_client.publish(topic=msg['topic'], payload=msg['payload'], qos=msg['qos'], retain=msg['retain'])
+                   for msg in msgs]
+        unpublished = []
+        for msg, result in zip(msgs, results):
+            while result.rc == mqtt.MQTT_ERR_SUCCESS and not result.is_published() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS or not result.is_published():
+                unpublished.append(msg)
+        logger.info("{} message(s) published to MQTT".format(len(msgs) - len(unpublished)))
+        if unpublished:
+            logger.error("Error publishing to MQTT: {} message(s) not published in time".format(len(unpublished)), exc_info=False)
+            if store is not None:
+                store.put(unpublished)
+        elif store is not None:
+            # Broker is reachable, publish the backlog in the time left
+            drain_store(mqtt_client, store, deadline=deadline)
+    finally:
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()
+
+
+def state_message(topic_prefix):
+    """Build the MQTT message telling that the script is running."""
+    state_info = {
+        'timestamp': int(round(time.time())),
+        'state': 'running'
+    }
+    return {'topic': topic_prefix + "state",
+            'payload': json.dumps(state_info),
+            'qos': 0,
+            'retain': True}
+
+
+def query_data(connection, config, topic_prefix, reverse=False, deadline=None, time_series=None, stop=None, trips=None,
+               analytics=None, charge_estimator=None, power=None, capabilities=None):
+    """Query all vehicle information and return the MQTT messages to publish.
+
+    Queries are sorted so that modules sharing CAN settings go one after the
+    other (battery and odometer both use the 7EC receive address). When
+    reverse is True the order is inverted, so a service alternating it on
+    every cycle starts with the module the adapter is already pointing to.
+
+    When the connection has a polling scheduler, modules without due commands
+    are skipped, the rest are queried by priority and the ones that didn't
+    start before the deadline (monotonic time) are left for the next cycle.
+
+    When a time series is given, the values of each topic are appended to it.
+    When a trip detector is given, it's updated with the values of each topic.
+    When pack analytics are given, the battery values are analysed and their
+    messages follow the battery one.
+    When a charge estimator is given, its estimation replaces the battery
+    minsToCompleteCharge and the charging message follows the battery one.
+    When a power manager is given, its state is updated with the battery
+    values (or the lack of them).
+    When a capability map is given, modules with commands not supported by
+    the vehicle are skipped and the VIN of the vmcu values identifies it.
+
+    When the connection has a raw batch, its messages are added once due. When
+    the batch is raw only (not decoded), the modules are queried with
+    query_raw and only the power manager and the capability map get their
+    values: no topic message is built nor the rest of consumers updated.
+
+    When the stop event (threading.Event) is set, the modules not queried yet
+    are left out (i.e. the agent is shutting down).
+    """
+    queries = [("battery", "battery information", ["BMS_2101", "BMS_2102", "BMS_2103", "BMS_2104", "BMS_2105"],
+                lambda: query_battery_info(connection, config['vehicle']['battery_capacity'], charge_estimator is None)),
+               ("odometer", "odometer", ["ODOMETER_22B002"],
+                lambda: query_odometer_info(connection)),
+               ("vmcu", "vmcu information", ["VIN_1A80", "VMCU_2101"],
+                lambda: query_vmcu_info(connection)),
+               ("tpms", "tpms information", ["TPMS_22C00B"],
+                lambda: query_tpms_info(connection)),
+               ("ext_temp", "external temperature information", ["EXT_TEMP_2180"],
+                lambda: query_external_temperature_info(connection))]
+    raw = getattr(connection, 'raw', None)
+    if raw is not None and not raw.decoded:
+        queries = [(topic, description, command_names, lambda command_names=command_names: query_raw(connection, command_names))
+                   for topic, description, command_names, query in queries]
+    if reverse:
+        queries.reverse()
+
+    if capabilities is not None:
+        for query in queries:
+            if not capabilities.supported(query[2]):
+                logger.debug("Not querying {}: not supported by the vehicle".format(query[1]))
+        queries = [query for query in queries if capabilities.supported(query[2])]
+
+    scheduler = getattr(connection, 'scheduler', None)
+    if scheduler is not None:
+        queries = [query for query in queries if scheduler.due_priority(query[2]) is not None]
+        queries.sort(key=lambda query: scheduler.due_priority(query[2]))
 
-
-def main():
-    console_handler = logging.StreamHandler()  # sends output to stderr
-    console_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-10s %(levelname)-8s %(message)s"))
-    console_handler.setLevel(logging.DEBUG)
-    logger.addHandler(console_handler)
-
-    file_handler = logging.handlers.TimedRotatingFileHandler(os.path.dirname(os.path.realpath(__file__)) + '/../obdii_data.log',
-                                                             when='midnight',
-                                                             backupCount=15
-                                                             )  # sends output to obdii_data.log file rotating it at midnight and storing latest 15 days
-    file_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-10s %(levelname)-8s %(message)s"))
-    file_handler.setLevel(logging.INFO)
-    logger.addHandler(file_handler)
-
-    logger.setLevel(logging.DEBUG)
-
-    obd.logger.setLevel(obd.logging.DEBUG)
-    # Remove obd logger existing handlers
-    for handler in obd.logger.handlers[:]:
-        obd.logger.removeHandler(handler)
-    # Add handlers to obd logger
-    obd.logger.addHandler(console_handler)
-    obd.logger.addHandler(file_handler)
-
-    with open(os.path.dirname(os.path.realpath(__file__)) + '/obdii_data.config.json') as config_file:
-        config = json.loads(config_file.read())
-
+    mqtt_msgs = []
+    for index, (topic, description, command_names, query) in enumerate(queries):
+        if stop is not None and stop.is_set():
+            logger.info("Stop requested, not querying {}".format(", ".join(skipped[0] for skipped in queries[index:])))
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            logger.warning("Scheduler cannot keep up: cycle out of time, deferring {} to next cycle"
+                           .format(", ".join(deferred[0] for deferred in queries[index:])))
+            break
+        try:
+            info = query()
+            if power is not None and topic == "battery":
+                power.update(info)
+            if capabilities is not None and topic == "vmcu":
+                capabilities.identify(info['vin'])
+            if raw is not None and not raw.decoded:
+                continue
+            charging_info = None
+            if charge_estimator is not None and topic == "battery":
+                charging_info = charge_estimator.update(info)
+                if charging_info is not None:
+                    info['minsToCompleteCharge'] = charging_info.get('minsToCompleteCharge')
+            if time_series is not None:
+                time_series.append_values(topic, info)
+            if trips is not None:
+                trips.update(topic, info)
+            # Add information to MQTT messages array
+            mqtt_msgs.extend([{'topic': topic_prefix + topic,
+                               'payload': json.dumps(info),
+                               'qos': 0,
+                               'retain': True}])
+            if analytics is not None and topic == "battery":
+                mqtt_msgs.extend(analytics.messages(info, topic_prefix))
+            if charging_info is not None:
+                mqtt_msgs.append({'topic': topic_prefix + "charging",
+                                  'payload': json.dumps(charging_info),
+                                  'qos': 0,
+                                  'retain': True})
+        except (ValueError, CanError) as err:
+            logger.warning("**** Error querying {}: {} ****"
+                           .format(description, err), exc_info=False)
+            if power is not None and topic == "battery":
+                power.unanswered()
+
+    if raw is not None:
+        mqtt_msgs.extend(raw.messages(topic_prefix + "raw"))
+    return mqtt_msgs
+
+
+def mqtt_connect(hostname,
+                 port,
+                 client_id,
+                 user,
+                 password,
+                 keepalive=60):
+    """Create a long-lived MQTT client that connects (and reconnects) in the background."""
+    mqtt_client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv311, transport="tcp")
+    mqtt_client.tls_set(tls_version=ssl.PROTOCOL_TLS)
+    mqtt_client.username_pw_set(user, password)
+    mqtt_client.enable_logger(logger)
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=60)
+    mqtt_client.connect_async(hostname, port, keepalive)
+    mqtt_client.loop_start()
+    return mqtt_client
+
+
+def publish_data_client(mqtt_client, msgs, store=None):
+    """Publish all messages using an already created MQTT client.
+
+    When a message store is given, messages that can't be published are stored
+    and any stored backlog is published while the client is connected.
+    """
+    logger.info("Publish messages to MQTT")
+    published = 0
+    failed = []
+    for msg in msgs:
+        logger.info("{}".format(msg))
+        result = mqtt_client.publish(topic=msg['topic'],
+                                     payload=msg['payload'],
+                                     qos=msg['qos'],
+                                     retain=msg['retain'])
+        if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            published += 1
+        else:
+            logger.error("Error publishing to MQTT: {}".format(mqtt.error_string(result.rc)), exc_info=False)
+            failed.append(msg)
+    logger.info("{} message(s) published to MQTT".format(published))
+
+    if store is not None:
+        if failed:
+            store.put(failed)
+        elif mqtt_client.is_connected() and len(store) > 0:
+            drain_store(mqtt_client, store, timeout=STORE_CYCLE_TIMEOUT, max_batches=STORE_CYCLE_BATCHES)
+
+
+def publish_data_local(local_publisher, msgs, store=None):
+    """Hand all messages to the local publisher service.
+
+    When a message store is given, messages that can't be handed over are stored
+    and any stored backlog is handed over once the publisher service is available.
+    """
+    failed = local_publisher.publish(msgs)
+    logger.info("{} message(s) sent to the local publisher".format(len(msgs) - len(failed)))
+    if store is not None:
+        if failed:
+            store.put(failed)
+        elif len(store) > 0:
+            local_publisher.forward_store(store, max_batches=STORE_CYCLE_BATCHES)
+
+
+def run_once(config):
+    """Query the vehicle once and publish the data (one run per cron execution).
+
+    When power is configured, runs before the next poll of the current power
+    state (i.e. while the car is asleep) exit without connecting.
+    """
     broker_address = config['mqtt']['broker']
     port = int(config['mqtt']['port'])
     user = config['mqtt']['user']
     password = config['mqtt']['password']
     topic_prefix = config['mqtt']['topic_prefix']
 
+    start = time.time()
+    run_deadline = time.monotonic() + CRON_RUN_TIME
+    metrics_config = config.get('metrics')
+    metrics = Metrics() if metrics_config else None
+    # Counters and histograms keep adding up across runs
+    metrics_path = state_path(metrics_config.get('path'), os.path.dirname(os.path.realpath(__file__))) if metrics_config else None
+    if metrics is not None:
+        metrics.load(metrics_path)
+    power = PowerManager.from_config(config.get('power'), os.path.dirname(os.path.realpath(__file__)), metrics)
+    if power is not None and not power.due(start):
+        logger.info("Power state {}: next poll in {:.0f} second(s)".format(power.state, power.next_poll - start))
+        return
+
     mqtt_msgs = []
+    store = open_store(config.get('store'), os.path.dirname(os.path.realpath(__file__)))
+    encoder = PayloadEncoder.from_config(config.get('encoding'), topic_prefix)
+    time_series = open_time_series(config.get('timeseries'), os.path.dirname(os.path.realpath(__file__)))
+    trips = TripDetector.from_config(config.get('trips'), os.path.dirname(os.path.realpath(__file__)))
+    analytics = open_analytics(config.get('analytics'))
+    if analytics is not None and time_series is not None:
+        analytics.seed(time_series)
+    charge_estimator = ChargeEstimator.from_config(config.get('charging'), config['vehicle']['battery_capacity'],
+                                                   os.path.dirname(os.path.realpath(__file__)))
+    cache = ConnectionCache.from_config(config.get('connection_cache'), os.path.dirname(os.path.realpath(__file__)))
+    capabilities = CapabilityMap.from_config(config.get('capabilities'), os.path.dirname(os.path.realpath(__file__)))
+    breaker = CircuitBreaker.from_config(config.get('breaker'), os.path.dirname(os.path.realpath(__file__)), metrics)
+    raw = RawBatch.from_config(config.get('raw'))
 
     try:
         logger.info("=== Script start ===")
 
         # Add state data to messages array
-        state_info = {
-            'timestamp': int(round(time.time())),
-            'state': 'running'
-        }
-        mqtt_msgs.extend([{'topic': topic_prefix + "state",
-                           'payload': json.dumps(state_info),
-                           'qos': 0,
-                           'retain': True}]
-                         )
-
-        connection = obd_connect(portstr=config['serial']['port'],
-                                 baudrate=int(config['serial']['baudrate']),
-                                 fast=False,
-                                 timeout=30)
+        mqtt_msgs.append(state_message(topic_prefix))
+
+        connection = vehicle_connect(config, metrics, power, cache)
+        connection.breaker = breaker
+        connection.raw = raw
 
         # Print supported commands
         # DTC = Diagnostic Trouble Codes
         # MIL = Malfunction Indicator Lamp
         logger.debug(connection.print_commands())
 
-        try:
-            # Add battery information to MQTT messages array
-            mqtt_msgs.extend([{'topic': topic_prefix + "battery",
-                               'payload': json.dumps(query_battery_info(connection, config['vehicle']['battery_capacity'])),
-                               'qos': 0,
-                               'retain': True}])
-        except (ValueError, CanError) as err:
-            logger.warning("**** Error querying battery information: {} ****"
-                           .format(err), exc_info=False)
-
-        try:
-            # Add VMCU information to MQTT messages array
-            mqtt_msgs.extend([{'topic': topic_prefix + "vmcu",
-                               'payload': json.dumps(query_vmcu_info(connection)),
-                               'qos': 0,
-                               'retain': True}])
-        except (ValueError, CanError) as err:
-            logger.warning("**** Error querying vmcu information: {} ****"
-                           .format(err), exc_info=False)
-
-        try:
-            # Add Odometer to MQTT messages array
-            mqtt_msgs.extend([{'topic': topic_prefix + "odometer",
-                               'payload': json.dumps(query_odometer_info(connection)),
-                               'qos': 0,
-                               'retain': True}])
-        except (ValueError, CanError) as err:
-            logger.warning("**** Error querying odometer: {} ****".format(err),
-                           exc_info=False)
-
-        try:
-            # Add TPMS information to MQTT messages array
-            mqtt_msgs.extend([{'topic': topic_prefix + "tpms",
-                               'payload': json.dumps(query_tpms_info(connection)),
-                               'qos': 0,
-                               'retain': True}])
-        except (ValueError, CanError) as err:
-            logger.warning("**** Error querying tpms information: {} ****"
-                           .format(err),
-                           exc_info=False)
-
-        try:
-            # Add external temperture information to MQTT messages array
-            mqtt_msgs.extend([{'topic': topic_prefix + "ext_temp",
-                               'payload': json.dumps(query_external_temperature_info(connection)),
-                               'qos': 0,
-                               'retain': True}])
-        except (ValueError, CanError) as err:
-            logger.warning("**** Error querying external temperature information: {} ****"
-                           .format(err),
-                           exc_info=False)
+        if power is None or not power.sleeping or probe_vehicle(connection, power):
+            if capabilities is not None and (config.get('discover') or capabilities.needs_discovery()):
+                discover_capabilities(connection, capabilities)
+            mqtt_msgs.extend(query_data(connection, config, topic_prefix, time_series=time_series, trips=trips,
+                                        analytics=analytics, charge_estimator=charge_estimator, power=power,
+                                        capabilities=capabilities))
 
     except OBDIIConnectionError as err:
         logger.error("OBDII connection error: {0}".format(err),
                      exc_info=False)
+        if power is not None:
+            power.unanswered()
     except ValueError as err:
         logger.error("Error found: {0}".format(err),
                      exc_info=False)
@@ -381,17 +828,261 @@ def main():
         logger.error("Unexpected error: {}".format(ex),
                      exc_info=True)
     finally:
-        publish_data_mqtt(msgs=mqtt_msgs,
-                          hostname=broker_address,
-                          port=port,
-                          client_id="battery-data-script",
-                          user=user,
-                          password=password)
+        if power is not None:
+            power.schedule(start)
+        if breaker is not None:
+            breaker.save()
+        if raw is not None:
+            # Nothing is kept between runs, the frames not published yet go now
+            mqtt_msgs.extend(raw.messages(topic_prefix + "raw", force=True))
+        if trips is not None:
+            # Also when the car didn't answer, the trip ends when it's off
+            trip_msg = trips.end_message(topic_prefix + "trip")
+            if trip_msg is not None:
+                mqtt_msgs.append(trip_msg)
+        if metrics is not None:
+            mqtt_msgs.append(metrics.message(topic_prefix + "metrics"))
+        if encoder is not None:
+            mqtt_msgs = encoder.encode(mqtt_msgs)
+        publish_start = time.monotonic()
+        if config.get('publisher'):
+            # No need to wait for a new MQTT connection, the publisher service has one
+            local_publisher = LocalPublisher(config['publisher']['socket'])
+            publish_data_local(local_publisher, mqtt_msgs, store)
+            local_publisher.close()
+        else:
+            publish_data_mqtt(msgs=mqtt_msgs,
+                              hostname=broker_address,
+                              port=port,
+                              client_id="battery-data-script",
+                              user=user,
+                              password=password,
+                              store=store,
+                              deadline=min(run_deadline, time.monotonic() + PUBLISH_TIMEOUT))
+        if metrics is not None:
+            metrics.observe('mqtt_publish_duration_seconds', time.monotonic() - publish_start)
+            if metrics_path is not None:
+                metrics.save(metrics_path)
+            if metrics_config.get('textfile'):
+                metrics.write_textfile(metrics_config['textfile'])
+        if store is not None:
+            store.close()
+        if time_series is not None:
+            time_series.close()
         if 'connection' in locals() and connection is not None:
             connection.close()
         logger.info("===  Script end  ===")
 
 
+def run_service(config):
+    """Keep querying the vehicle every service interval reusing OBDII and MQTT connections.
+
+    When power is configured, the interval is the one of the current power
+    state and the car is only probed while it's asleep.
+    """
+    topic_prefix = config['mqtt']['topic_prefix']
+    interval = float(config.get('service', {}).get('interval', 10))
+
+    mqtt_client = None
+    local_publisher = None
+    if config.get('publisher'):
+        local_publisher = LocalPublisher(config['publisher']['socket'])
+    else:
+        mqtt_client = mqtt_connect(hostname=config['mqtt']['broker'],
+                                   port=int(config['mqtt']['port']),
+                                   client_id="battery-data-service",
+                                   user=config['mqtt']['user'],
+                                   password=config['mqtt']['password'])
+    store = open_store(config.get('store'), os.path.dirname(os.path.realpath(__file__)))
+    change_filter = ChangeFilter.from_config(config.get('changes'))
+    encoder = PayloadEncoder.from_config(config.get('encoding'), topic_prefix)
+    time_series = open_time_series(config.get('timeseries'), os.path.dirname(os.path.realpath(__file__)))
+    metrics_config = config.get('metrics')
+    metrics = Metrics() if metrics_config else None
+    trips = TripDetector.from_config(config.get('trips'), os.path.dirname(os.path.realpath(__file__)))
+    analytics = open_analytics(config.get('analytics'))
+    if analytics is not None and time_series is not None:
+        analytics.seed(time_series)
+    charge_estimator = ChargeEstimator.from_config(config.get('charging'), config['vehicle']['battery_capacity'],
+                                                   os.path.dirname(os.path.realpath(__file__)))
+    power = PowerManager.from_config(config.get('power'), os.path.dirname(os.path.realpath(__file__)), metrics)
+    cache = ConnectionCache.from_config(config.get('connection_cache'), os.path.dirname(os.path.realpath(__file__)))
+    capabilities = CapabilityMap.from_config(config.get('capabilities'), os.path.dirname(os.path.realpath(__file__)))
+    breaker = CircuitBreaker.from_config(config.get('breaker'), os.path.dirname(os.path.realpath(__file__)), metrics)
+    raw = RawBatch.from_config(config.get('raw'))
+    # Discover the vehicle again once (--discover)
+    discover = config.get('discover', False)
+    connection = None
+
+    try:
+        logger.info("=== Service start (interval: {} second(s)) ===".format(interval))
+        next_cycle = time.monotonic()
+        next_metrics = next_cycle
+        reverse = False
+        while True:
+            cycle_start = time.monotonic()
+            if power is not None:
+                interval = power.interval()
+            mqtt_msgs = [state_message(topic_prefix)]
+            try:
+                # Only reconnect when there is no connection or the link dropped
+                if connection is None or connection.status() != OBDStatus.CAR_CONNECTED:
+                    if connection is not None:
+                        logger.warning("OBDII connection lost ({}). Reconnecting...".format(connection.status()))
+                        connection.close()
+                        connection = None
+                    connection = vehicle_connect(config, metrics, power, cache)
+                    # Polling rates are kept per connection (i.e. VIN is queried once per connection)
+                    connection.scheduler = PollingScheduler(config.get('schedule'))
+                    # ECUs not answering are kept across connections
+                    connection.breaker = breaker
+                    connection.raw = raw
+
+                if power is None or not power.sleeping or probe_vehicle(connection, power):
+                    if capabilities is not None and (discover or capabilities.needs_discovery()):
+                        if discover_capabilities(connection, capabilities):
+                            discover = False
+                    # Use the scheduled cycle time, so commands are due on exact multiples of the interval
+                    connection.scheduler.start_cycle(next_cycle)
+                    mqtt_msgs.extend(query_data(connection, config, topic_prefix, reverse,
+                                                deadline=next_cycle + interval,
+                                                time_series=time_series,
+                                                trips=trips,
+                                                analytics=analytics,
+                                                charge_estimator=charge_estimator,
+                                                power=power,
+                                                capabilities=capabilities))
+                    reverse = not reverse
+            except OBDIIConnectionError as err:
+                logger.error("OBDII connection error: {0}".format(err),
+                             exc_info=False)
+                if power is not None:
+                    power.unanswered()
+            except Exception as ex:
+                logger.error("Unexpected error: {}".format(ex),
+                             exc_info=True)
+            if breaker is not None:
+                breaker.save()
+            if trips is not None:
+                trip_msg = trips.end_message(topic_prefix + "trip")
+                if trip_msg is not None:
+                    mqtt_msgs.append(trip_msg)
+
+            if change_filter is not None:
+                mqtt_msgs = change_filter.filter(mqtt_msgs)
+                logger.info("{} byte(s) saved by change-based publishing".format(change_filter.bytes_saved))
+            if encoder is not None:
+                mqtt_msgs = encoder.encode(mqtt_msgs)
+            if metrics is not None and time.monotonic() >= next_metrics:
+                mqtt_msgs.append(metrics.message(topic_prefix + "metrics"))
+                if metrics_config.get('textfile'):
+                    metrics.write_textfile(metrics_config['textfile'])
+                next_metrics += float(metrics_config.get('interval', 60))
+            publish_start = time.monotonic()
+            if local_publisher is not None:
+                publish_data_local(local_publisher, mqtt_msgs, store)
+            else:
+                publish_data_client(mqtt_client, mqtt_msgs, store)
+            if metrics is not None:
+                metrics.observe('mqtt_publish_duration_seconds', time.monotonic() - publish_start)
+                metrics.observe('obdii_cycle_duration_seconds', time.monotonic() - cycle_start)
+            logger.info("Cycle finished in {:.3f} second(s)".format(time.monotonic() - cycle_start))
+
+            if power is not None:
+                # The state may have changed during the cycle (i.e. the car woke up)
+                interval = power.interval()
+            next_cycle += interval
+            delay = next_cycle - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                logger.warning("Cycle took {:.1f} second(s) longer than the configured interval".format(-delay))
+                next_cycle = time.monotonic()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        if mqtt_client is not None:
+            mqtt_client.disconnect()
+            mqtt_client.loop_stop()
+        if local_publisher is not None:
+            local_publisher.close()
+        if store is not None:
+            store.close()
+        if time_series is not None:
+            time_series.close()
+        if connection is not None:
+            connection.close()
+        logger.info("===  Service end  ===")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish OBDII vehicle data to MQTT.")
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        help="keep running and query the vehicle every service interval")
+    parser.add_argument('--record',
+                        metavar='FILE',
+                        help="append every OBDII query and its raw response to FILE")
+    parser.add_argument('--replay',
+                        metavar='FILE',
+                        help="answer OBDII queries from a session recorded with --record instead of the vehicle")
+    parser.add_argument('--discover',
+                        action='store_true',
+                        help="probe the commands supported by the vehicle again (needs the capabilities section)")
+    parser.add_argument('--fast',
+                        action='store_true',
+                        help="when replaying, answer as fast as possible instead of at the recorded speed")
+    args = parser.parse_args()
+
+    console_handler = logging.StreamHandler()  # sends output to stderr
+    console_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-10s %(levelname)-8s %(message)s"))
+    console_handler.setLevel(logging.DEBUG)
+    logger.addHandler(console_handler)
+
+    file_handler = logging.handlers.TimedRotatingFileHandler(os.path.dirname(os.path.realpath(__file__)) + '/../obdii_data.log',
+                                                             when='midnight',
+                                                             backupCount=15
+                                                             )  # sends output to obdii_data.log file rotating it at midnight and storing latest 15 days
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-10s %(levelname)-8s %(message)s"))
+    file_handler.setLevel(logging.INFO)
+    logger.addHandler(file_handler)
+
+    logger.setLevel(logging.DEBUG)
+
+    obd.logger.setLevel(obd.logging.DEBUG)
+    # Remove obd logger existing handlers
+    for handler in obd.logger.handlers[:]:
+        obd.logger.removeHandler(handler)
+    # Add handlers to obd logger
+    obd.logger.addHandler(console_handler)
+    obd.logger.addHandler(file_handler)
+
+    # Add handlers to the logger of the modules shared with other scripts
+    common_logger = logging.getLogger('pioniq')
+    common_logger.setLevel(logging.DEBUG)
+    common_logger.addHandler(console_handler)
+    common_logger.addHandler(file_handler)
+
+    with open(os.path.dirname(os.path.realpath(__file__)) + '/obdii_data.config.json') as config_file:
+        config = json.loads(config_file.read())
+
+    if args.record:
+        config['record'] = {'path': args.record}
+    if args.replay:
+        config['replay'] = {'path': args.replay, 'realtime': not args.fast}
+    if args.discover:
+        if not config.get('capabilities'):
+            parser.error("--discover needs the capabilities section in obdii_data.config.json")
+        config['discover'] = True
+
+    if args.daemon:
+        # systemd stops the service with SIGTERM, exit cleanly closing connections
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        run_service(config)
+    else:
+        run_once(config)
+
+
 if __name__ == '__main__':
     logger = logging.getLogger('obdii')
     main()
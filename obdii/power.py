@@ -0,0 +1,118 @@
+import logging
+import time
+
+from state import state_path, load_state, save_state
+
+logger = logging.getLogger('obdii')
+
+ACTIVE = "active"
+CHARGING = "charging"
+SLEEP = "sleep"
+
+# Cron runs don't start at exact times, a poll due within these seconds is done now
+GRACE = 10
+
+
+class PowerManager(object):
+    """Polling profile state machine driven by the BMS ignition and charging flags and the connection status.
+
+    States:
+        active:   ignition on, the vehicle is polled every active_interval seconds.
+        charging: ignition off but charging, polled every charging_interval seconds.
+        sleep:    car off or not answering (after max_misses consecutive failures).
+                  Only a cheap probe (one connection attempt with probe_timeout
+                  and one BMS query without retries) is done, every
+                  sleep_interval seconds doubled after every probe the car is
+                  still asleep, up to max_sleep_interval, so the ECUs (and the
+                  12 V battery) are left alone while parked.
+
+    When path is set, the state and the next poll time are saved there, so
+    script runs (i.e. cron) that are not due exit without connecting.
+    """
+
+    def __init__(self, active_interval=10, charging_interval=60, sleep_interval=300, max_sleep_interval=3600,
+                 probe_timeout=5, max_misses=2, path=None, metrics=None):
+        self.intervals = {ACTIVE: active_interval, CHARGING: charging_interval}
+        self.sleep_interval = sleep_interval
+        self.max_sleep_interval = max_sleep_interval
+        self.probe_timeout = probe_timeout
+        self.max_misses = max_misses
+        self.path = path
+        self.metrics = metrics
+        self.state = ACTIVE
+        self.misses = 0  # consecutive cycles without answer from the BMS
+        self.sleeps = 0  # consecutive probes the car was asleep
+        self.next_poll = 0
+        saved = load_state(path, "power state", ('state', 'misses', 'sleeps', 'next_poll'))
+        if saved is not None:
+            self.state = saved['state']
+            self.misses = saved['misses']
+            self.sleeps = saved['sleeps']
+            self.next_poll = saved['next_poll']
+
+    @classmethod
+    def from_config(cls, power_config, base_dir, metrics=None):
+        """Create the manager from the 'power' config section (None when not configured)."""
+        if not power_config:
+            return None
+        return cls(active_interval=float(power_config.get('active_interval', 10)),
+                   charging_interval=float(power_config.get('charging_interval', 60)),
+                   sleep_interval=float(power_config.get('sleep_interval', 300)),
+                   max_sleep_interval=float(power_config.get('max_sleep_interval', 3600)),
+                   probe_timeout=float(power_config.get('probe_timeout', 5)),
+                   max_misses=int(power_config.get('max_misses', 2)),
+                   path=state_path(power_config.get('path'), base_dir),
+                   metrics=metrics)
+
+    @property
+    def sleeping(self):
+        return self.state == SLEEP
+
+    def transition(self, state):
+        if state != self.state:
+            logger.info("Power state: {} -> {}".format(self.state, state))
+            if self.metrics is not None:
+                self.metrics.inc('power_state_transitions_total', state=state)
+            self.state = state
+
+    def update(self, bms_info):
+        """Update the state with the BMS 2101 values (battery info or the probe response)."""
+        self.misses = 0
+        if bms_info['bmsIgnition']:
+            self.transition(ACTIVE)
+        elif bms_info['charging']:
+            self.transition(CHARGING)
+        else:
+            self.asleep()
+            return
+        self.sleeps = 0
+
+    def unanswered(self):
+        """The BMS didn't answer (or the connection failed): the car is asleep after max_misses times."""
+        self.misses += 1
+        if self.sleeping or self.misses >= self.max_misses:
+            self.asleep()
+
+    def asleep(self):
+        if self.sleeping:
+            self.sleeps += 1
+        else:
+            self.transition(SLEEP)
+            self.sleeps = 0
+
+    def interval(self):
+        """Seconds until the next poll in the current state."""
+        if self.sleeping:
+            return min(self.max_sleep_interval, self.sleep_interval * 2 ** self.sleeps)
+        return self.intervals[self.state]
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        return now + GRACE >= self.next_poll
+
+    def schedule(self, start=None):
+        """Set the next poll time from the start of the current poll and save the state."""
+        self.next_poll = (time.time() if start is None else start) + self.interval()
+        if self.path is None:
+            return
+        save_state(self.path, {'state': self.state, 'misses': self.misses, 'sleeps': self.sleeps, 'next_poll': self.next_poll})
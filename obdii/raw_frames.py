@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""Raw PID response batches: the response data of the extended commands, decoded by the consumer.
+
+Consumers only need this file, decoders.py and signals.py (standard library
+only) to read the batches:
+
+    from raw_frames import decode_batch
+    for timestamp, command, values in decode_batch(msg.payload):
+        ...
+
+A batch is a header followed by the frames:
+    magic (1 byte, 'R'), version (1 byte), flags (1 byte, bit 0: frames
+    compressed with zlib), number of frames (2 bytes), base time (4 bytes,
+    epoch seconds)
+Each frame is its time (4 bytes, milliseconds since the base time), command id
+(1 byte) and data length (2 bytes) followed by the response data, as python-OBD
+message data (i.e. byte 0 is 0x61 and byte 1 is 0x01 for BMS 2101). All values
+are little-endian.
+
+Command ids are never changed once published: new commands get new ids, so
+old batches can still be decoded.
+"""
+
+import argparse
+import json
+import logging
+import struct
+import sys
+import time
+import zlib
+
+import decoders
+
+logger = logging.getLogger('obdii')
+
+MAGIC = 0x52  # 'R', JSON payloads start with '{' and binary ones with 'P'
+VERSION = 1
+FLAG_ZLIB = 0x01
+MAX_FRAMES = 0xFFFF
+# Max frames size (uncompressed) of a batch, so it fits the local publisher datagrams (64 KB)
+MAX_BYTES = 60000
+_HEADER = struct.Struct('<BBBHI')
+_FRAME = struct.Struct('<IBH')
+
+# Command id, extended command name and signal layout of its response
+COMMANDS = (
+    (1, "BMS_2101", decoders.BMS_2101),
+    (2, "BMS_2102", decoders.CELL_VOLTAGES),
+    (3, "BMS_2103", decoders.CELL_VOLTAGES),
+    (4, "BMS_2104", decoders.CELL_VOLTAGES),
+    (5, "BMS_2105", decoders.BMS_2105),
+    (6, "ODOMETER_22B002", decoders.ODOMETER),
+    (7, "VIN_1A80", decoders.VIN),
+    (8, "VMCU_2101", decoders.VMCU),
+    (9, "TPMS_22C00B", decoders.TPMS),
+    (10, "EXT_TEMP_2180", decoders.EXTERNAL_TEMPERATURE),
+)
+COMMAND_IDS = {name: command_id for command_id, name, layout in COMMANDS}
+
+
+def encode(frames, compress=False):
+    """Encode (timestamp, command id, data) frames as a batch."""
+    base = int(min(frame[0] for frame in frames))
+    body = b''.join(_FRAME.pack(int(round((timestamp - base) * 1000)), command_id, len(data)) + data
+                    for timestamp, command_id, data in frames)
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 9)
+        flags |= FLAG_ZLIB
+    return _HEADER.pack(MAGIC, VERSION, flags, len(frames), base) + body
+
+
+class BatchDecoder(object):
+    """Decode raw batches with the signal layouts of decoders.py.
+
+    Meant to run over large amounts of stored batches: the command lookups are
+    resolved once into a table by command id, frames of the commands not
+    wanted are skipped reading only their header and the wanted ones are
+    decoded in place (a memoryview of the batch, no copies) by the compiled
+    layouts. Responses the layout can't decode (too short or null) are
+    returned with None values.
+    """
+
+    def __init__(self, commands=None):
+        self.layouts = [None] * 256
+        for command_id, name, layout in COMMANDS:
+            if commands is None or name in commands:
+                self.layouts[command_id] = (name, layout.decode_data)
+
+    def frames(self, payload):
+        """Yield (timestamp, command id, data memoryview) of every frame of a batch."""
+        magic, version, flags, count, base = _HEADER.unpack_from(payload)
+        if magic != MAGIC:
+            raise ValueError("Not a raw batch")
+        if version != VERSION:
+            raise ValueError("Unknown raw batch version {}".format(version))
+        if flags & FLAG_ZLIB:
+            body = memoryview(zlib.decompress(memoryview(payload)[_HEADER.size:]))
+        else:
+            body = memoryview(payload)[_HEADER.size:]
+        unpack_from = _FRAME.unpack_from
+        frame_size = _FRAME.size
+        offset = 0
+        for _ in range(count):
+            millis, command_id, length = unpack_from(body, offset)
+            offset += frame_size
+            yield base + millis / 1000.0, command_id, body[offset:offset + length]
+            offset += length
+
+    def decode(self, payload):
+        """Yield (timestamp, command name, values) of the wanted frames of a batch."""
+        layouts = self.layouts
+        for timestamp, command_id, data in self.frames(payload):
+            layout = layouts[command_id]
+            if layout is not None:
+                yield timestamp, layout[0], layout[1](data)
+
+    def decode_many(self, payloads):
+        """Yield (timestamp, command name, values) of the wanted frames of every batch."""
+        for payload in payloads:
+            for frame in self.decode(payload):
+                yield frame
+
+
+_DECODER = BatchDecoder()
+
+
+def decode_batch(payload):
+    """Decode a batch into a list of (timestamp, command name, values)."""
+    return list(_DECODER.decode(payload))
+
+
+class RawBatch(object):
+    """Collect the raw responses of the extended commands and build the raw topic batches.
+
+    Responses are added by query_command as the vehicle answers them
+    (responses of the polling scheduler cache are not added again). A batch
+    message (not retained, qos 1) is built once the oldest frame is interval
+    seconds old, so with 0 every cycle publishes its responses. Batches are
+    also flushed (and split) once their frames reach MAX_BYTES or MAX_FRAMES.
+
+    With decoded False only the raw batches are published: the responses are
+    still decoded by the connection, but no topic info nor JSON is built
+    from them (the consumer decodes the batches).
+    """
+
+    def __init__(self, compress=False, interval=0, decoded=True):
+        self.compress = compress
+        self.interval = interval
+        self.decoded = decoded
+        self.frames = []  # (time, command id, data)
+        self.size = 0  # encoded size of the frames
+
+    @classmethod
+    def from_config(cls, raw_config):
+        """Create the batch from the 'raw' config section (None when not configured)."""
+        if not raw_config:
+            return None
+        return cls(compress=raw_config.get('compress', False),
+                   interval=float(raw_config.get('interval', 0)),
+                   decoded=raw_config.get('decoded', True))
+
+    def add(self, name, timestamp, data):
+        command_id = COMMAND_IDS.get(name)
+        if command_id is not None:
+            self.frames.append((timestamp, command_id, data))
+            self.size += _FRAME.size + len(data)
+
+    def messages(self, topic, now=None, force=False):
+        """Build the batch messages when due (or forced), none when there's nothing to publish yet."""
+        if not self.frames:
+            return []
+        now = time.time() if now is None else now
+        if not force and now - self.frames[0][0] < self.interval and len(self.frames) < MAX_FRAMES and self.size < MAX_BYTES:
+            return []
+        msgs = []
+        while self.frames:
+            # At least a frame per batch, a response is always far below MAX_BYTES
+            count = 1
+            size = _FRAME.size + len(self.frames[0][2])
+            while count < len(self.frames) and count < MAX_FRAMES:
+                frame_size = _FRAME.size + len(self.frames[count][2])
+                if size + frame_size > MAX_BYTES:
+                    break
+                size += frame_size
+                count += 1
+            frames, self.frames = self.frames[:count], self.frames[count:]
+            self.size -= size
+            payload = encode(frames, self.compress)
+            logger.info("{} raw frame(s) batched in {} byte(s)".format(len(frames), len(payload)))
+            msgs.append({'topic': topic,
+                         'payload': payload,
+                         'qos': 1,
+                         'retain': False})
+        return msgs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode stored raw batches (one per file) as JSON lines.")
+    parser.add_argument('files', nargs='+', help="raw batch files")
+    parser.add_argument('--command', action='append', dest='commands',
+                        help="only decode the frames of this command (can be repeated)")
+    args = parser.parse_args()
+
+    decoder = BatchDecoder(args.commands)
+    start = time.perf_counter()
+    count = 0
+    for path in args.files:
+        with open(path, 'rb') as batch_file:
+            payload = batch_file.read()
+        for timestamp, name, values in decoder.decode(payload):
+            sys.stdout.write(json.dumps({'timestamp': timestamp, 'command': name, 'values': values}) + "\n")
+            count += 1
+    elapsed = time.perf_counter() - start
+    sys.stderr.write("{} frame(s) decoded in {:.3f} second(s)\n".format(count, elapsed))
+
+
+if __name__ == '__main__':
+    main()
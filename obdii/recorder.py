@@ -0,0 +1,132 @@
+import json
+import logging
+import time
+from collections import deque
+
+from obd import OBDStatus
+from obd.OBDResponse import OBDResponse
+from obd.elm327 import ELM327
+
+logger = logging.getLogger('obdii')
+
+# Protocol used when the recording doesn't say it (ISO 15765-4 CAN 11 bit ID, 500 kbaud)
+DEFAULT_PROTOCOL = "6"
+
+
+class RecordingConnection(object):
+    """OBD connection wrapper appending every query and its raw response to a file.
+
+    Each line of the file is a JSON object. A session line is written when the
+    recording starts:
+        {"session": <epoch time>, "protocol": "<ELM327 protocol id>"}
+    followed by one line per query:
+        {"t": <epoch time>, "d": <query seconds>, "cmd": "<command>", "name": "<command name>",
+         "lines": [<raw adapter lines>]}
+    Queries raising an exception store it in "error" instead of "lines".
+    """
+
+    def __init__(self, connection, path):
+        self.connection = connection
+        self.path = path
+        self.file = open(path, 'a')
+        if hasattr(connection, 'keep_lines'):
+            # The lean transport only keeps the raw lines when asked
+            connection.keep_lines = True
+        self._write({'session': round(time.time(), 3), 'protocol': connection.protocol_id()})
+        logger.info("Recording OBDII session to {}".format(path))
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')) + "\n")
+        self.file.flush()
+
+    def query(self, command, force=False):
+        record = {'t': round(time.time(), 3),
+                  'cmd': command.command.decode(),
+                  'name': command.name}
+        start = time.monotonic()
+        try:
+            response = self.connection.query(command, force=force)
+        except Exception as err:
+            record.update({'d': round(time.monotonic() - start, 4), 'error': str(err)})
+            self._write(record)
+            raise
+        lines = getattr(response, 'lines', None)
+        if lines is None:
+            lines = [frame.raw for message in response.messages for frame in message.frames]
+        record.update({'d': round(time.monotonic() - start, 4),
+                       'lines': [line for line in lines if line]})
+        self._write(record)
+        return response
+
+    def close(self):
+        self.connection.close()
+        self.file.close()
+
+    def __getattr__(self, name):
+        # Everything else (status, protocol_id, print_commands...) is served by the real connection
+        return getattr(self.connection, name)
+
+
+class ReplayConnection(object):
+    """Connection answering queries with the responses of a recorded session.
+
+    Can be used in place of obd.OBD. Responses are served per command name (the
+    same command string, i.e. 2101, is sent to different modules) in the
+    recorded order, so the replay doesn't depend on the exact query sequence.
+    When realtime is True each query takes as long as it took when recorded,
+    otherwise responses are returned as fast as possible. When loop is True the
+    recorded responses of a command start over once they are exhausted, when
+    False an empty response is returned (as if the vehicle didn't answer).
+    """
+
+    def __init__(self, path, realtime=True, loop=True):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.records = {}
+        protocol_id = None
+        with open(path) as record_file:
+            for line in record_file:
+                record = json.loads(line)
+                if 'session' in record:
+                    protocol_id = protocol_id or record.get('protocol')
+                else:
+                    self.records.setdefault(record['name'], []).append(record)
+        self.protocol = ELM327._SUPPORTED_PROTOCOLS[protocol_id or DEFAULT_PROTOCOL]([])
+        self.pending = {name: deque(records) for name, records in self.records.items()}
+        self.connected = True
+        logger.info("Replaying OBDII session from {} ({} commands)".format(path, len(self.records)))
+
+    def _next_record(self, name):
+        pending = self.pending.get(name)
+        if not pending and self.loop and name in self.records:
+            pending = self.pending[name] = deque(self.records[name])
+        return pending.popleft() if pending else None
+
+    def query(self, command, force=False):
+        if not self.connected:
+            return OBDResponse()
+        record = self._next_record(command.name)
+        if record is None:
+            logger.info("No recorded response for command: {}".format(command))
+            return OBDResponse()
+        if self.realtime:
+            time.sleep(record['d'])
+        if 'error' in record:
+            raise IOError(record['error'])
+        messages = self.protocol(record['lines'])
+        if not messages:
+            return OBDResponse()
+        return command(messages)
+
+    def status(self):
+        return OBDStatus.CAR_CONNECTED if self.connected else OBDStatus.NOT_CONNECTED
+
+    def protocol_id(self):
+        return self.protocol.ELM_ID
+
+    def print_commands(self):
+        pass
+
+    def close(self):
+        self.connected = False
@@ -0,0 +1,71 @@
+import logging
+import time
+
+logger = logging.getLogger('obdii')
+
+# Commands are considered lagging when they are queried this many times later than configured
+LAG_FACTOR = 1.5
+
+
+class PollingScheduler(object):
+    """Decide which ext_commands are due on every polling cycle.
+
+    Each command name may have its own schedule, a dict with:
+        interval: seconds between queries. 0 queries the command on every
+                  cycle and None only once per OBDII connection.
+        priority: lower values are queried first when the cycle runs out of time.
+
+    Commands without schedule are queried on every cycle with the default priority.
+    The latest valid response of each command is kept so that not due commands
+    can be answered without using the bus.
+    """
+
+    def __init__(self, schedule=None, default_priority=10):
+        self.schedule = schedule or {}
+        self.default_priority = default_priority
+        self.cycle_start = time.monotonic()
+        self.last_query = {}  # cycle start time of latest valid response per command name
+        self.responses = {}  # latest valid response per command name
+        self.lagging = {}  # number of times each command has been queried late
+
+    def interval(self, name):
+        return self.schedule.get(name, {}).get('interval', 0)
+
+    def priority(self, name):
+        return self.schedule.get(name, {}).get('priority', self.default_priority)
+
+    def start_cycle(self, now=None):
+        """Set the reference time used to decide which commands are due in this cycle."""
+        self.cycle_start = time.monotonic() if now is None else now
+
+    def is_due(self, name):
+        if name not in self.last_query:
+            return True
+        interval = self.interval(name)
+        if interval is None:
+            return False
+        return self.cycle_start - self.last_query[name] >= interval
+
+    def due_priority(self, names):
+        """Return the highest priority (lowest value) of the due commands or None when none is due."""
+        priorities = [self.priority(name) for name in names if self.is_due(name)]
+        return min(priorities) if priorities else None
+
+    def cached(self, name):
+        """Return the latest valid response for a not due command, None if it must be queried."""
+        if self.is_due(name):
+            return None
+        return self.responses.get(name)
+
+    def record(self, name, response):
+        """Store a valid response, warning when the command could not be queried at its configured rate."""
+        interval = self.interval(name)
+        previous = self.last_query.get(name)
+        if previous is not None and interval:
+            elapsed = self.cycle_start - previous
+            if elapsed > interval * LAG_FACTOR:
+                self.lagging[name] = self.lagging.get(name, 0) + 1
+                logger.warning("Scheduler cannot keep up with {}: queried after {:.1f} second(s) but configured every {} second(s)"
+                               .format(name, elapsed, interval))
+        self.last_query[name] = self.cycle_start
+        self.responses[name] = response
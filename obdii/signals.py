@@ -0,0 +1,158 @@
+import re
+from collections import namedtuple
+
+# Declarative definition of a value stored in a PID response:
+#   name:          key of the value in the decoded dict.
+#   offset:        position of the first byte in the response data.
+#   length:        number of bytes of the value.
+#   signed:        True for two's complement values.
+#   little_endian: True when the least significant byte comes first (big-endian otherwise).
+#   scale:         Python expression converting the raw value 'x' (i.e. 'x / 10.0').
+#   unit:          unit of the decoded value, for documentation purposes.
+#   mask:          bit mask, the value is 1 when any of its bits is set, 0 otherwise.
+#   invert:        with mask, the value is 1 when none of its bits is set.
+#   flags:         sequence of (text, bit mask) pairs, the value is the text of the bits set concatenated.
+#   text:          True to decode the bytes as a latin-1 string.
+#   count:         number of consecutive values of the same length (the value is a list).
+#   null:          value meaning that the whole response is not available (decoded as None).
+Signal = namedtuple('Signal', ['name', 'offset', 'length', 'signed', 'little_endian', 'scale', 'unit',
+                               'mask', 'invert', 'flags', 'text', 'count', 'null'])
+Signal.__new__.__defaults__ = (1, False, False, None, None, None, False, None, False, 1, None)
+
+# Value computed from the signals of the same response, referenced by name in the expression.
+Derived = namedtuple('Derived', ['name', 'expression', 'unit'])
+Derived.__new__.__defaults__ = (None,)
+
+_INT_FORMATS = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
+
+def _raw_format(signal):
+    """Struct format character(s) used to read a single raw value of the signal."""
+    if signal.text:
+        return '{}s'.format(signal.length)
+    if signal.length not in _INT_FORMATS:
+        # Read as bytes, converted to int in the generated code
+        return '{}s'.format(signal.length)
+    fmt = _INT_FORMATS[signal.length]
+    return fmt if signal.signed else fmt.upper()
+
+
+def _raw_key(signal, index):
+    """Signals reading the same bytes the same way share the raw value."""
+    offset = signal.offset + index * signal.length
+    return (offset, signal.length, signal.signed, signal.little_endian, _raw_format(signal))
+
+
+def _struct_passes(raw_keys):
+    """Group raw values in the minimum number of non overlapping struct layouts."""
+    passes = []
+    for key in sorted(raw_keys):
+        for layout in passes:
+            last = layout[-1]
+            if key[0] >= last[0] + last[1] and key[3] == last[3]:
+                layout.append(key)
+                break
+        else:
+            passes.append([key])
+    return passes
+
+
+def _struct_format(layout):
+    fmt = '<' if layout[0][3] else '>'
+    position = 0
+    for offset, length, signed, little_endian, raw_format in layout:
+        if offset > position:
+            fmt += '{}x'.format(offset - position)
+        fmt += raw_format
+        position = offset + length
+    return fmt
+
+
+def _convert(signal, raw):
+    """Python expression converting the raw value variable name into the decoded value."""
+    if signal.text:
+        return "{}.decode('latin-1')".format(raw)
+    if signal.length not in _INT_FORMATS:
+        raw = "int.from_bytes({}, '{}', signed={})".format(raw, 'little' if signal.little_endian else 'big', signal.signed)
+    if signal.flags:
+        return " + ".join('("{}" if {} & {} else "")'.format(text, raw, hex(mask)) for text, mask in signal.flags)
+    if signal.mask is not None:
+        return "({} if {} & {} else {})".format(0 if signal.invert else 1, raw, hex(signal.mask), 1 if signal.invert else 0)
+    if signal.scale:
+        return re.sub(r'\bx\b', raw, signal.scale)
+    return raw
+
+
+class SignalLayout(object):
+    """Decoder of a PID response compiled from its signal definitions.
+
+    All the raw values are read with precomputed struct layouts (usually a single
+    unpack_from call) and converted by generated code building the result at once.
+    The same output is available from the response data (decode_data) and from
+    the python-OBD messages (decode, used as OBDCommand decoder).
+    """
+
+    def __init__(self, name, description, fields, as_list=False):
+        self.name = name
+        self.description = description
+        self.fields = tuple(fields)  # Signal and Derived in output order
+        self.signals = tuple(field for field in self.fields if isinstance(field, Signal))
+        self.as_list = as_list
+        self.size = max(signal.offset + signal.length * signal.count for signal in self.signals)
+        self.source = self._source()
+        namespace = {}
+        exec(compile(self.source, '<signals {}>'.format(name), 'exec'), namespace)
+        self.decode_data = namespace['decode_data']
+        self.decode = namespace['decode']
+        self.decode.__name__ = name
+        self.decode.__doc__ = description
+
+    def _source(self):
+        raw_names = {}
+        for signal in self.signals:
+            for index in range(signal.count):
+                key = _raw_key(signal, index)
+                if key not in raw_names:
+                    raw_names[key] = "r{}".format(len(raw_names))
+
+        lines = []
+        for layout in _struct_passes(raw_names):
+            names = ", ".join(raw_names[key] for key in layout)
+            lines.append("    {}, = _unpack_from({!r}, d)".format(names, _struct_format(layout)))
+
+        for signal in self.signals:
+            if signal.count > 1:
+                value = "[{}]".format(", ".join(_convert(signal, raw_names[_raw_key(signal, index)])
+                                                for index in range(signal.count)))
+            else:
+                value = _convert(signal, raw_names[_raw_key(signal, 0)])
+            lines.append("    {} = {}".format(signal.name, value))
+            if signal.null is not None:
+                lines.append("    if {} == {!r}:".format(signal.name, signal.null))
+                lines.append("        return None")
+        for field in self.fields:
+            if isinstance(field, Derived):
+                lines.append("    {} = {}".format(field.name, field.expression))
+
+        values = [field.name for field in self.fields]
+
+        if self.as_list:
+            lines.append("    return {}".format(" + ".join(values)))
+        else:
+            lines.append("    return {{{}}}".format(", ".join("'{0}': {0}".format(value) for value in values)))
+
+        body = "\n".join(lines)
+        return ("from struct import unpack_from as _unpack_from\n"
+                "\n"
+                "\n"
+                "def decode_data(d):\n"
+                "    if len(d) < {size}:\n"
+                "        return None\n"
+                "{body}\n"
+                "\n"
+                "\n"
+                "def decode(messages):\n"
+                "    d = messages[0].data\n"
+                "    if len(d) < {size}:\n"
+                "        return None\n"
+                "{body}\n").format(size=self.size, body=body)
@@ -0,0 +1,250 @@
+import binascii
+import logging
+import time
+
+import serial
+from obd import OBDStatus
+from obd.elm327 import ELM327
+
+from decoders import LAYOUTS
+
+logger = logging.getLogger('obdii')
+
+ELM_PROMPT = 0x3E  # >
+# ISO-TP max message length (12 bit length of the first frame)
+MAX_MESSAGE = 4095
+# Response buffer: every 7 data bytes are sent as a line of a 8 hex digits ID, 16 hex digits and a CR
+MAX_RESPONSE = 16384
+# Hex digits of the CAN ID at the start of each line (with ATH1) by ELM327 protocol id
+HEADER_LENGTHS = {"6": 3, "8": 3, "7": 8, "9": 8}
+# ELM327 factory baud rate, used when the baud rate is not configured nor cached
+DEFAULT_BAUDRATE = 38400
+
+
+class FrameParser(object):
+    """Reassemble the ISO-TP frames of an ELM327 response into a preallocated buffer.
+
+    The response lines (headers on, spaces and linefeeds off) are parsed in
+    place: each frame is converted from hex and copied once to the message
+    buffer, and the message is returned as a memoryview of it, so no
+    intermediate objects are built per frame or per message. Frames of other
+    CAN IDs than the first one are ignored (the receive address is set with
+    ATCRA anyway). Lines that are not frames (i.e. OK, NO DATA, CAN ERROR)
+    are returned as text.
+    """
+
+    def __init__(self, header_length=3):
+        self.header_length = header_length
+        # A consecutive frame may carry up to 6 bytes past the message length
+        self.data = bytearray(MAX_MESSAGE + 7)
+        self.view = memoryview(self.data)
+
+    def parse(self, raw, end=None):
+        """Return the message (memoryview, None when incomplete or not received) and the text lines of raw[:end].
+
+        The memoryview is only valid until the next parse.
+        """
+        end = len(raw) if end is None else end
+        lines = memoryview(raw)
+        header_length = self.header_length
+        text = []
+        can_id = None
+        expected = None  # message length, known from the single or first frame
+        length = 0
+        sequence = 0
+        broken = False
+        start = 0
+        while start < end:
+            stop = raw.find(b"\r", start, end)
+            if stop < 0:
+                stop = end
+            line = lines[start:stop]
+            start = stop + 1
+            if not line:
+                continue
+            try:
+                frame = binascii.unhexlify(line[header_length:]) if len(line) > header_length + 1 else None
+            except (binascii.Error, ValueError):
+                frame = None
+            # CAN frames carry up to 8 bytes
+            if frame is None or len(frame) > 8:
+                text.append(line.tobytes().decode('latin-1'))
+                continue
+            if can_id is None:
+                can_id = line[:header_length].tobytes()
+            elif line[:header_length] != can_id:
+                continue
+            frame_type = frame[0] & 0xF0
+            if frame_type == 0x00:
+                # Single frame: 4 bit length
+                expected = frame[0] & 0x0F
+                length = min(expected, len(frame) - 1)
+                self.data[:length] = frame[1:1 + length]
+            elif frame_type == 0x10 and len(frame) > 2:
+                # First frame: 12 bit length
+                expected = ((frame[0] & 0x0F) << 8) | frame[1]
+                length = len(frame) - 2
+                self.data[:length] = frame[2:]
+                sequence = 1
+            elif frame_type == 0x20 and expected is not None and length < expected:
+                # Consecutive frame: 4 bit sequence number, frames are received in order
+                if frame[0] & 0x0F != sequence & 0x0F:
+                    broken = True
+                    continue
+                self.data[length:length + len(frame) - 1] = frame[1:]
+                length += len(frame) - 1
+                sequence += 1
+        if expected is None or not expected or length < expected or broken:
+            return None, text
+        return self.view[:expected], text
+
+
+class Response(object):
+    """Query response with the same interface query_command uses from python-OBD's OBDResponse."""
+
+    __slots__ = ('command', 'value', 'time', 'lines', 'data')
+
+    def __init__(self, command, value, lines=None, data=None):
+        self.command = command
+        self.value = value
+        self.time = time.time()
+        self.lines = lines  # raw response lines, only kept when recording
+        self.data = data  # message data (bytes), only kept for the raw batches
+
+    def is_null(self):
+        return self.value is None
+
+
+class ELM327Transport(object):
+    """Lean ELM327 connection, used in place of obd.OBD to query the ext_commands.
+
+    Speaks the ELM327 protocol directly over the serial port: every response
+    is read into a preallocated buffer up to the prompt, its ISO-TP frames are
+    reassembled by FrameParser and the decoders (decoders.LAYOUTS) read the
+    values straight from the message memoryview. Commands without layout (the
+    AT commands) get the text lines as value, as python-OBD's raw_string.
+    Only CAN protocols are supported.
+
+    The adapter is set up with ATZ, ATE0, ATL0, ATS0 and ATH1 and the protocol
+    (the one given, i.e. from the connection cache, or searched with ATSP0).
+    """
+
+    def __init__(self, portstr, baudrate=None, protocol=None, timeout=30):
+        self.timeout = timeout
+        self.connection_status = OBDStatus.NOT_CONNECTED
+        self.protocol = None
+        self.keep_lines = False
+        self.keep_data = False
+        self.rx = bytearray(MAX_RESPONSE)
+        self.port = None
+        self.portstr = portstr
+        logger.info("Initializing lean ELM327 transport: PORT={} BAUD={} PROTOCOL={}"
+                    .format(portstr, baudrate or DEFAULT_BAUDRATE, protocol or "auto"))
+        try:
+            self.port = serial.serial_for_url(portstr, baudrate=baudrate or DEFAULT_BAUDRATE, timeout=0.1)
+        except (serial.SerialException, OSError) as err:
+            logger.error("Cannot open {}: {}".format(portstr, err))
+            return
+
+        # Reset and wait for the prompt, junk may come before it
+        self.send_text(b"ATZ")
+        for command in (b"ATE0", b"ATL0", b"ATS0", b"ATH1"):
+            if "OK" not in self.send_text(command):
+                logger.error("{} did not return 'OK'".format(command.decode()))
+                self.close_port()
+                return
+        self.connection_status = OBDStatus.ELM_CONNECTED
+
+        if protocol is not None:
+            self.send_text(b"ATSP" + protocol.encode())
+        else:
+            self.send_text(b"ATSP0")
+        # First request to the car (searching the protocol in auto mode)
+        response = self.send_text(b"0100")
+        if not response or any("UNABLE TO CONNECT" in line for line in response):
+            logger.error("Connected to the adapter, but failed to connect to the vehicle")
+            self.close_port()
+            return
+        if protocol is None:
+            response = self.send_text(b"ATDPN")
+            protocol = response[0][1:] if response and response[0].startswith("A") else (response or [""])[0]
+        if protocol not in HEADER_LENGTHS:
+            logger.error("Protocol {} not supported by the lean transport (only CAN)".format(protocol))
+            self.close_port()
+            return
+        self.protocol = protocol
+        self.parser = FrameParser(HEADER_LENGTHS[protocol])
+        self.connection_status = OBDStatus.CAR_CONNECTED
+        logger.info("Connected Successfully: PORT={} BAUD={} PROTOCOL={}".format(portstr, self.port.baudrate, protocol))
+
+    def send(self, command):
+        """Send a command and read the response into the buffer up to the prompt. Returns its length."""
+        port = self.port
+        rx = self.rx
+        try:
+            port.reset_input_buffer()
+            port.write(command + b"\r")
+            size = 0
+            deadline = time.monotonic() + self.timeout
+            while True:
+                chunk = port.read(port.in_waiting or 1)
+                if chunk:
+                    if size + len(chunk) > MAX_RESPONSE:
+                        logger.warning("Response to {} too long, discarded".format(command))
+                        return 0
+                    rx[size:size + len(chunk)] = chunk
+                    size += len(chunk)
+                    if rx[size - 1] == ELM_PROMPT:
+                        return size - 1
+                elif time.monotonic() > deadline:
+                    logger.warning("No prompt after {} within {} second(s)".format(command, self.timeout))
+                    return size
+        except (serial.SerialException, OSError) as err:
+            logger.error("Serial error: {}".format(err))
+            self.close()
+            return 0
+
+    def send_text(self, command):
+        """Send a command and return the non empty response lines."""
+        size = self.send(command)
+        return [line for line in self.rx[:size].decode('latin-1').split("\r") if line.strip()]
+
+    def query(self, command, force=False):
+        if self.connection_status == OBDStatus.NOT_CONNECTED:
+            return Response(command, None)
+        size = self.send(command.command)
+        data, text = self.parser.parse(self.rx, size)
+        lines = self.rx[:size].decode('latin-1').split("\r") if self.keep_lines else None
+        # The message memoryview is reused by the next parse
+        kept_data = data.tobytes() if self.keep_data and data is not None else None
+        layout = LAYOUTS.get(command.decode.__name__)
+        if layout is not None:
+            value = layout.decode_data(data) if data is not None else None
+        else:
+            value = "\n".join(text) if data is None else data.hex()
+        return Response(command, value, lines, kept_data)
+
+    def status(self):
+        return self.connection_status
+
+    def protocol_id(self):
+        return self.protocol
+
+    def protocol_name(self):
+        return ELM327._SUPPORTED_PROTOCOLS[self.protocol].ELM_NAME if self.protocol else ""
+
+    def port_name(self):
+        return self.portstr
+
+    def print_commands(self):
+        pass
+
+    def close_port(self):
+        """Close the serial port keeping the status (i.e. of a failed setup, so the caller can retry)."""
+        if self.port is not None:
+            self.port.close()
+            self.port = None
+
+    def close(self):
+        self.close_port()
+        self.connection_status = OBDStatus.NOT_CONNECTED
@@ -0,0 +1,171 @@
+import json
+import logging
+import time
+
+from state import state_path, load_state, save_state
+
+logger = logging.getLogger('obdii')
+
+
+class TripDetector(object):
+    """Detect trips from the queried values and aggregate them as they are received.
+
+    A trip starts with the first vmcu sample driving (gear D or R, or any speed)
+    and ends when no sample has been driving for end_timeout seconds (parked or
+    car off), so short stops don't split a trip. Every sample only updates
+    running values (O(1)):
+        - distance: odometer difference (km), the speed integrated over time
+          when the odometer is not available.
+        - energy: cumulativeEnergyDischarged and cumulativeEnergyCharged
+          differences (kWh), energy charged while driving is regenerated.
+        - average speed: speed integrated over the driving time.
+
+    When path is set, the trip in progress is saved there when it changed, so
+    trips span script runs (i.e. cron) and restarts. Saves are at most every
+    save_interval seconds (a service updates the trip every cycle) but when a
+    trip starts or ends, samples that don't change the trip (i.e. parked or
+    cached ones) aren't saved.
+    """
+
+    def __init__(self, end_timeout=300, min_distance=0.1, path=None, save_interval=60):
+        self.end_timeout = end_timeout
+        self.min_distance = min_distance
+        self.path = path
+        self.save_interval = save_interval
+        self.latest = {}  # latest odometer and energy counters, also out of trips
+        self.trip = None
+        self.changed = False
+        self.last_save = 0  # 0 to save on the next call
+        state = load_state(path, "trip state", ('latest', 'trip'))
+        if state is not None:
+            self.latest = state['latest']
+            self.trip = state['trip']
+
+    @classmethod
+    def from_config(cls, trips_config, base_dir):
+        """Create the detector from the 'trips' config section (None when not configured)."""
+        if not trips_config:
+            return None
+        return cls(end_timeout=float(trips_config.get('end_timeout', 300)),
+                   min_distance=float(trips_config.get('min_distance', 0.1)),
+                   path=state_path(trips_config.get('path'), base_dir),
+                   save_interval=float(trips_config.get('save_interval', 60)))
+
+    def update(self, topic, info):
+        """Update the running values with the info of a queried topic."""
+        if topic == "battery":
+            self.counter('energyDischarged', info.get('cumulativeEnergyDischarged'))
+            self.counter('energyCharged', info.get('cumulativeEnergyCharged'))
+            self.counter('soc', info.get('socDisplay'))
+        elif topic == "odometer":
+            self.counter('odometer', info.get('odometer'))
+        elif topic == "vmcu":
+            self.drive(info['timestamp'], info.get('gear') or "", info.get('speed') or 0)
+
+    def counter(self, name, value):
+        if value is None:
+            return
+        if self.latest.get(name) != value:
+            self.latest[name] = value
+            self.changed = True
+        self.latest['updated'] = time.time()
+        if self.trip is not None and self.trip['start'].get(name) is None:
+            # Not known when the trip started, count from the first value
+            self.trip['start'][name] = value
+
+    def drive(self, timestamp, gear, speed):
+        driving = speed > 0 or "D" in gear or "R" in gear
+        trip = self.trip
+        if trip is None:
+            if not driving:
+                return
+            logger.info("Trip started")
+            # Counters read long ago may have changed since (i.e. charged), use the next ones instead
+            recent = time.time() - self.latest.get('updated', 0) <= self.end_timeout
+            trip = self.trip = {'startTime': timestamp, 'lastSample': timestamp, 'lastDriving': timestamp,
+                                'lastSpeed': speed, 'integratedDistance': 0.0, 'drivingTime': 0,
+                                'maxSpeed': speed, 'start': dict(self.latest) if recent else {}}
+            self.changed = True
+            self.last_save = 0
+        elif timestamp > trip['lastSample']:
+            elapsed = timestamp - trip['lastSample']
+            # Parked, only the sample time changes (nothing to integrate)
+            moved = driving or trip['lastSpeed'] > 0 or speed > 0
+            if elapsed <= self.end_timeout:
+                # Trapezoidal integration of the speed (km/h) over the elapsed seconds
+                trip['integratedDistance'] += (trip['lastSpeed'] + speed) / 2.0 * elapsed / 3600.0
+                if driving or trip['lastSpeed'] > 0:
+                    trip['drivingTime'] += elapsed
+            trip['lastSample'] = timestamp
+            trip['lastSpeed'] = speed
+            trip['maxSpeed'] = max(trip['maxSpeed'], speed)
+            if driving:
+                trip['lastDriving'] = timestamp
+            if moved:
+                self.changed = True
+
+    def summary(self):
+        """Aggregated values of the trip in progress."""
+        trip = self.trip
+        start = trip['start']
+        latest = self.latest
+        summary = {
+            'startTime': trip['startTime'],
+            'endTime': trip['lastDriving'],
+            'duration': trip['lastDriving'] - trip['startTime'],
+            'maxSpeed': round(trip['maxSpeed'], 1)
+        }
+        if start.get('odometer') is not None and latest['odometer'] > start['odometer']:
+            summary.update({'startOdometer': start['odometer'], 'endOdometer': latest['odometer']})
+            distance = latest['odometer'] - start['odometer']
+        else:
+            # The odometer resolution is 1 km
+            distance = trip['integratedDistance']
+        summary['distance'] = round(distance, 2)
+        summary['averageSpeed'] = round(trip['integratedDistance'] / trip['drivingTime'] * 3600, 1) if trip['drivingTime'] > 0 else 0
+        if start.get('energyDischarged') is not None:
+            discharged = latest['energyDischarged'] - start['energyDischarged']
+            regen = latest['energyCharged'] - start['energyCharged']
+            used = discharged - regen
+            summary.update({'energyDischarged': round(discharged, 1),
+                            'regenEnergy': round(regen, 1),
+                            'energyUsed': round(used, 1),
+                            'consumption': round(used / distance * 100, 1) if distance > 0 else None})  # kWh/100 km
+        if start.get('soc') is not None:
+            summary.update({'startSoc': start['soc'], 'endSoc': latest['soc']})
+        return summary
+
+    def end_message(self, topic, now=None):
+        """Return the trip MQTT message when the trip in progress ended (None otherwise).
+
+        Trips shorter than min_distance (i.e. moving the car in the garage) are discarded.
+        """
+        msg = None
+        now = time.time() if now is None else now
+        if self.trip is not None and now - self.trip['lastDriving'] > self.end_timeout:
+            summary = self.summary()
+            self.trip = None
+            self.changed = True
+            self.last_save = 0
+            if summary['distance'] < self.min_distance:
+                logger.info("Trip of {} km discarded".format(summary['distance']))
+            else:
+                logger.info("Trip ended: {} km, {} kWh/100 km".format(summary['distance'], summary.get('consumption')))
+                summary['timestamp'] = int(round(now))
+                msg = {'topic': topic,
+                       'payload': json.dumps(summary),
+                       'qos': 1,
+                       'retain': False}
+        self.save()
+        return msg
+
+    def save(self):
+        """Save the trip in progress and the latest counters when they changed (at most every save_interval seconds)."""
+        if self.path is None or not self.changed:
+            return
+        now = time.time()
+        if now - self.last_save < self.save_interval:
+            return
+        save_state(self.path, {'latest': self.latest, 'trip': self.trip})
+        self.changed = False
+        self.last_save = now
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import logging.handlers
+import os
+import signal
+import socket
+import ssl
+import sys
+
+import paho.mqtt.client as mqtt
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../common')
+from store import open_store, drain_store, STORE_CYCLE_BATCHES, STORE_CYCLE_TIMEOUT  # noqa: E402
+from local_publisher import MAX_MESSAGE_SIZE, unpack_message  # noqa: E402
+
+
+class ResumingContext(ssl.SSLContext):
+    """SSL context reusing the latest TLS session, so reconnections skip the full handshake."""
+
+    session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.session is not None:
+            kwargs.setdefault('session', self.session)
+        return super(ResumingContext, self).wrap_socket(sock, *args, **kwargs)
+
+
+def on_connect(client, userdata, flags, rc):
+    if rc == mqtt.CONNACK_ACCEPTED:
+        tls_socket = client.socket()
+        userdata.session = tls_socket.session
+        logger.info("Connected to MQTT (TLS session reused: {})".format(tls_socket.session_reused))
+    else:
+        logger.error("Not connected to MQTT: {}".format(mqtt.connack_string(rc)))
+
+
+def on_disconnect(client, userdata, rc):
+    if rc != mqtt.MQTT_ERR_SUCCESS:
+        logger.warning("Disconnected from MQTT: {}, reconnecting...".format(mqtt.error_string(rc)))
+
+
+def mqtt_connect(hostname, port, client_id, user, password, keepalive=60):
+    """Create the long-lived MQTT client, it connects and reconnects (with backoff) in the background."""
+    context = ResumingContext(ssl.PROTOCOL_TLS)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = True
+    context.load_default_certs()
+    mqtt_client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv311, transport="tcp", userdata=context)
+    mqtt_client.tls_set_context(context)
+    mqtt_client.username_pw_set(user, password)
+    mqtt_client.enable_logger(logger)
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_disconnect = on_disconnect
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=60)
+    mqtt_client.connect_async(hostname, port, keepalive)
+    mqtt_client.loop_start()
+    return mqtt_client
+
+
+def bind_socket(path):
+    """Create the Unix datagram socket the collectors send their messages to."""
+    if os.path.exists(path):
+        # Left by a previous run
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(path)
+    os.chmod(path, 0o660)
+    server.settimeout(1.0)
+    return server
+
+
+def run_service(config):
+    """Publish the messages received from the collectors using a single MQTT connection."""
+    mqtt_client = mqtt_connect(hostname=config['mqtt']['broker'],
+                               port=int(config['mqtt']['port']),
+                               client_id="pioniq-publisher",
+                               user=config['mqtt']['user'],
+                               password=config['mqtt']['password'],
+                               keepalive=int(config['mqtt'].get('keepalive', 60)))
+    store = open_store(config.get('store'), os.path.dirname(os.path.realpath(__file__)))
+    socket_path = config['publisher']['socket']
+    server = bind_socket(socket_path)
+
+    published = 0
+    try:
+        logger.info("=== Publisher start (socket: {}) ===".format(socket_path))
+        while True:
+            try:
+                # One byte more than the max, so truncated datagrams can be told apart
+                data = server.recv(MAX_MESSAGE_SIZE + 1)
+            except socket.timeout:
+                data = None
+            if data and len(data) > MAX_MESSAGE_SIZE:
+                logger.error("Message larger than {} bytes received, dropped".format(MAX_MESSAGE_SIZE))
+                data = None
+            if data:
+                msg = unpack_message(data)
+                result = mqtt_client.publish(topic=msg['topic'],
+                                             payload=msg['payload'],
+                                             qos=msg['qos'],
+                                             retain=msg['retain'])
+                if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                    published += 1
+                    logger.debug("Message published to {}".format(msg['topic']))
+                else:
+                    logger.error("Error publishing to MQTT: {}".format(mqtt.error_string(result.rc)))
+                    if store is not None:
+                        store.put([msg])
+            if store is not None and mqtt_client.is_connected() and len(store) > 0:
+                drain_store(mqtt_client, store, timeout=STORE_CYCLE_TIMEOUT, max_batches=STORE_CYCLE_BATCHES)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.close()
+        os.unlink(socket_path)
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()
+        if store is not None:
+            store.close()
+        logger.info("{} message(s) published".format(published))
+        logger.info("===  Publisher end  ===")
+
+
+def main():
+    console_handler = logging.StreamHandler()  # sends output to stderr
+    console_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-10s %(levelname)-8s %(message)s"))
+    console_handler.setLevel(logging.DEBUG)
+    logger.addHandler(console_handler)
+
+    file_handler = logging.handlers.TimedRotatingFileHandler(os.path.dirname(os.path.realpath(__file__)) + '/../publisher.log',
+                                                             when='midnight',
+                                                             backupCount=15
+                                                             )  # sends output to publisher.log file rotating it at midnight and storing latest 15 days
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-10s %(levelname)-8s %(message)s"))
+    file_handler.setLevel(logging.INFO)
+    logger.addHandler(file_handler)
+
+    logger.setLevel(logging.DEBUG)
+
+    with open(os.path.dirname(os.path.realpath(__file__)) + '/publisher.config.json') as config_file:
+        config = json.loads(config_file.read())
+
+    # systemd stops the service with SIGTERM, exit cleanly closing connections
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    run_service(config)
+
+
+if __name__ == '__main__':
+    # Same logger as the shared modules
+    logger = logging.getLogger('pioniq')
+    main()